@@ -0,0 +1,238 @@
+'''Compare HTTP transports against local test servers.
+
+    python benchmarks/bench_transport.py --requests 200 --workers 8 --delay 0.02
+
+Serves a synthetic ~200KB payload over TLS from two servers on localhost: a
+threaded http.server speaking HTTP/1.1, and an HTTP/2 server built on the h2
+package, which clients reach through ALPN just as they reach the archive host.
+Each response is held back by *delay* seconds to stand in for a remote server.
+Every available backend fetches the payload concurrently from each server it
+can speak to, so the httpx rows show the gain of multiplexing all requests
+over one HTTP/2 connection against a pool of HTTP/1.1 connections.
+
+Needs the openssl command for a throwaway certificate, and h2 for the HTTP/2
+server (installed with httpx[http2]).
+
+'''
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import os
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+except ImportError:
+    h2 = None
+
+from epaper.transport import TRANSPORTS, TransportError
+
+PAYLOAD = os.urandom(200 * 1024)
+
+
+def make_certificate(directory):
+    '''Write a self-signed certificate for 127.0.0.1, return (cert, key).'''
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+        '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=127.0.0.1',
+        '-addext', 'subjectAltName=IP:127.0.0.1'
+    ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+def tls_context(cert, key, protocol):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    context.set_alpn_protocols([protocol])
+    return context
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    delay = 0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(PAYLOAD)))
+        self.end_headers()
+        self.wfile.write(PAYLOAD)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTP1Server(ThreadingHTTPServer):
+    '''HTTP/1.1 over TLS, one thread per connection.'''
+
+    daemon_threads = True
+
+    def __init__(self, context):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+
+class HTTP2Server:
+    '''Minimal HTTP/2 over TLS server: every GET is answered with PAYLOAD after
+*delay* seconds. Streams of a connection are answered concurrently, within
+the flow control windows the client grants.'''
+
+    def __init__(self, context, delay=0):
+        self.context = context
+        self.delay = delay
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(64)
+        self.server_address = self.sock.getsockname()
+
+    def serve_forever(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(sock,),
+                             daemon=True).start()
+
+    def shutdown(self):
+        self.sock.close()
+
+    def _serve(self, sock):
+        try:
+            sock = self.context.wrap_socket(sock, server_side=True)
+        except (ssl.SSLError, OSError):
+            return
+        conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False))
+        conn.initiate_connection()
+        lock = threading.Lock()
+        # stream id -> bytes of PAYLOAD left to send, once its delay is over
+        pending = {}
+
+        def flush():
+            # called with the lock held
+            for stream_id, data in list(pending.items()):
+                while data:
+                    window = min(conn.local_flow_control_window(stream_id),
+                                 conn.max_outbound_frame_size)
+                    if window <= 0:
+                        break
+                    conn.send_data(stream_id, data[:window])
+                    data = data[window:]
+                pending[stream_id] = data
+                if not data:
+                    conn.end_stream(stream_id)
+                    del pending[stream_id]
+            sock.sendall(conn.data_to_send())
+
+        def respond(stream_id):
+            time.sleep(self.delay)
+            with lock:
+                conn.send_headers(stream_id, [
+                    (':status', '200'),
+                    ('content-type', 'image/jpeg'),
+                    ('content-length', str(len(PAYLOAD))),
+                ])
+                pending[stream_id] = memoryview(PAYLOAD)
+                flush()
+
+        with lock:
+            sock.sendall(conn.data_to_send())
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    return
+                with lock:
+                    for event in conn.receive_data(data):
+                        if isinstance(event, h2.events.RequestReceived):
+                            threading.Thread(target=respond,
+                                             args=(event.stream_id,),
+                                             daemon=True).start()
+                        elif isinstance(event, h2.events.ConnectionTerminated):
+                            return
+                    flush()
+        except (OSError, h2.exceptions.ProtocolError):
+            pass
+        finally:
+            sock.close()
+
+
+def start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'https://127.0.0.1:{0}'.format(server.server_address[1])
+
+
+def run(transport, url, num_requests, workers):
+    def one(i):
+        return len(transport.get('{0}/page-{1}.jpg'.format(url, i)).content)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        total = sum(pool.map(one, range(num_requests)))
+    return time.perf_counter() - start, total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--delay', type=float, default=0.02,
+                        help='seconds each response is held back')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    cert, key = make_certificate(directory)
+    # both backends trust the throwaway certificate through these
+    os.environ['SSL_CERT_FILE'] = cert
+    os.environ['REQUESTS_CA_BUNDLE'] = cert
+
+    Handler.delay = args.delay
+    servers = [('http/1.1', HTTP1Server(tls_context(cert, key, 'http/1.1')))]
+    if h2 is not None:
+        servers.append(('h2', HTTP2Server(tls_context(cert, key, 'h2'),
+                                          delay=args.delay)))
+    else:
+        print('h2 not installed, no HTTP/2 server')
+    print('{0} requests, {1} workers, {2}s server delay'.format(
+        args.requests, args.workers, args.delay))
+
+    for protocol, server in servers:
+        url = start(server)
+        for name, cls in TRANSPORTS.items():
+            if protocol == 'h2' and name != 'httpx':
+                continue
+            try:
+                transport = cls(user_agent='epaper-bench',
+                                pool_maxsize=args.workers)
+            except ImportError:
+                print('{0:10s} not installed'.format(name))
+                continue
+            try:
+                elapsed, total = run(transport, url, args.requests,
+                                     args.workers)
+            except TransportError as e:
+                print('{0:10s} {1:8s} failed: {2}'.format(name, protocol, e))
+                continue
+            finally:
+                transport.close()
+            print('{0:10s} {1:8s} {2:6.2f}s {3:8.1f} req/s {4:8.1f} MB/s'.format(
+                name, protocol, elapsed, args.requests / elapsed,
+                total / elapsed / 1e6))
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
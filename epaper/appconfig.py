@@ -3,10 +3,107 @@ import logging
 import os
 
 import epaper
+from epaper.utils import atomic_path
 
 # logging
 logger = logging.getLogger('epaper')
 
+# Optional settings added after the first release. Missing keys are filled in
+# when an older config file is loaded, see AppConfig.update_config().
+DEFAULTS = {
+    'App': {
+        # on-disk compression of toc.json/page_metadata.json: zstd, gzip, none
+        'metadata_compression': 'zstd',
+        # storage format of downloaded page images: jpg (as downloaded),
+        # webp or avif; transcoding runs on transcode_workers processes
+        # (0 = one per core)
+        'storage_format': 'jpg',
+        'storage_quality': '80',
+        'transcode_workers': '0',
+        # pack the thumbnails of an edition into one image after download
+        'thumbnail_atlas': 'yes',
+        # reuse lowres/highres images of pages of other editions of the same
+        # day whose thumbnails differ by at most dedupe_threshold bits
+        'dedupe': 'no',
+        'dedupe_threshold': '4',
+        # pack completely downloaded editions into a single <date>.zip
+        'pack_editions': 'no',
+        # extract the text of downloaded page PDFs (needs pypdf) for
+        # `epaper search --text`, on text_workers processes (0 = one per core)
+        'extract_text': 'no',
+        'text_workers': '0',
+        # HH:MM by which downloads should be complete, e.g. 06:30: on slow
+        # links highres images are postponed until after the deadline
+        'deadline': '',
+        # seconds after which a download lease of a dead worker is reclaimed
+        'lease_ttl': '300',
+        # logging, see epaper.logs.setup_logging()
+        'log_level': 'INFO',
+        'log_format': 'text',
+        'log_max_bytes': str(10 * 1024 * 1024),
+        'log_backup_count': '3',
+        'log_sample_rate': '1.0',
+    },
+    'Http': {
+        # 'requests' or 'httpx' (HTTP/2, needs httpx[http2] installed)
+        'transport': 'requests',
+        'pool_connections': '4',
+        'pool_maxsize': '16',
+        'connect_timeout': '10',
+        'read_timeout': '30',
+        # low level retries of connection errors inside the transport, on top
+        # of the retry policies below
+        'max_retries': '0',
+        # retry_<error class> = attempts, base delay, max delay (seconds), with
+        # exponential backoff and full jitter; 429/503 Retry-After is honoured
+        'retry_connect': '3,1,30',
+        'retry_timeout': '3,2,60',
+        'retry_server': '3,2,60',
+        'retry_throttle': '5,5,120',
+        'retry_corrupt': '2,0.5,5',
+        # pause requests to a host for circuit_cooldown seconds (doubling up to
+        # circuit_max_cooldown) after circuit_failures failures in a row; fail
+        # fast after circuit_max_trips pauses without recovery
+        'circuit_failures': '5',
+        'circuit_cooldown': '30',
+        'circuit_max_cooldown': '300',
+        'circuit_max_trips': '3',
+        # parallel page downloads
+        'workers': '4',
+        # edition availability checks: results are reused for probe_ttl seconds
+        'probe_ttl': '600',
+        'probe_workers': '16',
+    },
+    'Server': {
+        # epaper serve: use host 0.0.0.0 to serve display clients on the LAN
+        'host': '127.0.0.1',
+        'port': '8080',
+        'index_interval': '300',
+        # cache rescan interval where inotify is unavailable
+        'watch_interval': '5',
+        # seconds clients may cache page files before revalidating them
+        'max_age': '300',
+    },
+    'Storage': {
+        # where page files go, see epaper.storage: local (cache_dir) or s3, an
+        # S3 compatible bucket (needs boto3); endpoint_url e.g. for MinIO.
+        # Images are streamed to the bucket in part_size MiB parts.
+        'backend': 'local',
+        'bucket': '',
+        'prefix': '',
+        'endpoint_url': '',
+        'region': '',
+        'part_size': '8',
+    },
+    'Selection': {
+        # what to download, see epaper.selection.PageSelection
+        'pages': '',
+        'include': '',
+        'exclude': '',
+        'renditions': 'thumbnail,lowres,highres',
+    },
+}
+
 
 class AppConfig:
     def __init__(self):
@@ -67,6 +164,7 @@ class AppConfig:
                 'selected_pub_code': '',
                 'selected_edition_code': ''
             }
+            self.add_defaults()
             self.save()
         else:
             # update config to match software state if loaded from
@@ -97,8 +195,18 @@ class AppConfig:
         '''Validate and save config to config_file.'''
         self.validate_config()
         if self.valid:
-            with open(self.config_file, 'w') as fd:
-                self.config.write(fd)
+            # several epaper processes may start at the same time
+            with atomic_path(self.config_file) as temp:
+                with open(temp, 'w') as fd:
+                    self.config.write(fd)
+
+    def add_defaults(self):
+        '''Add optional settings from DEFAULTS that are not configured yet.'''
+        for section, values in DEFAULTS.items():
+            if section not in self.config:
+                self.config[section] = {}
+            for key, value in values.items():
+                self.config[section].setdefault(key, value)
 
     def update_config(self):
         '''Update saved config for newer values of certain configuration variables.'''
@@ -107,5 +215,7 @@ class AppConfig:
         # update user_agent
         self.config['Http']['user_agent'] = self.config['App']['app_name'] + '/' + \
             self.config['App']['app_version']
+        # add settings missing from older config files
+        self.add_defaults()
         # save config
         self.save()
@@ -0,0 +1,146 @@
+from io import BytesIO
+import logging
+import mmap
+import os
+import shutil
+import struct
+import zipfile
+
+from epaper.transcode import STORAGE_FORMATS
+from epaper.utils import atomic_path, decode_json
+
+# logging
+logger = logging.getLogger('archive')
+
+# local file header: signature ... file name length, extra field length
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+
+def archive_path(download_path):
+    '''Return the archive filename of an edition: <date>.zip next to where its
+directory would be.'''
+    return download_path.rstrip(os.sep) + '.zip'
+
+
+def pack_edition(download_path):
+    '''Pack the files of an edition directory into an uncompressed (stored) ZIP
+archive and remove the directory. Dot files (leases, partial downloads) are
+left out. Return the archive filename.'''
+    filename = archive_path(download_path)
+    names = sorted(name for name in os.listdir(download_path)
+                   if not name.startswith('.') and
+                   os.path.isfile(os.path.join(download_path, name)))
+    with atomic_path(filename) as temp:
+        with zipfile.ZipFile(temp, 'w', compression=zipfile.ZIP_STORED) as zf:
+            for name in names:
+                zf.write(os.path.join(download_path, name), name)
+        with zipfile.ZipFile(temp) as zf:
+            bad = zf.testzip()
+            if bad is not None:
+                raise IOError('{0}: bad CRC for {1}'.format(filename, bad))
+    shutil.rmtree(download_path)
+    return filename
+
+
+def unpack_edition(download_path):
+    '''Extract an edition archive back into its directory, e.g. to download
+more pages of it, and remove the archive.'''
+    filename = archive_path(download_path)
+    os.makedirs(download_path, exist_ok=True)
+    with zipfile.ZipFile(filename) as zf:
+        zf.extractall(download_path)
+    os.remove(filename)
+    logger.info('unpacked {0}'.format(filename))
+
+
+class EditionArchive:
+    '''Random access to the files of a packed edition. Member offsets are read
+once from the central directory; reads are slices of a read-only mmap of the
+archive, so nothing is extracted.'''
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.mtime = os.stat(filename).st_mtime
+        # name: (offset of the member data, size)
+        self.members = {}
+        self._mmap = None
+        try:
+            with open(filename, 'rb') as fd:
+                self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                infos = zipfile.ZipFile(fd).infolist()
+            for info in infos:
+                if info.compress_type != zipfile.ZIP_STORED:
+                    logger.warning('{0}: {1} is compressed, skipped'.format(
+                        filename, info.filename))
+                    continue
+                header = LOCAL_HEADER.unpack_from(self._mmap, info.header_offset)
+                offset = info.header_offset + LOCAL_HEADER.size + \
+                    header[-2] + header[-1]
+                self.members[info.filename] = (offset, info.file_size)
+        except (zipfile.BadZipFile, struct.error, ValueError) as e:
+            # truncated or corrupt; ValueError: an empty file cannot be mapped
+            self.close()
+            raise IOError('{0}: unreadable archive: {1}'.format(filename, e))
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def locate(self, name):
+        '''Return (offset, size) of member *name* in the archive file, or None.'''
+        return self.members.get(name)
+
+    def read(self, name):
+        '''Return the content of member *name*.'''
+        offset, size = self.members[name]
+        return self._mmap[offset:offset + size]
+
+    def find_json(self, name):
+        '''Return the member name of JSON document *name* (e.g. toc.json), trying
+the compressed variants first, or None.'''
+        for suffix in ('.zst', '.gz', ''):
+            if name + suffix in self.members:
+                return name + suffix
+        return None
+
+    def read_json(self, name):
+        member = self.find_json(name)
+        if member is None:
+            raise FileNotFoundError('{0}: {1}'.format(self.filename, name))
+        return decode_json(self.read(member), member)
+
+    def resolve_image(self, name):
+        '''Like transcode.resolve_image() for member names.'''
+        if name in self.members:
+            return name
+        stem, ext = os.path.splitext(name)
+        extensions = [extension for extension, _ in STORAGE_FORMATS.values()]
+        if ext not in extensions:
+            return None
+        for extension in extensions:
+            if stem + extension in self.members:
+                return stem + extension
+        return None
+
+    def open(self, name):
+        '''Return member *name* as a file object.'''
+        return BytesIO(self.read(name))
+
+
+def verify_archive(filename):
+    '''Check the CRC of every member of an edition archive. Return the names of
+bad members; IOError if the archive cannot be read at all.'''
+    bad = []
+    try:
+        zf = zipfile.ZipFile(filename)
+    except zipfile.BadZipFile as e:
+        raise IOError('{0}: unreadable archive: {1}'.format(filename, e))
+    with zf:
+        for info in zf.infolist():
+            try:
+                with zf.open(info) as fd:
+                    while fd.read(1024 * 1024):
+                        pass
+            except zipfile.BadZipFile:
+                bad.append(info.filename)
+    return bad
@@ -0,0 +1,116 @@
+from PIL import Image
+import logging
+import math
+import os
+
+from epaper.transcode import STORAGE_FORMATS
+from epaper.utils import atomic_path, find_json, read_json, write_json
+
+# logging
+logger = logging.getLogger('atlas')
+
+# atlas image thumbnails.<ext> and its offset index thumbnails.json
+ATLAS_NAME = 'thumbnails'
+
+
+def atlas_paths(download_path):
+    '''Return (image filename or None, index filename) of an edition's atlas.'''
+    stem = os.path.join(download_path, ATLAS_NAME)
+    for extension, _ in STORAGE_FORMATS.values():
+        if os.path.exists(stem + extension):
+            return stem + extension, stem + '.json'
+    return None, stem + '.json'
+
+
+def build_atlas(download_path, thumbnails, storage_format='jpg', quality=80,
+                compression='zstd'):
+    '''Pack page thumbnails {page number: filename} into a single atlas image in
+*download_path*, rows of ceil(sqrt(n)) pages each as high as their tallest
+thumbnail, plus an index of {page number: [left, upper, right, lower]} boxes.
+Return the atlas filename, or None if there were no readable thumbnails.'''
+    images = {}
+    for number, filename in sorted(thumbnails.items()):
+        try:
+            with Image.open(filename) as image:
+                images[number] = image.convert('RGB')
+        except (IOError, OSError) as e:
+            logger.error('could not read {0}: {1}'.format(filename, e))
+    if not images:
+        return None
+
+    columns = int(math.ceil(math.sqrt(len(images))))
+    numbers = sorted(images)
+    boxes, width, height = {}, 0, 0
+    for row in range(0, len(numbers), columns):
+        x = 0
+        for number in numbers[row:row + columns]:
+            w, h = images[number].size
+            boxes[number] = [x, height, x + w, height + h]
+            x += w
+        width = max(width, x)
+        height += max(images[n].size[1] for n in numbers[row:row + columns])
+
+    atlas = Image.new('RGB', (width, height), 'white')
+    for number, box in boxes.items():
+        atlas.paste(images[number], tuple(box[:2]))
+
+    extension, pil_format = STORAGE_FORMATS[storage_format]
+    filename = os.path.join(download_path, ATLAS_NAME + extension)
+    with atomic_path(filename) as temp:
+        atlas.save(temp, format=pil_format, quality=quality)
+    # an atlas in the previous storage format is stale now
+    for other, _ in STORAGE_FORMATS.values():
+        stale = os.path.join(download_path, ATLAS_NAME + other)
+        if other != extension and os.path.exists(stale):
+            os.remove(stale)
+    write_json(os.path.join(download_path, ATLAS_NAME + '.json'),
+               {'size': [width, height],
+                'pages': dict((str(n), box) for n, box in boxes.items())},
+               compression=compression)
+    return filename
+
+
+class ThumbnailAtlas:
+    '''A decoded atlas image and its index. Page thumbnails are crops of the one
+image, so showing a whole edition costs a single file open and decode.'''
+
+    def __init__(self, download_path=None, archive=None):
+        '''Load the atlas of the edition in *download_path*, or from its
+EditionArchive *archive* if the edition is packed.'''
+        self.filename, index_filename = atlas_paths(download_path)
+        if self.filename is None and archive is not None:
+            name = archive.resolve_image(ATLAS_NAME + '.jpg')
+            if name and archive.find_json(ATLAS_NAME + '.json'):
+                self.filename = os.path.join(download_path, name)
+                self._disk_file = archive.filename
+                index = archive.read_json(ATLAS_NAME + '.json')
+                source = archive.open(name)
+        elif self.filename is not None and find_json(index_filename):
+            self._disk_file = self.filename
+            index = read_json(index_filename)
+            source = self.filename
+        else:
+            self.filename = None
+        if self.filename is None:
+            raise FileNotFoundError(
+                'no thumbnail atlas in {0}'.format(download_path))
+        self.mtime = os.stat(self._disk_file).st_mtime
+        self.boxes = dict((int(n), tuple(box))
+                          for n, box in index['pages'].items())
+        with Image.open(source) as image:
+            image.load()
+            self.image = image
+
+    def is_stale(self):
+        '''True if the atlas was rebuilt or removed since it was loaded.'''
+        try:
+            return os.stat(self._disk_file).st_mtime != self.mtime
+        except FileNotFoundError:
+            return True
+
+    def thumbnail(self, page_number):
+        '''Return the thumbnail of *page_number* as a new image, or None.'''
+        box = self.boxes.get(page_number)
+        if box is None:
+            return None
+        return self.image.crop(box)
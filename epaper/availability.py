@@ -0,0 +1,111 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import logging
+import os
+import threading
+import time
+
+from epaper.utils import find_json, read_json, write_json
+
+# logging
+logger = logging.getLogger('availability')
+
+
+def candidate_dates(days=7):
+    '''Return YYYYMMDD strings for today and the *days* days before, newest
+first.'''
+    today = datetime.today().date()
+    return [(today - timedelta(i)).strftime('%Y%m%d') for i in range(days + 1)]
+
+
+class AvailabilityProber:
+    '''Find out which editions exist on which dates before offering them, with
+one HEAD request for toc.json per (edition, date), all sent concurrently.
+Results are cached for *ttl* seconds in memory and in cache_dir/availability.json,
+shared by subsequent runs.
+
+A failed request means unknown and counts as available, so a flaky network
+does not hide editions; only a definite "not found" does.
+
+    '''
+
+    def __init__(self, scraper=None, cache_dir=None, ttl=600, workers=16,
+                 compression='zstd'):
+        self.scraper = scraper
+        self.ttl = ttl
+        self.workers = max(1, workers)
+        self.compression = compression
+        self.path = os.path.join(cache_dir, 'availability.json')
+        self._lock = threading.Lock()
+        # "pub/edition/date": [available (True, False or None), checked at]
+        self.cache = read_json(self.path) if find_json(self.path) else {}
+
+    @classmethod
+    def from_config(cls, scraper, app_config):
+        http = app_config.config['Http']
+        return cls(
+            scraper=scraper,
+            cache_dir=app_config.config['App']['cache_dir'],
+            ttl=http.getint('probe_ttl', 600),
+            workers=http.getint('probe_workers', 16),
+            compression=app_config.config['App'].get(
+                'metadata_compression', 'zstd')
+        )
+
+    def _check(self, pub_code, edition_code, date_str):
+        url = self.scraper.build_toc_url(
+            pub_code=pub_code, edition_code=edition_code, date_str=date_str)
+        return self.scraper.exists(url)
+
+    def probe(self, pub_code, edition_codes, dates):
+        '''Return {(edition_code, date_str): True, False or None (unknown)} for all
+combinations, probing those not cached or cached longer than ttl ago.'''
+        now = time.time()
+        results, missing = {}, []
+        with self._lock:
+            for edition_code in edition_codes:
+                for date_str in dates:
+                    key = '/'.join((pub_code, edition_code, date_str))
+                    entry = self.cache.get(key)
+                    if entry is not None and now - entry[1] < self.ttl:
+                        results[(edition_code, date_str)] = entry[0]
+                    else:
+                        missing.append((edition_code, date_str))
+        if not missing:
+            return results
+
+        with ThreadPoolExecutor(
+                max_workers=min(self.workers, len(missing))) as pool:
+            found = list(pool.map(
+                lambda job: self._check(pub_code, *job), missing))
+        with self._lock:
+            for (edition_code, date_str), available in zip(missing, found):
+                results[(edition_code, date_str)] = available
+                if available is not None:
+                    self.cache['/'.join((pub_code, edition_code, date_str))] = \
+                        [available, now]
+            # expired entries of any edition are dropped
+            self.cache = dict((k, v) for k, v in self.cache.items()
+                              if now - v[1] < self.ttl)
+            try:
+                write_json(self.path, self.cache, compression=self.compression)
+            except OSError as e:
+                logger.error('could not save {0}: {1}'.format(self.path, e))
+        return results
+
+    def available_dates(self, pub_code, edition_code, dates=None):
+        '''Return those of *dates* (YYYYMMDD strings, default candidate_dates())
+with an edition, in the given order.'''
+        dates = dates or candidate_dates()
+        results = self.probe(pub_code, [edition_code], dates)
+        return [date_str for date_str in dates
+                if results[(edition_code, date_str)] is not False]
+
+    def available_editions(self, pub_code, edition_codes, dates=None):
+        '''Return {edition_code: available dates} for several editions at once.'''
+        dates = dates or candidate_dates()
+        results = self.probe(pub_code, edition_codes, dates)
+        return dict(
+            (edition_code, [date_str for date_str in dates
+                            if results[(edition_code, date_str)] is not False])
+            for edition_code in edition_codes)
@@ -1,13 +1,22 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from epaper.appconfig import AppConfig
+from epaper.availability import AvailabilityProber, candidate_dates
+from epaper.downloader import DownloadError, Downloader
 from epaper.epaper import EPaper
+from epaper.manifest import verify_editions
+from epaper.logs import setup_logging
+from epaper.pdftext import TextExtractor
+from epaper.scheduler import parse_deadline
 from epaper.scraper import Scraper
+from epaper.selection import PageSelection
+from epaper.server import CacheServer
+from epaper.sync import EditionSync
 from epaper.ui import UI
 import click
 import epaper
-import json
 import logging
 import os
+import re
 
 logger = logging.getLogger('cli')
 
@@ -16,22 +25,23 @@ def doit(interactive=True,
          publication_code=None,
          edition_code=None,
          date=None,
-         from_config=False):  # noqa: we know this function is complex
+         from_config=False,
+         selection=None,
+         deadline=None):  # noqa: we know this function is complex
     '''Main Execution Module'''
     # Load app configuration: app-specific configuration management
     app_config = AppConfig()
 
     # setup logging
-    logging.basicConfig(
-        filename=app_config.config['App']['log_file'],
-        filemode='w',
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.DEBUG
-    )
+    setup_logging(app_config)
 
     # choose a default publisher -- as of now this is the only one.
     publisher = 'TOI'
 
+    # pages and renditions to download
+    if selection is None:
+        selection = PageSelection.from_config(app_config)
+
     # Scraper instance: scraper functions
     scraper = Scraper(publisher=publisher, app_config=app_config)
 
@@ -116,166 +126,110 @@ def doit(interactive=True,
     # Pick a date, if we are in interactive mode, else it defaults to todays date.
     # XXX: date may not be required for some editions...
     if interactive:
-        epaper.selected_date = ui.select_pub_date()
+        # only offer dates that have this edition
+        prober = AvailabilityProber.from_config(scraper, app_config)
+        epaper.selected_date = ui.select_pub_date(
+            available_dates=prober.available_dates(
+                epaper.selected_publication[1], epaper.selected_edition[1],
+                epaper.available_dates))
     elif isinstance(date, type('')):
         epaper.selected_date = datetime.strptime(date, '%Y-%m-%d')
 
-    # $HOME/cache_dir/pub/edition/date
-    epaper.create_download_dir()
-
-    # inform ui
-    ui.download_path = epaper.download_path
-
-    logger.info('Downloading epaper...')
-    logger.info('pub_code={0}, edition={1}, date={2}'.format(
-        epaper.selected_publication[1],
-        epaper.selected_edition[1],
-        str(epaper.selected_date.date())
-    ))
+    def progress(update):
+        if update.stage != 'done':
+            ui.update_status(message=update.message, end='', flush=True)
 
-    date_str = '{year:04d}{month:02d}{day:02d}'.format(
-        year=epaper.selected_date.year,
-        month=epaper.selected_date.month,
-        day=epaper.selected_date.day
-    )
-
-    toc_url = scraper.build_toc_url(
+    downloader = Downloader(
         pub_code=epaper.selected_publication[1],
         edition_code=epaper.selected_edition[1],
-        date_str=date_str
+        date=epaper.selected_date,
+        selection=selection,
+        app_config=app_config,
+        publisher=publisher,
+        scraper=scraper,
+        epaper=epaper,
+        on_progress=progress,
+        deadline=deadline
     )
-
-    epaper.toc_dict = scraper.fetch(toc_url)
-
-    # check for valid dict format.
-    if epaper.toc_dict is None:
-        logger.error('Table of contents could not be retrieved! exiting...')
-        return False
-
-    if 'toc' not in epaper.toc_dict:
-        logger.error('TOC JSON format error! exiting...')
+    try:
+        report = downloader.run()
+    except DownloadError as e:
+        logger.error('{0} exiting...'.format(e))
         return False
 
-    # save the toc to default download location
-    toc_file = os.path.join(epaper.download_path, 'toc.json')
-    with open(toc_file, 'w') as toc:
-        toc.write(json.dumps(epaper.toc_dict))
-
-    epaper.num_pages = len(epaper.toc_dict['toc'])
-
-    # build the epaper.pages list of epaper.Page structures
-    for i, page in enumerate(epaper.toc_dict['toc']):
-        ui.update_status(
-            message='Retrieving page {0} metadata'.format(i),
-            end='',
-            flush=True
-        )
-
-        urls = scraper.build_page_urls(
-            pub_code=epaper.selected_publication[1],
-            edition_code=epaper.selected_edition[1],
-            date_str=date_str,
-            page_folder=page['page_folder']
-        )
-
-        urls['thumbnail'][1] = os.path.join(
-            epaper.download_path, 'page-{0:03d}-thumbnail.jpg'.format(int(page['page'])))
-        urls['lowres'][1] = os.path.join(
-            epaper.download_path, 'page-{0:03d}-lowres.jpg'.format(int(page['page'])))
-        urls['highres'][1] = os.path.join(
-            epaper.download_path, 'page-{0:03d}-highres.jpg'.format(int(page['page'])))
-        urls['pdf'][1] = os.path.join(
-            epaper.download_path, 'page-{0:03d}-highres.pdf'.format(int(page['page'])))
-
-        epaper.pages.append(
-            epaper.Page(
-                number=int(page['page']),
-                title=page['page_title'],
-                urls=urls
-            )
-        )
-
-    # download required pages
-    ui.update_status(
-        message='Downloading pages...',
-        end='',
-        flush=True
-    )
-    for i, page in enumerate(epaper.pages):
-        page_downloads = 0
-        for j, url_key in enumerate(page.urls):
-            url = page.urls[url_key][0]
-            filename = page.urls[url_key][1]
-            file_exists = page.urls[url_key][2]
-
-            if file_exists:
-                continue
-
-            if url_key == 'pdf':
-                continue
-
-            status, count = scraper.save_image(url, filename, delay=False)
-            if status:
-                page_downloads += 1
-                # update file_exists flag in epaper.pages
-                if os.path.exists(filename):
-                    epaper.pages[i].urls[url_key][2] = True
-        # track
-        if page_downloads >= 2:
-            # successful download and save of thumbnail and at least one of
-            # low or highres images.
-            ui.num_downloads += 1
-            ui.update_status(
-                message='Downloaded page {}'.format(page.number),
-                end='',
-                flush=True
-            )
-        else:
-            # note failed attempts
-            ui.failed.append(page.number)
-            ui.update_status(
-                message='Failed to downloaded page {}'.format(page.number),
-                end='',
-                flush=True
-            )
-
     # final counts
+    ui.download_path = report.download_path
+    ui.num_downloads = report.downloaded
+    ui.failed = report.failed
     ui.update_status(message='Downloaded {0} pages.'.format(ui.num_downloads))
     if len(ui.failed) > 0:
         ui.update_status(message='Failed to download {0} pages: {1}'.format(
             len(ui.failed), repr(ui.failed)))
 
-    # save page metadata as json, so UI tools can read it.
-    epaper.save_page_metadata()
-
     # notify
     ui.notify(
         publication=epaper.selected_publication[0],
         edition=epaper.selected_edition[0]
     )
 
+    # the edition is ready, now fetch what was postponed for the deadline
+    if report.postponed:
+        ui.update_status(message='Upgrading pages {0}...'.format(
+            repr(report.postponed)))
+        results = downloader.upgrade()
+        ui.update_status(message='Upgraded {0} images.'.format(
+            len([r for r in results if r.ok])))
+
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 
-@click.command(context_settings=CONTEXT_SETTINGS)
+@click.group(context_settings=CONTEXT_SETTINGS, invoke_without_command=True)
 @click.option('--publication_code', default='', help='Publication code as on SITE_ARCHIVE')
 @click.option('--edition_code', default='', help='Edition code as on SITE_ARCHIVE')
 @click.option('--date', default=str(datetime.now().date()), help='Edition date, default is todays date.')
 @click.option('--from-config', is_flag=True, help='Use publication and edition codes from default config file.')
+@click.option('--pages', default=None, help='Page ranges to download, e.g. 1-12,15.')
+@click.option('--include', default=None, help='Only download pages whose title matches this regex.')
+@click.option('--exclude', default=None, help='Skip pages whose title matches this regex, e.g. Classifieds.')
+@click.option('--renditions', default=None, help='Comma separated subset of thumbnail,lowres,highres,pdf.')
+@click.option('--deadline', default=None, help='HH:MM by which the edition must be downloaded; postpones highres images on slow links.')
 @click.option('--verbose', is_flag=True, help='Be more verbose on STDOUT.')
 @click.option('--version', is_flag=True, help='Print version.')
-def main(publication_code,
+@click.pass_context
+def main(ctx,
+         publication_code,
          edition_code,
          date,
          from_config,
+         pages,
+         include,
+         exclude,
+         renditions,
+         deadline,
          verbose,
          version):
     '''EPaper Command Line Interface.'''
 
-    if version:
+    if ctx.invoked_subcommand is not None:
+        return
+    elif version:
         click.echo('EPaper version {0}'.format(epaper.__version__))
-    elif publication_code and \
+        return
+
+    try:
+        selection = PageSelection.from_config(
+            AppConfig(), pages=pages, include=include, exclude=exclude,
+            renditions=renditions)
+    except (ValueError, re.error) as e:
+        raise click.BadParameter(str(e))
+    if deadline:
+        try:
+            parse_deadline(deadline)
+        except ValueError:
+            raise click.BadParameter('deadline must be HH:MM: {0}'.format(deadline))
+
+    if publication_code and \
             edition_code and \
             date:
         if verbose:
@@ -284,15 +238,237 @@ def main(publication_code,
                     publication_code=publication_code,
                     edition_code=edition_code,
                     date=date,
-                    from_config=False)
+                    from_config=False,
+                    selection=selection,
+                    deadline=deadline)
     elif from_config:
         if verbose:
             click.echo('Using configured settings.')
-        return doit(interactive=False, from_config=True)
+        return doit(interactive=False, from_config=True, selection=selection,
+                    deadline=deadline)
     else:
         if verbose:
             click.echo('Using interactive mode.')
-        return doit(interactive=True, from_config=False)
+        return doit(interactive=True, from_config=False, selection=selection,
+                    deadline=deadline)
+
+
+@main.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('query')
+@click.option('--publication_code', default=None, help='Limit to publication code.')
+@click.option('--edition_code', default=None, help='Limit to edition code.')
+@click.option('--limit', default=50, help='Maximum number of hits.')
+@click.option('--reindex', is_flag=True, help='First index cached editions missing from the index.')
+@click.option('--text', is_flag=True, help='Search the text of pages extracted with `epaper text`.')
+def search(query, publication_code, edition_code, limit, reindex, text):
+    '''Search page titles of downloaded editions.'''
+    app_config = AppConfig()
+    epaper = EPaper(publisher='TOI', app_config=app_config)
+    if reindex:
+        click.echo('Indexed {0} editions.'.format(epaper.update_search_index()))
+    for hit in epaper.search(query, pub_code=publication_code,
+                             edition_code=edition_code, limit=limit, text=text):
+        click.echo('{0} {1} {2} page {3:3d}: {4}'.format(
+            hit.pub_code, hit.edition_code, hit.date, hit.page, hit.title))
+
+
+@main.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--publication_code', default=None, help='Publication code, default from config.')
+@click.option('--edition_code', default=None, help='Edition code, default from config.')
+@click.option('--all-editions', is_flag=True, help='Check every edition of the publication.')
+@click.option('--days', default=7, help='Number of days back from today to check.')
+def dates(publication_code, edition_code, all_editions, days):
+    '''List the recent dates on which editions are available.'''
+    app_config = AppConfig()
+    setup_logging(app_config)
+    publisher = 'TOI'
+    config = app_config.config[publisher]
+    scraper = Scraper(publisher=publisher, app_config=app_config)
+    pub_code = publication_code or config.get('selected_pub_code', '')
+    if all_editions:
+        doc = scraper.fetch(scraper.site_archive_edition_url.format(
+            pub_code=pub_code))
+        if not doc:
+            raise click.ClickException('Could not obtain edition codes.')
+        edition_codes = sorted(scraper.parse_edition_codes(doc).values())
+    else:
+        edition_codes = [edition_code or config.get('selected_edition_code', '')]
+    if not pub_code or not all(edition_codes):
+        raise click.UsageError('No publication and edition code given or configured.')
+
+    prober = AvailabilityProber.from_config(scraper, app_config)
+    available = prober.available_editions(pub_code, edition_codes,
+                                          candidate_dates(days))
+    for code in edition_codes:
+        click.echo('{0} {1}: {2}'.format(pub_code, code, ' '.join(
+            datetime.strptime(d, '%Y%m%d').strftime('%Y-%m-%d')
+            for d in available[code]) or 'none'))
+
+
+@main.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--host', default=None, help='Address to listen on, default from [Server] config.')
+@click.option('--port', default=None, type=int, help='Port to listen on, default from [Server] config.')
+def serve(host, port):
+    '''Serve the download cache to display clients over HTTP.'''
+    app_config = AppConfig()
+    setup_logging(app_config)
+    config = app_config.config['Server']
+    server = CacheServer(
+        publisher='TOI',
+        app_config=app_config,
+        host=host or config.get('host', '127.0.0.1'),
+        port=port or config.getint('port', 8080),
+        index_interval=config.getint('index_interval', 300),
+        watch_interval=config.getint('watch_interval', 5),
+        max_age=config.getint('max_age', 300)
+    )
+    click.echo('Serving {0} on http://{1}:{2}/index.json'.format(
+        server.cache_dir, server.host, server.port))
+    server.run()
+
+
+@main.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--publication_code', default=None, help='Publication code, default from config.')
+@click.option('--edition_code', default=None, help='Edition code, default from config.')
+@click.option('--date', default=str(datetime.now().date()), help='Edition date, default is todays date.')
+def sync(publication_code, edition_code, date):
+    '''Re-download only the pages of an edition that changed since download.'''
+    app_config = AppConfig()
+    setup_logging(app_config)
+    publisher = 'TOI'
+    config = app_config.config[publisher]
+    epaper = EPaper(publisher=publisher, app_config=app_config)
+    epaper.selected_publication = ('', publication_code or config.get('selected_pub_code', ''))
+    epaper.selected_edition = ('', edition_code or config.get('selected_edition_code', ''))
+    epaper.selected_date = datetime.strptime(date, '%Y-%m-%d')
+    epaper.create_download_dir()
+    if not epaper.download_path:
+        raise click.UsageError('No publication and edition code given or configured.')
+
+    report = EditionSync(
+        epaper=epaper,
+        scraper=Scraper(publisher=publisher, app_config=app_config),
+        selection=PageSelection.from_config(app_config),
+        workers=app_config.config['Http'].getint('workers', 4)
+    ).run()
+    if report is None:
+        click.echo('Table of contents could not be retrieved.')
+        return False
+    click.echo('{0} pages unchanged, {1} added, {2} removed, {3} changed.'.format(
+        report.unchanged, len(report.added), len(report.removed), len(report.changed)))
+    for number in report.added:
+        click.echo('  page {0}: added'.format(number))
+    for number in report.removed:
+        click.echo('  page {0}: removed'.format(number))
+    for number, reasons in sorted(report.changed.items()):
+        click.echo('  page {0}: {1}'.format(number, ', '.join(reasons)))
+    click.echo('Downloaded {0} files.'.format(report.downloaded))
+    if report.failed:
+        click.echo('Failed to download pages: {0}'.format(repr(report.failed)))
+    elif app_config.config['App'].getboolean('pack_editions', False):
+        epaper.pack_pub(epaper.selected_publication[1],
+                        epaper.selected_edition[1], date)
+
+
+@main.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--full', is_flag=True, help='Hash every file instead of trusting unchanged size and mtime.')
+@click.option('--workers', default=0, help='Worker processes, default one per core.')
+@click.option('--redownload', is_flag=True, help='Then download editions with queued corrupt files again.')
+def verify(full, workers, redownload):
+    '''Verify cached files against their checksum manifests.'''
+    app_config = AppConfig()
+    setup_logging(app_config)
+    epaper = EPaper(publisher='TOI', app_config=app_config)
+    cache_dir = app_config.config['App']['cache_dir']
+    download_paths = [os.path.join(cache_dir, *pub)
+                      for pub in epaper.find_on_disk_pubs()]
+    num_bad = 0
+    for download_path, bad in verify_editions(
+            download_paths, full=full, workers=workers,
+            compression=epaper.metadata_compression):
+        if bad:
+            num_bad += len(bad)
+            click.echo('{0}: {1}'.format(download_path, ', '.join(bad)))
+            epaper.queue_redownload(download_path, bad)
+    click.echo('Verified {0} editions, {1} corrupt files queued for re-download.'.format(
+        len(download_paths), num_bad))
+    if redownload:
+        for key in sorted(epaper.redownload_queue()):
+            pub_code, edition_code, date_str = key.split('/')
+            click.echo('Downloading {0}'.format(key))
+            doit(interactive=False,
+                 publication_code=pub_code,
+                 edition_code=edition_code,
+                 date=date_str)
+
+
+@main.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--days', default=1, help='Only pack editions at least this many days old.')
+def pack(days):
+    '''Pack completely downloaded editions into single archive files.'''
+    app_config = AppConfig()
+    setup_logging(app_config)
+    epaper = EPaper(publisher='TOI', app_config=app_config)
+    cache_dir = app_config.config['App']['cache_dir']
+    cutoff = str(datetime.now().date() - timedelta(days))
+    packed = 0
+    for pub in sorted(epaper.find_on_disk_pubs()):
+        if pub[2] > cutoff or not os.path.isdir(os.path.join(cache_dir, *pub)):
+            continue
+        if epaper.pack_pub(*pub):
+            click.echo('Packed {0}'.format('/'.join(pub)))
+            packed += 1
+    click.echo('Packed {0} editions.'.format(packed))
+
+
+@main.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--publication_code', default=None, help='Only editions of this publication code.')
+@click.option('--edition_code', default=None, help='Only editions of this edition code.')
+@click.option('--date', default=None, help='Only editions of this date, default all cached dates.')
+@click.option('--download', is_flag=True, help='First download missing page PDFs.')
+@click.option('--workers', default=0, help='Worker processes, default from [App] text_workers.')
+def text(publication_code, edition_code, date, download, workers):
+    '''Extract the text of page PDFs of cached editions for `search --text`.'''
+    app_config = AppConfig()
+    setup_logging(app_config)
+    epaper = EPaper(publisher='TOI', app_config=app_config)
+    cache_dir = app_config.config['App']['cache_dir']
+    try:
+        extractor = TextExtractor.from_config(app_config,
+                                              search_index=epaper.search_index)
+    except ImportError as e:
+        raise click.ClickException('{0}, pip install epaper[text]'.format(e))
+    if workers:
+        extractor.workers = workers
+    keys = [pub for pub in sorted(epaper.find_on_disk_pubs())
+            if (not publication_code or pub[0] == publication_code) and
+            (not edition_code or pub[1] == edition_code) and
+            (not date or pub[2] == date) and
+            os.path.isdir(os.path.join(cache_dir, *pub))]
+    if download:
+        for pub_code, edition_code_, date_str in keys:
+            click.echo('Downloading PDFs of {0}'.format(
+                '/'.join((pub_code, edition_code_, date_str))))
+            try:
+                Downloader(
+                    pub_code=pub_code,
+                    edition_code=edition_code_,
+                    date=date_str,
+                    selection=PageSelection.from_config(app_config,
+                                                        renditions='pdf'),
+                    app_config=app_config,
+                    epaper=epaper
+                ).run()
+            except DownloadError as e:
+                click.echo(str(e))
+    extracted = failed = 0
+    for key, page, ok in extractor.run(keys):
+        if ok:
+            extracted += 1
+        else:
+            failed += 1
+    click.echo('Extracted text of {0} pages of {1} editions, {2} failed.'.format(
+        extracted, len(keys), failed))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,625 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import asyncio
+import logging
+import os
+import queue
+import shutil
+import threading
+
+from epaper.appconfig import AppConfig
+from epaper.epaper import EPaper
+from epaper.lease import LeaseManager
+from epaper.logs import log_event
+from epaper.manifest import Manifest
+from epaper.pdftext import TextExtractor
+from epaper.phash import DEDUPE_RENDITIONS, PHashIndex, dhash
+from epaper.scheduler import DownloadScheduler, Job, parse_deadline
+from epaper.scraper import Scraper
+from epaper.selection import PageSelection
+from epaper.storage import file_key
+from epaper.transcode import resolve_image
+
+# logging
+logger = logging.getLogger('downloader')
+
+# one finished (page, rendition) download, yielded by Downloader; filename is
+# a storage key when downloading to an object store
+PageResult = namedtuple('PageResult', ['page', 'rendition', 'ok', 'filename'])
+
+# progress callback argument: stage is one of metadata, download, tier, text,
+# upgrade, done
+Progress = namedtuple('Progress', ['stage', 'done', 'total', 'message'])
+
+# outcome of a download: pages with enough renditions, page numbers that failed,
+# page numbers with renditions postponed to meet the deadline (see upgrade())
+DownloadReport = namedtuple('DownloadReport', [
+    'downloaded', 'failed', 'cancelled', 'download_path', 'postponed'])
+
+# bytes of a rendition assumed until a HEAD request or download tells
+DEFAULT_SIZES = {
+    'thumbnail': 20 * 1024,
+    'lowres': 250 * 1024,
+    'highres': 1024 * 1024,
+    'pdf': 1024 * 1024,
+}
+
+# renditions whose size is sampled with HEAD requests before a deadline run
+SIZE_SAMPLES = 3
+
+# marks the end of the results queue
+_DONE = object()
+
+
+class DownloadError(Exception):
+    '''The edition could not be downloaded at all, e.g. its table of contents
+could not be retrieved.'''
+
+
+class Downloader:
+    '''Download one edition, without any user interaction.
+
+    downloader = Downloader(pub_code='TOI', edition_code='BOM',
+                            date='2024-01-02', on_progress=print)
+    for result in downloader:          # or: async for result in downloader
+        ...                            # a PageResult per finished download
+    report = downloader.report
+
+Pages and renditions come from *selection* (default from the config). Downloads
+run on a DownloadScheduler in a background thread; iterating yields a PageResult
+as each one finishes. cancel() stops a download: pending jobs are dropped, the
+running ones finish. *on_progress* is called with Progress tuples.
+
+A prepared *epaper* may be passed in (e.g. one a viewer shows, so select_page()
+bumps pages on display); its selected publication and edition labels are kept.
+
+With a *deadline* ("HH:MM" or epoch seconds, default [App] deadline) the edition
+is planned to be complete by then: if the measured throughput is too low for
+the remaining bytes, estimated from Content-Length, highres (then lowres)
+images of pending pages are postponed. upgrade() downloads them afterwards.
+
+Page files go to *storage* (default from the [Storage] config, see
+epaper.storage). With an object store they are streamed from the response into
+the bucket and never touch the local disk; only the edition metadata is kept in
+cache_dir and copied to the bucket. Post-processing that needs the files on disk
+(deduplication, transcoding, thumbnail atlas, text extraction, packing) is
+skipped then.
+
+    '''
+
+    def __init__(self, pub_code=None, edition_code=None, date=None,
+                 selection=None, app_config=None, publisher='TOI',
+                 scraper=None, epaper=None, on_progress=None, storage=None,
+                 deadline=None):
+        self.app_config = app_config or AppConfig()
+        self.publisher = publisher
+        self.selection = selection or PageSelection.from_config(self.app_config)
+        self.scraper = scraper or Scraper(publisher=publisher,
+                                          app_config=self.app_config)
+        self.epaper = epaper or EPaper(publisher=publisher,
+                                       app_config=self.app_config)
+        self.pub_code = pub_code
+        self.edition_code = edition_code
+        if isinstance(date, str):
+            date = datetime.strptime(date, '%Y-%m-%d')
+        self.date = date or datetime.today()
+        self.on_progress = on_progress
+        self.storage = storage or self.epaper.storage
+        if deadline is None:
+            deadline = self.app_config.config['App'].get('deadline', '')
+        if isinstance(deadline, str):
+            try:
+                deadline = parse_deadline(deadline)
+            except ValueError:
+                logger.error('invalid deadline {0}, expected HH:MM'.format(
+                    deadline))
+                deadline = None
+        self.deadline = deadline
+        self.report = None
+        # jobs postponed to meet the deadline, see upgrade()
+        self.postponed = []
+
+        self.scheduler = None
+        self._prepared = False
+        self._cancelled = False
+        self._pages_by_number = {}
+        self._thumbnail_hashes = {}
+        # (page number, rendition): bytes, from HEAD requests and downloads
+        self._sizes = {}
+        self.leases = None
+        self.manifest = None
+        self.phash_index = None
+
+    def _progress(self, stage, done=0, total=0, message=''):
+        if self.on_progress is not None:
+            self.on_progress(Progress(stage, done, total, message))
+
+    def _resolve_labels(self):
+        '''Look up publication and edition labels, checking that the codes exist.'''
+        doc = self.scraper.fetch(self.scraper.site_archive_url)
+        if not doc:
+            raise DownloadError('Could not obtain publication codes.')
+        publications = self.scraper.parse_publication_codes(doc)
+        labels = [k for k, v in publications.items() if v == self.pub_code]
+        if not labels:
+            raise DownloadError('Unknown publication {0}'.format(self.pub_code))
+        self.epaper.selected_publication = (labels[0], self.pub_code)
+
+        doc = self.scraper.fetch(self.scraper.site_archive_edition_url.format(
+            pub_code=self.pub_code))
+        if not doc:
+            raise DownloadError('Could not obtain edition codes.')
+        editions = self.scraper.parse_edition_codes(doc)
+        labels = [k for k, v in editions.items() if v == self.edition_code]
+        if not labels:
+            raise DownloadError('Unknown edition {0}'.format(self.edition_code))
+        self.epaper.selected_edition = (labels[0], self.edition_code)
+
+    def prepare(self):
+        '''Retrieve the table of contents and build epaper.pages for the selected
+pages. Raise DownloadError if the edition is not available.'''
+        if self._prepared:
+            return self.epaper.pages
+        epaper = self.epaper
+        if epaper.selected_publication[1] != self.pub_code or \
+           epaper.selected_edition[1] != self.edition_code:
+            self._resolve_labels()
+        epaper.selected_date = self.date
+
+        # $HOME/cache_dir/pub/edition/date
+        epaper.create_download_dir()
+
+        logger.info('Downloading epaper...')
+        logger.info('pub_code={0}, edition={1}, date={2}'.format(
+            self.pub_code, self.edition_code, str(self.date.date())))
+
+        date_str = self.date.strftime('%Y%m%d')
+        toc_url = self.scraper.build_toc_url(
+            pub_code=self.pub_code,
+            edition_code=self.edition_code,
+            date_str=date_str
+        )
+        epaper.toc_dict = self.scraper.fetch(toc_url)
+
+        # check for valid dict format.
+        if epaper.toc_dict is None:
+            raise DownloadError('Table of contents could not be retrieved!')
+        if 'toc' not in epaper.toc_dict:
+            raise DownloadError('TOC JSON format error!')
+
+        # save the toc to default download location
+        epaper.save_toc()
+
+        # build the epaper.pages list of epaper.Page structures for selected
+        # pages only
+        entries = self.selection.filter_toc(epaper.toc_dict['toc'])
+        epaper.pages = []
+        for i, page in enumerate(entries):
+            self._progress('metadata', i, len(entries),
+                           'Retrieving page {0} metadata'.format(i))
+            urls = self.scraper.build_page_urls(
+                pub_code=self.pub_code,
+                edition_code=self.edition_code,
+                date_str=date_str,
+                page_folder=page['page_folder'],
+                with_pdf=self.selection.pdf
+            )
+            for url_key, filename in epaper.page_filenames(
+                    int(page['page'])).items():
+                urls[url_key][1] = filename
+            epaper.pages.append(
+                epaper.Page(
+                    number=int(page['page']),
+                    title=page['page_title'],
+                    urls=urls
+                )
+            )
+        epaper.num_pages = len(epaper.pages)
+        self._pages_by_number = dict((page.number, page) for page in epaper.pages)
+        self._prepared = True
+        return epaper.pages
+
+    def _setup(self):
+        config = self.app_config.config['App']
+        # other epaper processes, possibly on other hosts sharing cache_dir, may
+        # be working on this edition: claim each job before downloading it.
+        self.leases = LeaseManager(
+            lease_dir=os.path.join(self.epaper.download_path, '.leases'),
+            ttl=config.getint('lease_ttl', 300)
+        )
+        # size and checksum of every file, see `epaper verify`
+        self.manifest = Manifest(self.epaper.download_path,
+                                 compression=self.epaper.metadata_compression)
+        # optionally reuse identical pages of other editions of the same day
+        if config.getboolean('dedupe', False) and self.storage.local:
+            try:
+                self.phash_index = PHashIndex(
+                    cache_dir=config['cache_dir'],
+                    threshold=config.getint('dedupe_threshold', 4))
+            except ImportError as e:
+                logger.error('page deduplication disabled: {0}'.format(e))
+
+    def _thumbnail_hash(self, page_number):
+        if page_number not in self._thumbnail_hashes:
+            filename = resolve_image(
+                self._pages_by_number[page_number].urls['thumbnail'][1])
+            if filename is None:
+                return None
+            try:
+                self._thumbnail_hashes[page_number] = dhash(filename)
+            except (IOError, OSError) as e:
+                logger.error('could not hash {0}: {1}'.format(filename, e))
+                return None
+        return self._thumbnail_hashes[page_number]
+
+    def _reuse_page(self, job):
+        # thumbnails are downloaded first, so normally one is on disk
+        value = self._thumbnail_hash(job.page_number)
+        if value is None:
+            return None
+        return self.phash_index.reuse(
+            self.pub_code, self.edition_code, str(self.date.date()), value,
+            job.rendition, job.filename)
+
+    def _key(self, job):
+        return file_key(self.app_config.config['App']['cache_dir'],
+                        job.filename)
+
+    def _on_disk(self, job):
+        if not self.storage.local:
+            return self.storage.exists(self._key(job))
+        if job.rendition == 'pdf':
+            return os.path.exists(job.filename)
+        # possibly transcoded by an earlier run
+        return resolve_image(job.filename) is not None
+
+    def _run_job(self, job):
+        if self._on_disk(job):
+            return True
+        key = 'page-{0:03d}-{1}'.format(job.page_number, job.rendition)
+        if not self.leases.claim(key):
+            # leased by another worker, retried later
+            return None
+        try:
+            # it may have completed between our check and claim
+            if self._on_disk(job):
+                return True
+            if self.phash_index is not None and \
+               job.rendition in DEDUPE_RENDITIONS:
+                filename = self._reuse_page(job)
+                if filename:
+                    self.manifest.add(filename)
+                    return True
+            headers = {}
+            if not self.storage.local:
+                ok = self.scraper.stream_to_storage(
+                    job.url, self.storage, self._key(job),
+                    image=job.rendition != 'pdf', response_headers=headers)
+            elif job.rendition == 'pdf':
+                ok = self.scraper.save_file(job.url, job.filename, delay=False,
+                                            response_headers=headers)
+            else:
+                status, count = self.scraper.save_image(
+                    job.url, job.filename, delay=False,
+                    response_headers=headers)
+                ok = status and os.path.exists(job.filename)
+            if ok:
+                # throughput and sizes for the deadline, see _job_size()
+                size = headers.get('content-length', '')
+                if size.isdigit():
+                    size = int(size)
+                elif self.storage.local and os.path.exists(job.filename):
+                    size = os.path.getsize(job.filename)
+                else:
+                    size = None
+                if size is not None:
+                    self._sizes[(job.page_number, job.rendition)] = size
+                    self.scheduler.transferred(size)
+            if ok and self.storage.local:
+                # remote validators let `epaper sync` detect corrected pages
+                self.manifest.add(job.filename, etag=headers.get('etag'),
+                                  content_length=headers.get('content-length'))
+            return ok
+        finally:
+            self.leases.release(key)
+
+    def _job_done(self, job, ok, results):
+        log_event(logger, 'page_rendition_done', page=job.page_number,
+                  rendition=job.rendition, ok=ok)
+        page = self._pages_by_number[job.page_number]
+        # update file_exists flag in epaper.pages
+        if ok:
+            page.urls[job.rendition][2] = True
+        if ok and self.phash_index is not None and job.rendition == 'thumbnail':
+            value = self._thumbnail_hash(job.page_number)
+            if value is not None:
+                self.phash_index.add(
+                    self.pub_code, self.edition_code, str(self.date.date()),
+                    job.page_number, value, self.epaper.download_path)
+        if ok and not self.storage.local:
+            filename = self._key(job)
+        elif ok:
+            filename = resolve_image(job.filename) or job.filename
+        else:
+            filename = None
+        results.put(PageResult(
+            page=page, rendition=job.rendition, ok=bool(ok), filename=filename))
+
+    def _tier_complete(self, tier):
+        # every page now has this rendition: let viewers and the search index
+        # pick up the edition without waiting for the remaining tiers.
+        logger.info('all {0} images downloaded'.format(tier))
+        self._progress('tier', message='Downloaded all {0} images'.format(tier))
+        self.epaper.save_page_metadata()
+        self.epaper.index_pub()
+        self.manifest.save()
+
+    def _job_size(self, job):
+        '''Expected bytes of *job*: its Content-Length if known, else the mean of
+the known sizes of its rendition.'''
+        size = self._sizes.get((job.page_number, job.rendition))
+        if size is not None:
+            return size
+        sizes = [v for (_, rendition), v in list(self._sizes.items())
+                 if rendition == job.rendition]
+        if sizes:
+            return sum(sizes) / len(sizes)
+        return DEFAULT_SIZES.get(job.rendition, DEFAULT_SIZES['highres'])
+
+    def _sample_sizes(self, jobs):
+        '''HEAD the first few jobs of each rendition for their Content-Length.'''
+        samples = []
+        for rendition in self.selection.renditions:
+            samples.extend([job for job in jobs
+                            if job.rendition == rendition][:SIZE_SAMPLES])
+        if not samples:
+            return
+
+        def head(job):
+            headers = self.scraper.head(job.url) or {}
+            if headers.get('content-length', '').isdigit():
+                self._sizes[(job.page_number, job.rendition)] = \
+                    int(headers['content-length'])
+
+        workers = self.app_config.config['Http'].getint('workers', 4)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            list(pool.map(head, samples))
+
+    def _work(self, scheduler, results):
+        # viewers bump the page on display via epaper.select_page()
+        self.scheduler = scheduler
+        self.epaper.scheduler = scheduler
+        self.leases.start_heartbeat()
+        try:
+            scheduler.run()
+        finally:
+            self.leases.stop_heartbeat()
+            self.epaper.scheduler = None
+            results.put(_DONE)
+
+    def _start(self, results):
+        '''Queue the missing files and start the scheduler thread; results are
+put on *results*, followed by _DONE.'''
+        self.prepare()
+        self._setup()
+        jobs = []
+        for page in self.epaper.pages:
+            for url_key in self.selection.renditions:
+                url, filename, file_exists = page.urls[url_key]
+                if url and not file_exists:
+                    jobs.append(Job(page.number, url_key, url, filename))
+        if self.deadline is not None:
+            self._progress('download', message='Estimating download size...')
+            self._sample_sizes(jobs)
+        self._progress('download', message='Downloading pages...')
+        self.scheduler = DownloadScheduler(
+            run_job=self._run_job,
+            workers=self.app_config.config['Http'].getint('workers', 4),
+            tiers=self.selection.renditions,
+            on_job_done=lambda job, ok: self._job_done(job, ok, results),
+            on_tier_complete=self._tier_complete,
+            deadline=self.deadline,
+            job_size=self._job_size
+        )
+        for job in jobs:
+            self.scheduler.add(job)
+        if self._cancelled:
+            self.scheduler.cancel()
+
+        def work():
+            self._work(self.scheduler, results)
+
+        thread = threading.Thread(target=work, daemon=True)
+        thread.start()
+        return thread
+
+    def _count_pages(self):
+        '''Return (number of complete pages, page numbers that failed).'''
+        renditions = self.selection.renditions
+        postponed = set((job.page_number, job.rendition)
+                        for job in self.postponed)
+        downloaded, failed = 0, []
+        for page in self.epaper.pages:
+            # postponed renditions come with upgrade()
+            page_downloads = len([key for key in renditions
+                                  if page.urls[key][2] or
+                                  (page.number, key) in postponed])
+            if page_downloads >= min(2, len(renditions)):
+                # successful download and save of thumbnail and at least one
+                # of low or highres images, or of the only selected rendition.
+                downloaded += 1
+            else:
+                # note failed attempts
+                failed.append(page.number)
+        return downloaded, failed
+
+    def _finish(self):
+        '''Count complete pages, post-process the edition and set self.report.'''
+        self.postponed = self.scheduler.postponed()
+        downloaded, failed = self._count_pages()
+        self._post_process(failed)
+        self.report = DownloadReport(
+            downloaded=downloaded,
+            failed=failed,
+            cancelled=self._cancelled,
+            download_path=self.epaper.download_path,
+            postponed=sorted(set(job.page_number for job in self.postponed))
+        )
+        self._progress('done', downloaded, len(self.epaper.pages),
+                       'Downloaded {0} pages.'.format(downloaded))
+        return self.report
+
+    def _post_process(self, failed):
+        epaper = self.epaper
+        local = self.storage.local
+        if not self._cancelled and local:
+            # optional storage format conversion
+            epaper.transcode_pages(manifest=self.manifest)
+            atlas = epaper.build_thumbnail_atlas()
+            if atlas:
+                self.manifest.add(atlas)
+        self.manifest.save()
+        if not failed:
+            epaper.clear_redownload()
+
+        # save page metadata as json, so UI tools can read it.
+        epaper.save_page_metadata()
+
+        # make page titles searchable
+        epaper.index_pub()
+
+        if not local:
+            self._publish_metadata()
+
+        # optionally make the text of the page PDFs searchable
+        if self.app_config.config['App'].getboolean('extract_text', False) \
+           and self.selection.pdf and not self._cancelled and local:
+            self._progress('text', message='Extracting text...')
+            try:
+                extractor = TextExtractor.from_config(
+                    self.app_config, search_index=epaper.search_index)
+                extracted = sum(1 for key, page, ok in extractor.run(
+                    [(self.pub_code, self.edition_code, str(self.date.date()))])
+                    if ok)
+                logger.info('extracted text of {0} pages'.format(extracted))
+            except ImportError as e:
+                logger.error('text extraction disabled: {0}'.format(e))
+
+        # optionally pack the completed edition into a single archive
+        if self.app_config.config['App'].getboolean('pack_editions', False) \
+           and not failed and not self.postponed and not self._cancelled \
+           and local:
+            epaper.pack_pub(self.pub_code, self.edition_code,
+                            str(self.date.date()))
+
+    def upgrade(self):
+        '''Download the renditions postponed to meet the deadline, in a pass of
+their own once the edition is ready, e.g. highres images for pages that only
+got lowres. Post-process the edition again and update self.report. Return the
+list of PageResult.'''
+        if not self.postponed or self._cancelled:
+            return []
+        jobs = self.postponed
+        self._progress('upgrade', 0, len(jobs),
+                       'Upgrading {0} images...'.format(len(jobs)))
+        results = queue.Queue()
+        scheduler = DownloadScheduler(
+            run_job=self._run_job,
+            workers=self.app_config.config['Http'].getint('workers', 4),
+            tiers=self.selection.renditions,
+            on_job_done=lambda job, ok: self._job_done(job, ok, results)
+        )
+        for job in jobs:
+            scheduler.add(job)
+        self._work(scheduler, results)
+        page_results = []
+        while True:
+            result = results.get()
+            if result is _DONE:
+                break
+            page_results.append(result)
+
+        self.postponed = []
+        downloaded, failed = self._count_pages()
+        self._post_process(failed)
+        self.report = self.report._replace(
+            downloaded=downloaded, failed=failed, cancelled=self._cancelled,
+            postponed=[])
+        self._progress('done', downloaded, len(self.epaper.pages),
+                       'Upgraded {0} images.'.format(
+                           len([r for r in page_results if r.ok])))
+        return page_results
+
+    def _publish_metadata(self):
+        '''Copy the edition's table of contents and page metadata to the object
+store, next to its pages.'''
+        cache_dir = self.app_config.config['App']['cache_dir']
+        for name in sorted(os.listdir(self.epaper.download_path)):
+            if not name.startswith(('toc.json', 'page_metadata.json')):
+                continue
+            filename = os.path.join(self.epaper.download_path, name)
+            try:
+                with open(filename, 'rb') as source, \
+                        self.storage.writer(file_key(cache_dir, filename)) as fd:
+                    shutil.copyfileobj(source, fd)
+            except Exception as e:
+                logger.error('could not store {0}: {1}'.format(filename, e))
+
+    def cancel(self):
+        '''Stop the download: pending jobs are dropped, running ones finish.
+Safe to call from any thread.'''
+        self._cancelled = True
+        if self.scheduler is not None:
+            self.scheduler.cancel()
+
+    def __iter__(self):
+        '''Yield a PageResult for each download as it finishes. Closing the
+generator early cancels the download.'''
+        results = queue.Queue()
+        thread = self._start(results)
+        try:
+            while True:
+                result = results.get()
+                if result is _DONE:
+                    break
+                yield result
+        finally:
+            if thread.is_alive():
+                self.cancel()
+                thread.join()
+            self._finish()
+
+    async def _aiter(self):
+        loop = asyncio.get_running_loop()
+        results = asyncio.Queue()
+
+        class _Bridge:
+            # scheduler threads hand results over to the event loop
+            def put(self, item):
+                loop.call_soon_threadsafe(results.put_nowait, item)
+
+        # prepare() does blocking network requests
+        thread = await loop.run_in_executor(None, self._start, _Bridge())
+        try:
+            while True:
+                result = await results.get()
+                if result is _DONE:
+                    break
+                yield result
+        finally:
+            if thread.is_alive():
+                self.cancel()
+                await loop.run_in_executor(None, thread.join)
+            await loop.run_in_executor(None, self._finish)
+
+    def __aiter__(self):
+        '''Like __iter__(), for use from an asyncio event loop; the download
+runs in threads and does not block the loop.'''
+        return self._aiter()
+
+    def run(self):
+        '''Download the whole edition and return the DownloadReport.'''
+        for result in self:
+            pass
+        return self.report
@@ -1,14 +1,28 @@
 from PIL import Image
 from collections import namedtuple
-from datetime import datetime, timedelta
+from datetime import datetime
 from io import BytesIO
-import json
 import logging
 import os
+import re
+
+from epaper.archive import EditionArchive, archive_path, pack_edition, \
+    unpack_edition
+from epaper.atlas import ThumbnailAtlas, build_atlas
+from epaper.availability import candidate_dates
+from epaper.manifest import Manifest
+from epaper.search import SearchIndex
+from epaper.storage import file_key, make_storage
+from epaper.transcode import resolve_image, transcode_images
+from epaper.utils import find_json, read_json, write_json
+from epaper.watcher import EDITION_EVICTED, PAGE_COMPLETED
 
 # logging
 logger = logging.getLogger('epaper')
 
+# a packed edition: <cache_dir>/<pub>/<edition>/<YYYY-MM-DD>.zip
+ARCHIVE_FILE = re.compile(r'^\d{4}-\d{2}-\d{2}\.zip$')
+
 
 class EPaper:
     '''Manages data that is pulled from SITE_ARCHIVE to enable selection of a specific
@@ -29,10 +43,9 @@ publication.'''
             ('Mumbai', 'BOM'),
         ])
 
-        # selectable dates for epaper download
-        self.available_dates = [
-            (datetime.today().date() - timedelta(i)).strftime('%Y%m%d') for i in range(1, 8)
-        ]
+        # selectable dates for epaper download, newest first; narrow them down to
+        # those with an edition with AvailabilityProber
+        self.available_dates = candidate_dates(7)
 
         # publication code and label after selection
         self.selected_publication = ('', '')  # (label, code)
@@ -55,6 +68,9 @@ publication.'''
         # array index of page being viewed
         self.selected_page = 0
 
+        # DownloadScheduler of a running download, if any
+        self.scheduler = None
+
         # page data
         # urls: dict of lists where each key points to [url, filename, exists]
         # see implementation in scraper.build_page_urls()
@@ -67,21 +83,73 @@ publication.'''
         # each element of list is a tuple(pub_code, edition_code, date_str)
         self.on_disk_pubs = []
 
+        # full-text index of page titles, opened on first use
+        self._search_index = None
+
+        # ThumbnailAtlas of the edition being viewed, loaded on first use
+        self._atlas = None
+
+        # open EditionArchive by archive filename, see open_archive()
+        self._archives = {}
+
+        # storage backend of page files, made on first use
+        self._storage = None
+
     def get_page_image_from_disk(self, page_index, image_type='thumbnail'):
         '''Read and return page image from disk given page_index.'''
         if len(self.pages) > 0:
             page = self.pages[page_index]
             try:
-                filename = page.urls[image_type][1]
-                if os.path.exists(filename):
+                filename = resolve_image(page.urls[image_type][1])
+                if filename:
                     with open(filename, 'rb') as fd:
-                        return Image(BytesIO(fd.read()))
-                else:
-                    return None
+                        return Image.open(BytesIO(fd.read()))
+                archive = self.open_archive(
+                    os.path.dirname(page.urls[image_type][1]))
+                if archive is not None:
+                    name = archive.resolve_image(
+                        os.path.basename(page.urls[image_type][1]))
+                    if name:
+                        return Image.open(archive.open(name))
+                if not self.storage.local:
+                    # downloaded straight to the object store
+                    key = file_key(self.app_config.config['App']['cache_dir'],
+                                   page.urls[image_type][1])
+                    return Image.open(BytesIO(self.storage.read(key)))
+                return None
             except IOError as e:
-                logger.error('EPaperApp: error reading {fname}')
+                logger.error('EPaperApp: error reading {0}: {1}'.format(
+                    page.urls[image_type][1], e))
         return None
 
+    def get_page_thumbnail(self, page_index):
+        '''Return the thumbnail of a page as a crop of the edition's thumbnail
+atlas, decoded once and cached; falls back to the page's thumbnail file.'''
+        if len(self.pages) == 0:
+            return None
+        atlas = self._atlas
+        if atlas is None or atlas.is_stale() or \
+           os.path.dirname(atlas.filename) != self.download_path:
+            try:
+                atlas = ThumbnailAtlas(self.download_path,
+                                       self.open_archive(self.download_path))
+            except (IOError, OSError) as e:
+                logger.debug('no thumbnail atlas: {0}'.format(e))
+                atlas = None
+            self._atlas = atlas
+        image = atlas.thumbnail(self.pages[page_index].number) \
+            if atlas is not None else None
+        if image is None:
+            return self.get_page_image_from_disk(page_index)
+        return image
+
+    def select_page(self, page_index):
+        '''Select the page being viewed; while the edition is downloading its
+remaining images are moved to the front of the queue.'''
+        self.selected_page = page_index
+        if self.scheduler is not None and page_index < len(self.pages):
+            self.scheduler.bump(self.pages[page_index].number)
+
     def save_codes_to_config(self):
         pub_code = self.selected_publication[1]
         edition_code = self.selected_edition[1]
@@ -106,25 +174,201 @@ publication.'''
                 edition_code,
                 str(date.date())  # YYYY-MM-DD
             )
+            if os.path.exists(archive_path(self.download_path)):
+                # packed earlier: unpack to download more of it
+                self.close_archive(self.download_path)
+                unpack_edition(self.download_path)
             os.makedirs(self.download_path, exist_ok=True)
 
+    def page_filenames(self, page_number):
+        '''Return {rendition: filename} for a page in the download directory.'''
+        return dict(
+            (key, os.path.join(self.download_path, name.format(page_number)))
+            for key, name in (('thumbnail', 'page-{0:03d}-thumbnail.jpg'),
+                              ('lowres', 'page-{0:03d}-lowres.jpg'),
+                              ('highres', 'page-{0:03d}-highres.jpg'),
+                              ('pdf', 'page-{0:03d}-highres.pdf'))
+        )
+
     def save_page_metadata(self):
         '''Save self.pages after first initial download, so any subsequent redownloads
-can restart from this db than re-requesting all data again. This should also
-help manage planned sync feature.
+can restart from this db than re-requesting all data again. `epaper sync`
+compares against it to find changed pages.
 
         '''
         if len(self.pages) > 0:
-            filename = os.path.join(self.download_path, 'page_metadata.json')
-            with open(filename, 'w') as fd:
-                fd.write(json.dumps(self.pages))
+            # other workers sharing the cache may have completed files since
+            for page in self.pages:
+                for key, (url, filename, exists) in page.urls.items():
+                    if filename and not exists:
+                        page.urls[key][2] = resolve_image(filename) is not None
+            write_json(os.path.join(self.download_path, 'page_metadata.json'),
+                       self.pages, compression=self.metadata_compression)
+
+    def save_toc(self):
+        '''Save self.toc_dict to toc.json in the download directory.'''
+        write_json(os.path.join(self.download_path, 'toc.json'),
+                   self.toc_dict, compression=self.metadata_compression)
+
+    def transcode_pages(self, image_types=('thumbnail', 'lowres', 'highres'),
+                        manifest=None):
+        '''Transcode downloaded page images to [App] storage_format and point the
+page urls at the new files; in *manifest*, the new files replace the old ones.
+Return a dict of original to new filenames, None for those that failed.'''
+        config = self.app_config.config['App']
+        storage_format = config.get('storage_format', 'jpg')
+        if storage_format == 'jpg':
+            return {}
+        filenames = [
+            page.urls[key][1] for page in self.pages for key in image_types
+            if page.urls[key][1] and os.path.exists(page.urls[key][1])
+        ]
+        results = transcode_images(
+            filenames,
+            storage_format=storage_format,
+            quality=config.getint('storage_quality', 80),
+            workers=config.getint('transcode_workers', 0)
+        )
+        for page in self.pages:
+            for key in image_types:
+                new_filename = results.get(page.urls[key][1])
+                if new_filename:
+                    page.urls[key][1] = new_filename
+        if manifest is not None:
+            for filename, new_filename in results.items():
+                if new_filename:
+                    manifest.rename(filename, new_filename)
+        return results
+
+    def build_thumbnail_atlas(self):
+        '''Pack the downloaded page thumbnails into the edition's thumbnail atlas,
+if [App] thumbnail_atlas is enabled. Return the atlas filename or None.'''
+        config = self.app_config.config['App']
+        if not config.getboolean('thumbnail_atlas', True):
+            return None
+        thumbnails = {}
+        for page in self.pages:
+            filename = resolve_image(page.urls['thumbnail'][1])
+            if filename:
+                thumbnails[page.number] = filename
+        return build_atlas(
+            self.download_path, thumbnails,
+            storage_format=config.get('storage_format', 'jpg'),
+            quality=config.getint('storage_quality', 80),
+            compression=self.metadata_compression
+        )
+
+    def queue_redownload(self, download_path, names):
+        '''Move corrupt files *names* of an edition aside (as hidden .corrupt files)
+so the next download of the edition fetches them again, and record them in the
+cache-wide redownload queue.'''
+        if not os.path.isdir(download_path):
+            self.close_archive(download_path)
+            archive = archive_path(download_path)
+            if os.path.basename(archive) in names:
+                # unreadable: moved aside, the whole edition is downloaded again
+                os.replace(archive, os.path.join(
+                    os.path.dirname(archive),
+                    '.{0}.corrupt'.format(os.path.basename(archive))))
+                os.makedirs(download_path, exist_ok=True)
+            else:
+                unpack_edition(download_path)
+        for name in names:
+            filename = os.path.join(download_path, name)
+            if os.path.exists(filename):
+                os.replace(filename, os.path.join(
+                    download_path, '.{0}.corrupt'.format(name)))
+        manifest = Manifest(download_path, compression=self.metadata_compression)
+        for name in names:
+            manifest.remove(name)
+        manifest.save()
+        queue = self.redownload_queue()
+        key = '/'.join(download_path.split('/')[-3:])
+        queue[key] = sorted(set(queue.get(key, [])) | set(names))
+        self._save_redownload_queue(queue)
+
+    def redownload_queue(self):
+        '''Return {"pub/edition/date": [file names]} of files queued for
+re-download.'''
+        path = os.path.join(self.app_config.config['App']['cache_dir'],
+                            'redownload.json')
+        return read_json(path) if find_json(path) else {}
+
+    def clear_redownload(self):
+        '''Drop the selected edition from the redownload queue.'''
+        queue = self.redownload_queue()
+        key = '/'.join(self.download_path.split('/')[-3:])
+        if queue.pop(key, None) is not None:
+            self._save_redownload_queue(queue)
+
+    def _save_redownload_queue(self, queue):
+        write_json(os.path.join(self.app_config.config['App']['cache_dir'],
+                                'redownload.json'),
+                   queue, compression=self.metadata_compression)
+
+    @property
+    def metadata_compression(self):
+        '''On-disk compression for JSON metadata, see [App] metadata_compression.'''
+        return self.app_config.config['App'].get('metadata_compression', 'zstd')
 
     def find_on_disk_pubs(self):
-        '''Find previously downloaded publications within cache directory.'''
+        '''Find previously downloaded publications within cache directory, as
+directories or packed archives.'''
+        cache_dir = self.app_config.config['App']['cache_dir']
+        toc_files = ('toc.json', 'toc.json.zst', 'toc.json.gz')
+        pubs = []
+        for dirpath, dirs, files in os.walk(cache_dir):
+            if any(name in files for name in toc_files):
+                pubs.append(tuple(dirpath.split('/')[-3:]))
+                # an edition directory has no subdirectories worth a visit
+                dirs[:] = []
+                continue
+            pubs.extend(tuple(dirpath.split('/')[-2:]) + (name[:-4],)
+                        for name in files if ARCHIVE_FILE.match(name))
+        return pubs
+
+    def open_archive(self, download_path):
+        '''Return the EditionArchive of a packed edition, kept open until the
+archive changes, or None if the edition is not packed.'''
+        filename = archive_path(download_path)
+        archive = self._archives.get(filename)
+        try:
+            if archive is None or os.stat(filename).st_mtime != archive.mtime:
+                self.close_archive(download_path)
+                archive = self._archives[filename] = EditionArchive(filename)
+        except FileNotFoundError:
+            self.close_archive(download_path)
+            return None
+        except (IOError, OSError) as e:
+            # one bad archive must not take down the index or the viewer
+            logger.error('unreadable edition archive: {0}'.format(e))
+            self.close_archive(download_path)
+            return None
+        return archive
+
+    def close_archive(self, download_path):
+        archive = self._archives.pop(archive_path(download_path), None)
+        if archive is not None:
+            archive.close()
+
+    def pack_pub(self, pub_code=None, edition_code=None, date_str=None):
+        '''Pack a completely downloaded edition into a single archive, see
+archive.pack_edition(). Editions with failed downloads or workers still holding
+leases are left as they are. Return the archive filename or None.'''
         cache_dir = self.app_config.config['App']['cache_dir']
-        return [tuple(dirpath.split('/')[-3:])
-                for dirpath, dirs, files in os.walk(cache_dir)
-                if 'toc.json' in files]
+        download_path = os.path.join(cache_dir, pub_code, edition_code, date_str)
+        if not find_json(os.path.join(download_path, 'page_metadata.json')):
+            return None
+        if '/'.join((pub_code, edition_code, date_str)) in self.redownload_queue():
+            return None
+        lease_dir = os.path.join(download_path, '.leases')
+        if os.path.isdir(lease_dir) and \
+           any(name.endswith('.lease') for name in os.listdir(lease_dir)):
+            return None
+        self.close_archive(download_path)
+        filename = pack_edition(download_path)
+        logger.info('packed {0}'.format(filename))
+        return filename
 
     def load_pub(self, pub_code=None, edition_code=None, date_str=None):
         '''Load self.pages data from json dump in disk cache.'''
@@ -133,10 +377,145 @@ help manage planned sync feature.
             cache_dir, pub_code, edition_code, date_str)
         toc_filename = os.path.join(download_path, 'toc.json')
         metadata_filename = os.path.join(download_path, 'page_metadata.json')
-        if os.path.exists(toc_filename) and \
-           os.path.exists(metadata_filename):
-            with open(toc_filename, 'r') as fd:
-                toc = json.load(fd)
-            with open(metadata_filename, 'r') as fd:
-                metadata = json.load(fd)
+        toc, metadata = None, None
+        if find_json(toc_filename) and \
+           find_json(metadata_filename):
+            toc = read_json(toc_filename)
+            metadata = read_json(metadata_filename)
+        else:
+            archive = self.open_archive(download_path)
+            if archive is not None and archive.find_json('toc.json') and \
+               archive.find_json('page_metadata.json'):
+                toc = archive.read_json('toc.json')
+                metadata = archive.read_json('page_metadata.json')
         return (toc, metadata)
+
+    def open_pub(self, pub_code=None, edition_code=None, date_str=None):
+        '''View a cached edition: point the download path at it and load its pages
+from its page metadata. Return False if there is no page metadata (yet).'''
+        cache_dir = self.app_config.config['App']['cache_dir']
+        self.download_path = os.path.join(cache_dir, pub_code, edition_code,
+                                          date_str)
+        self.selected_date = datetime.strptime(date_str, '%Y-%m-%d')
+        toc, metadata = self.load_pub(pub_code, edition_code, date_str)
+        if metadata is None:
+            self.pages = []
+            self.num_pages = 0
+            return False
+        self.toc_dict = toc
+        self.pages = []
+        for number, title, urls in metadata:
+            for key, value in urls.items():
+                # metadata may come from another host sharing the cache
+                if value[1]:
+                    value[1] = os.path.join(self.download_path,
+                                            os.path.basename(value[1]))
+            self.pages.append(self.Page(number=number, title=title, urls=urls))
+        self.num_pages = len(self.pages)
+        return True
+
+    def apply_cache_event(self, event):
+        '''Update the list of cached editions and the pages of the edition being
+viewed from a watcher.CacheEvent. Return True if the event concerns the edition
+being viewed.'''
+        key = (event.pub_code, event.edition_code, event.date)
+        if event.kind == EDITION_EVICTED:
+            if key in self.on_disk_pubs:
+                self.on_disk_pubs.remove(key)
+        elif key not in self.on_disk_pubs:
+            self.on_disk_pubs.append(key)
+        viewed = self.download_path == os.path.join(
+            self.app_config.config['App']['cache_dir'], *key)
+        if viewed and event.kind == PAGE_COMPLETED:
+            pages = [page for page in self.pages if page.number == event.page]
+            if not pages:
+                # written by another process: its page metadata may be newer
+                self.open_pub(*key)
+                pages = [page for page in self.pages
+                         if page.number == event.page]
+            for page in pages:
+                if event.rendition in page.urls:
+                    page.urls[event.rendition][2] = True
+        return viewed
+
+    def describe_pub(self, pub_code=None, edition_code=None, date_str=None):
+        '''Return a dict describing a cached edition and its pages, with page files
+as paths relative to the cache directory.'''
+        cache_dir = self.app_config.config['App']['cache_dir']
+        download_path = os.path.join(cache_dir, pub_code, edition_code, date_str)
+        toc, metadata = self.load_pub(pub_code, edition_code, date_str)
+        archive = None if os.path.isdir(download_path) else \
+            self.open_archive(download_path)
+        pages = []
+        for number, title, urls in metadata or []:
+            files = {}
+            for key, (url, filename, exists) in urls.items():
+                if not filename:
+                    continue
+                # metadata may come from another host sharing the cache
+                name = os.path.basename(filename)
+                if archive is not None:
+                    # served from the archive under the same path
+                    name = archive.resolve_image(name)
+                    filename = name and os.path.join(download_path, name)
+                else:
+                    filename = resolve_image(os.path.join(download_path, name))
+                if filename:
+                    files[key] = os.path.relpath(filename, cache_dir)
+            pages.append({'number': number, 'title': title, 'files': files})
+        return {
+            'pub_code': pub_code,
+            'edition_code': edition_code,
+            'date': date_str,
+            'pages': pages,
+        }
+
+    def build_catalog(self):
+        '''Return describe_pub() for every edition in the disk cache.'''
+        return [self.describe_pub(*pub) for pub in sorted(self.find_on_disk_pubs())]
+
+    @property
+    def storage(self):
+        '''Storage backend of page files, see epaper.storage.'''
+        if self._storage is None:
+            self._storage = make_storage(self.app_config)
+        return self._storage
+
+    @property
+    def search_index(self):
+        '''SearchIndex stored in the cache directory.'''
+        if self._search_index is None:
+            self._search_index = SearchIndex(
+                cache_dir=self.app_config.config['App']['cache_dir'])
+        return self._search_index
+
+    def index_pub(self):
+        '''Add the selected, downloaded edition to the search index.'''
+        return self.search_index.add_edition(
+            pub_code=self.selected_publication[1],
+            edition_code=self.selected_edition[1],
+            date_str=str(self.selected_date.date()),
+            toc_dict=self.toc_dict
+        )
+
+    def update_search_index(self):
+        '''Index editions in the disk cache that are not in the search index yet,
+e.g. those downloaded before the index existed. Return number of editions added.'''
+        added = 0
+        for pub_code, edition_code, date_str in self.find_on_disk_pubs():
+            if self.search_index.has_edition(pub_code, edition_code, date_str):
+                continue
+            toc, metadata = self.load_pub(pub_code, edition_code, date_str)
+            if toc is None:
+                continue
+            if self.search_index.add_edition(pub_code, edition_code, date_str, toc):
+                added += 1
+        return added
+
+    def search(self, query, pub_code=None, edition_code=None, limit=50,
+               text=False):
+        '''Return (pub_code, edition_code, date, page, title) hits for pages whose
+title, or with *text* whose extracted text, matches query.'''
+        return self.search_index.search(query, pub_code=pub_code,
+                                        edition_code=edition_code, limit=limit,
+                                        text=text)
@@ -0,0 +1,151 @@
+from contextlib import contextmanager
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# logging
+logger = logging.getLogger('lease')
+
+# lockf locks belong to the process, this serialises takeovers between its
+# threads
+_takeover_lock = threading.Lock()
+
+
+class LeaseManager:
+    '''Lease files for claiming (page, rendition) jobs in a shared cache, so that
+several processes, or hosts sharing cache_dir over NFS, split the work of an
+edition instead of each downloading everything.
+
+A lease is a file created with O_CREAT | O_EXCL in *lease_dir*. Its mtime is
+refreshed by a heartbeat thread while held; a lease not refreshed for *ttl*
+seconds belongs to a dead worker and may be taken over. Takeovers (and
+releases) are serialised with a lockf lock on a file in *lease_dir*, which NFS
+supports through its lock manager; where fcntl is not available they are not.
+
+    '''
+
+    def __init__(self, lease_dir=None, ttl=300, owner=None):
+        self.lease_dir = lease_dir
+        self.ttl = ttl
+        self.owner = owner or '{0}:{1}:{2}'.format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._held = set()
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        self._stop = threading.Event()
+        os.makedirs(self.lease_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.lease_dir, key + '.lease')
+
+    def _lease(self):
+        return json.dumps({'owner': self.owner, 'time': time.time()})
+
+    def _create(self, path):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(self._lease())
+        return True
+
+    def _is_stale(self, path):
+        try:
+            return os.path.getmtime(path) + self.ttl < time.time()
+        except FileNotFoundError:
+            return True
+
+    @contextmanager
+    def _takeover_lock(self):
+        with _takeover_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.lease_dir, '.takeover'), 'a') as f:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.lockf(f, fcntl.LOCK_UN)
+
+    def _take_over(self, path):
+        # under the takeover lock: check again, another worker may have taken
+        # the lease over since we looked
+        if not os.path.exists(path):
+            return self._create(path)
+        if not self._is_stale(path):
+            return False
+        # replace the file rather than remove it, so that it never disappears
+        # and no worker creating it with O_EXCL slips in meanwhile
+        temp = '{0}.{1}.tmp'.format(path, uuid.uuid4().hex[:8])
+        with open(temp, 'w') as f:
+            f.write(self._lease())
+        os.replace(temp, path)
+        return True
+
+    def claim(self, key):
+        '''Try to take the lease for *key*. Return True if we now hold it.'''
+        path = self._path(key)
+        if not self._create(path):
+            if not self._is_stale(path):
+                return False
+            with self._takeover_lock():
+                if not self._take_over(path):
+                    return False
+            logger.info('reclaimed stale lease {0}'.format(key))
+        with self._lock:
+            self._held.add(key)
+        return True
+
+    def release(self, key):
+        '''Give up the lease for *key*, if we still own it.'''
+        with self._lock:
+            self._held.discard(key)
+        path = self._path(key)
+        # not while another worker takes over the lease: we would remove its
+        # new one
+        with self._takeover_lock():
+            try:
+                with open(path) as f:
+                    owner = json.loads(f.read()).get('owner')
+                if owner == self.owner:
+                    os.remove(path)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def renew(self):
+        '''Refresh the mtime of all leases held.'''
+        with self._lock:
+            keys = list(self._held)
+        for key in keys:
+            try:
+                os.utime(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def start_heartbeat(self):
+        '''Renew held leases every ttl / 3 seconds from a daemon thread.'''
+        def beat():
+            while not self._stop.wait(self.ttl / 3.0):
+                self.renew()
+
+        if self._heartbeat is None:
+            self._stop.clear()
+            self._heartbeat = threading.Thread(target=beat, daemon=True)
+            self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        if self._heartbeat is not None:
+            self._stop.set()
+            self._heartbeat.join()
+            self._heartbeat = None
@@ -0,0 +1,103 @@
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import atexit
+import json
+import logging
+import queue
+import random
+
+# the running QueueListener, see setup_logging()
+_listener = None
+
+# fraction of sampled events that are logged, see log_event()
+_sample_rate = 1.0
+
+
+class JsonFormatter(logging.Formatter):
+    '''One JSON object per line; events from log_event() carry their fields.'''
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'name': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        if hasattr(record, 'event'):
+            entry['event'] = record.event
+            entry.update(record.event_fields)
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _Fields:
+    '''key=value rendering of event fields, done when the record is formatted.'''
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join('{0}={1}'.format(k, v) for k, v in self.fields.items())
+
+
+class _QueueHandler(QueueHandler):
+    '''Enqueue records as they are: the listener thread, not the logging
+thread, does the message formatting.'''
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(app_config):
+    '''Log through a queue to a rotating log file written by a background
+listener thread, configured from the [App] section:
+
+    log_file, log_level, log_format (text or json),
+    log_max_bytes, log_backup_count, log_sample_rate
+
+    '''
+    global _listener, _sample_rate
+    if _listener is not None:
+        return _listener
+
+    config = app_config.config['App']
+    handler = RotatingFileHandler(
+        config['log_file'],
+        maxBytes=config.getint('log_max_bytes', 10 * 1024 * 1024),
+        backupCount=config.getint('log_backup_count', 3)
+    )
+    if config.get('log_format', 'text') == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    _sample_rate = config.getfloat('log_sample_rate', 1.0)
+
+    log_queue = queue.Queue(-1)
+    root = logging.getLogger()
+    root.handlers = [_QueueHandler(log_queue)]
+    root.setLevel(config.get('log_level', 'INFO').upper())
+
+    _listener = QueueListener(log_queue, handler)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    '''Flush queued records and stop the listener thread.'''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def log_event(logger, event, level=logging.INFO, sampled=False, **fields):
+    '''Log a structured *event* with *fields*. High rate events, e.g. one per
+HTTP request, pass sampled=True and are only logged at [App] log_sample_rate.'''
+    if not logger.isEnabledFor(level):
+        return
+    if sampled and _sample_rate < 1.0 and random.random() >= _sample_rate:
+        return
+    logger.log(level, '%s %s', event, _Fields(fields),
+               extra={'event': event, 'event_fields': fields})
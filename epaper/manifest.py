@@ -0,0 +1,174 @@
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import logging
+import os
+import re
+import threading
+import zipfile
+
+from epaper.archive import archive_path, verify_archive
+from epaper.utils import find_json, read_json, write_json
+
+# logging
+logger = logging.getLogger('manifest')
+
+# page files checked even if a manifest does not list them
+PAGE_FILE = re.compile(r'^page-\d+-\w+\.(jpg|webp|avif|pdf)$')
+
+IMAGE_EXTENSIONS = ('.jpg', '.webp', '.avif')
+
+
+def file_digest(filename):
+    '''Return the SHA-256 hex digest of *filename*.'''
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class Manifest:
+    '''Size, mtime and SHA-256 of every downloaded file of an edition, stored as
+manifest.json in the edition directory. Entries are keyed by file name.'''
+
+    def __init__(self, download_path=None, compression='zstd'):
+        self.download_path = download_path
+        self.compression = compression
+        self.path = os.path.join(download_path, 'manifest.json')
+        self.entries = read_json(self.path) if find_json(self.path) else {}
+        self._removed = set()
+        self._lock = threading.Lock()
+
+    def add(self, filename, **extra):
+        '''Record *filename* as it is on disk now; *extra* fields, e.g. an HTTP
+ETag, are stored with it.'''
+        stat = os.stat(filename)
+        entry = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': file_digest(filename),
+        }
+        entry.update(extra)
+        with self._lock:
+            self.entries[os.path.basename(filename)] = entry
+            self._removed.discard(os.path.basename(filename))
+
+    def remove(self, filename):
+        with self._lock:
+            self.entries.pop(os.path.basename(filename), None)
+            self._removed.add(os.path.basename(filename))
+
+    def rename(self, filename, new_filename):
+        '''Record *new_filename*, e.g. *filename* transcoded, in place of
+*filename*. The HTTP validators of the download (etag, content_length), which
+sync compares against, move with it.'''
+        with self._lock:
+            entry = self.entries.get(os.path.basename(filename)) or {}
+        self.remove(filename)
+        self.add(new_filename, **dict(
+            (key, entry[key]) for key in ('etag', 'content_length')
+            if entry.get(key)))
+
+    def save(self):
+        '''Write the manifest, merged with entries other workers sharing the
+edition may have written since it was loaded.'''
+        with self._lock:
+            entries = read_json(self.path) if find_json(self.path) else {}
+            entries.update(self.entries)
+            for name in self._removed:
+                entries.pop(name, None)
+            self.entries = entries
+            write_json(self.path, self.entries, compression=self.compression)
+
+
+def check_file(filename, entry=None, full=False):
+    '''Return True if *filename* looks intact. With a manifest *entry* a file of
+the recorded size and mtime passes without being read, unless *full*; others
+are hashed. Files without an entry are decoded with Image.verify().'''
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return False
+    if entry is not None:
+        if stat.st_size != entry['size']:
+            return False
+        if not full and stat.st_mtime == entry['mtime']:
+            return True
+        return file_digest(filename) == entry['sha256']
+    if filename.endswith(IMAGE_EXTENSIONS):
+        try:
+            with Image.open(filename) as image:
+                image.verify()
+        except Exception:
+            return False
+    return stat.st_size > 0
+
+
+def verify_edition(download_path, full=False, compression='zstd'):
+    '''Check the files of one edition against its manifest. Files that passed
+a full check are (re)recorded. Packed editions are checked against the CRCs in
+their archive instead. Return the list of bad file names, the archive's own if
+it cannot be read at all.'''
+    filename = archive_path(download_path)
+    if not os.path.isdir(download_path) and os.path.exists(filename):
+        try:
+            return verify_archive(filename)
+        except (IOError, zipfile.BadZipFile) as e:
+            # the whole archive is bad
+            logger.error(str(e))
+            return [os.path.basename(filename)]
+    manifest = Manifest(download_path, compression=compression)
+    names = set(manifest.entries)
+    names.update(name for name in os.listdir(download_path)
+                 if PAGE_FILE.match(name))
+    bad, updated = [], False
+    for name in sorted(names):
+        filename = os.path.join(download_path, name)
+        entry = manifest.entries.get(name)
+        if entry is not None and name.endswith(IMAGE_EXTENSIONS) and \
+           not os.path.exists(filename):
+            # transcoded or deliberately removed since it was recorded
+            stem = os.path.splitext(name)[0]
+            if any(os.path.exists(os.path.join(download_path, stem + ext))
+                   for ext in IMAGE_EXTENSIONS):
+                manifest.remove(name)
+                updated = True
+                continue
+        if not check_file(filename, entry, full=full):
+            bad.append(name)
+        elif entry is None or \
+                os.stat(filename).st_mtime != entry['mtime']:
+            # new to the manifest, or touched but with the same content; keep
+            # the validators sync compares against
+            if entry is None:
+                manifest.add(filename)
+            else:
+                manifest.add(filename, etag=entry.get('etag'),
+                             content_length=entry.get('content_length'))
+            updated = True
+    if updated:
+        manifest.save()
+    return bad
+
+
+def _verify(args):
+    download_path, full, compression = args
+    try:
+        return download_path, verify_edition(download_path, full, compression)
+    except (OSError, zipfile.BadZipFile) as e:
+        logger.error('could not verify {0}: {1}'.format(download_path, e))
+        if not os.path.isdir(download_path) and \
+           os.path.exists(archive_path(download_path)):
+            return download_path, [os.path.basename(
+                archive_path(download_path))]
+        return download_path, []
+
+
+def verify_editions(download_paths, full=False, compression='zstd', workers=None):
+    '''Verify editions in a process pool. Yield (download_path, bad file names)
+as each edition completes.'''
+    jobs = [(path, full, compression) for path in download_paths]
+    with ProcessPoolExecutor(max_workers=workers or None) as pool:
+        for result in pool.map(_verify, jobs):
+            yield result
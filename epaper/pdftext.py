@@ -0,0 +1,181 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import logging
+import os
+import re
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+from epaper.utils import find_json, read_json, write_json
+
+# logging
+logger = logging.getLogger('pdftext')
+
+# the PDF of a page, see EPaper.page_filenames()
+PDF_FILE = re.compile(r'^page-(\d+)-highres\.pdf$')
+
+# text of the pages of an edition, {page number: text}
+TEXT_NAME = 'text.json'
+
+# pages extracted since text.json was written, one {"page", "text"} JSON
+# object per line; merged into text.json once the edition is done
+TEXT_LOG = 'text.jsonl'
+
+
+def compact_text(text):
+    '''Collapse runs of whitespace in lines and drop empty lines.'''
+    lines = (' '.join(line.split()) for line in text.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def extract_text(filename):
+    '''Return the text of a PDF file, all its pages, compacted.'''
+    reader = pypdf.PdfReader(filename)
+    return compact_text('\n'.join(page.extract_text() or ''
+                                  for page in reader.pages))
+
+
+def _extract(job):
+    # runs in a worker process
+    key, page, filename = job
+    try:
+        return key, page, extract_text(filename), None
+    except Exception as e:
+        # pypdf raises all sorts of errors on broken files
+        return key, page, None, '{0}: {1}'.format(type(e).__name__, e)
+
+
+def read_texts(download_path):
+    '''Return {page number: text} of the pages of an edition extracted so far.'''
+    path = os.path.join(download_path, TEXT_NAME)
+    texts = {}
+    if find_json(path):
+        texts.update((int(page), text) for page, text in read_json(path).items())
+    try:
+        with open(os.path.join(download_path, TEXT_LOG), encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+                texts[int(entry['page'])] = entry['text']
+    except FileNotFoundError:
+        pass
+    return texts
+
+
+class TextExtractor:
+    '''Extract the text of downloaded page PDFs in a process pool, with the pure
+Python pypdf (optional). Each page is appended to the edition's text.jsonl and
+added to the search index as it is extracted; once all pages of the edition are
+done they are merged into its compressed text.json. Pages with text are never extracted again, so an
+interrupted backfill picks up where it stopped; pages that failed are tried
+again next time. Packed editions are skipped.
+
+    '''
+
+    def __init__(self, cache_dir=None, search_index=None, workers=None,
+                 compression='zstd'):
+        if pypdf is None:
+            raise ImportError('pypdf is required for PDF text extraction')
+        self.cache_dir = cache_dir
+        self.search_index = search_index
+        self.workers = workers or None
+        self.compression = compression
+
+    @classmethod
+    def from_config(cls, app_config, search_index=None):
+        config = app_config.config['App']
+        return cls(
+            cache_dir=config['cache_dir'],
+            search_index=search_index,
+            workers=config.getint('text_workers', 0),
+            compression=config.get('metadata_compression', 'zstd')
+        )
+
+    def pending(self, key, texts):
+        '''Return [(page number, PDF filename)] of edition *key* (pub, edition,
+date) without text in *texts*.'''
+        download_path = os.path.join(self.cache_dir, *key)
+        try:
+            names = os.listdir(download_path)
+        except OSError:
+            return []
+        jobs = []
+        for name in sorted(names):
+            match = PDF_FILE.match(name)
+            if match and int(match.group(1)) not in texts:
+                jobs.append((int(match.group(1)),
+                             os.path.join(download_path, name)))
+        return jobs
+
+    def _append(self, key, page, text):
+        with open(os.path.join(self.cache_dir, *key, TEXT_LOG), 'a',
+                  encoding='utf-8') as f:
+            f.write(json.dumps({'page': page, 'text': text}) + '\n')
+
+    def _save(self, key, texts):
+        download_path = os.path.join(self.cache_dir, *key)
+        write_json(os.path.join(download_path, TEXT_NAME),
+                   dict((str(page), text) for page, text in sorted(texts.items())),
+                   compression=self.compression)
+        try:
+            os.remove(os.path.join(download_path, TEXT_LOG))
+        except FileNotFoundError:
+            pass
+
+    def run(self, keys):
+        '''Extract the text of all pages of editions *keys* that have none yet;
+the pages of all editions share the pool. Yield (key, page number, ok) as
+each page completes.'''
+        texts, jobs = {}, []
+        for key in keys:
+            texts[key] = read_texts(os.path.join(self.cache_dir, *key))
+            jobs.extend((key, page, filename)
+                        for page, filename in self.pending(key, texts[key]))
+        if not jobs:
+            return
+        logger.info('extracting text of {0} pages of {1} editions'.format(
+            len(jobs), len(set(job[0] for job in jobs))))
+        # key -> pages left to extract; editions with new text to merge
+        left, changed = {}, set()
+        for job in jobs:
+            left[job[0]] = left.get(job[0], 0) + 1
+        # not a with block: when the caller stops early, pages not started
+        # yet are dropped instead of waited for
+        pool = ProcessPoolExecutor(max_workers=self.workers)
+        futures = []
+        try:
+            futures.extend(pool.submit(_extract, job) for job in jobs)
+            for future in as_completed(futures):
+                key, page, text, error = future.result()
+                left[key] -= 1
+                if error is None:
+                    # indexing again after a crash before the append is
+                    # harmless
+                    if self.search_index is not None:
+                        self.search_index.add_page_text(*key, page=page,
+                                                        text=text)
+                    texts[key][page] = text
+                    self._append(key, page, text)
+                    changed.add(key)
+                else:
+                    logger.error('could not extract text of {0} page {1}: '
+                                 '{2}'.format('/'.join(key), page, error))
+                if left[key] == 0 and key in changed:
+                    self._save(key, texts[key])
+                    changed.discard(key)
+                yield key, page, error is None
+        finally:
+            # as shutdown(cancel_futures=True) of Python 3.9: only the pages
+            # being extracted are waited for
+            for future in futures:
+                future.cancel()
+            pool.shutdown()
+            # interrupted: merge what was extracted so far
+            for key in changed:
+                self._save(key, texts[key])
@@ -0,0 +1,125 @@
+from PIL import Image
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from epaper.transcode import resolve_image
+
+# logging
+logger = logging.getLogger('phash')
+
+# renditions that may be reused from a matching page
+DEDUPE_RENDITIONS = ('lowres', 'highres')
+
+# hashes with fewer set (or unset) bits carry too little detail to match on
+MIN_BITS = 8
+
+
+def dhash(filename, size=8):
+    '''Difference hash of an image: compare horizontally adjacent pixels of a
+(size + 1) x size grayscale thumbnail. Return a size * size bit int.'''
+    with Image.open(filename) as image:
+        pixels = numpy.asarray(
+            image.convert('L').resize((size + 1, size), Image.LANCZOS),
+            dtype=numpy.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(numpy.packbits(bits).tobytes(), 'big')
+
+
+def hamming_distances(hashes, value):
+    '''Bit distances between 64 bit *value* and each of *hashes* (uint64 array).'''
+    xor = numpy.bitwise_xor(hashes, numpy.uint64(value))
+    return numpy.unpackbits(xor.view(numpy.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def link_file(source, target):
+    '''Hard link *source* to *target*, copying if the filesystem cannot link.'''
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class PHashIndex:
+    '''Perceptual hashes of page thumbnails per publication and date, kept in
+cache_dir/phash.db. Regional editions carry many identical pages; a page whose
+thumbnail is within *threshold* bits of an already downloaded page of another
+edition of the same day can reuse that page's images.
+
+    '''
+
+    def __init__(self, cache_dir=None, threshold=4):
+        if numpy is None:
+            raise ImportError('numpy is required for perceptual hashing')
+        self.threshold = threshold
+        self.cache_dir = cache_dir
+        self.conn = sqlite3.connect(os.path.join(cache_dir, 'phash.db'),
+                                    check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS hashes ('
+                'pub_code TEXT, edition_code TEXT, date TEXT, page INTEGER, '
+                'hash INTEGER, download_path TEXT, '
+                'PRIMARY KEY (pub_code, edition_code, date, page))'
+            )
+            self.conn.commit()
+
+    def add(self, pub_code, edition_code, date_str, page, value, download_path):
+        '''Record the thumbnail hash of a page.'''
+        # sqlite integers are signed 64 bit
+        signed = value - (1 << 64) if value >= (1 << 63) else value
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                (pub_code, edition_code, date_str, page, signed,
+                 os.path.relpath(download_path, self.cache_dir))
+            )
+            self.conn.commit()
+
+    def find_match(self, pub_code, edition_code, date_str, value):
+        '''Return (download_path, page) of the closest page of another edition of
+the same publication and date within self.threshold bits, or None.'''
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT hash, download_path, page FROM hashes '
+                'WHERE pub_code=? AND date=? AND edition_code!=?',
+                (pub_code, date_str, edition_code)
+            ).fetchall()
+        if not rows:
+            return None
+        hashes = numpy.array([row[0] for row in rows], dtype=numpy.int64)
+        distances = hamming_distances(hashes.view(numpy.uint64), value)
+        best = int(numpy.argmin(distances))
+        if distances[best] > self.threshold:
+            return None
+        return (os.path.join(self.cache_dir, rows[best][1]), rows[best][2])
+
+    def reuse(self, pub_code, edition_code, date_str, value, rendition,
+              filename):
+        '''Link the *rendition* image of a matching page to *filename* (keeping the
+matched file's format). Return the linked filename, or None.'''
+        # near uniform thumbnails (blank or single colour pages) all hash alike
+        if not MIN_BITS <= bin(value).count('1') <= 64 - MIN_BITS:
+            return None
+        match = self.find_match(pub_code, edition_code, date_str, value)
+        if match is None:
+            return None
+        download_path, page = match
+        source = resolve_image(os.path.join(
+            download_path, 'page-{0:03d}-{1}.jpg'.format(page, rendition)))
+        if source is None:
+            return None
+        target = os.path.splitext(filename)[0] + os.path.splitext(source)[1]
+        link_file(source, target)
+        logger.info('reused {0} for {1}'.format(source, target))
+        return target
@@ -0,0 +1,236 @@
+from collections import namedtuple
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import logging
+import random
+import threading
+import time
+
+from epaper.logs import log_event
+from epaper.transport import TransportError
+
+# logging
+logger = logging.getLogger('retry')
+
+# attempts: total tries including the first one; delays in seconds
+Rule = namedtuple('Rule', ['attempts', 'base_delay', 'max_delay'])
+
+# error classes and their default rules, configurable in [Http] as
+# retry_<class> = attempts, base_delay, max_delay
+DEFAULT_RULES = {
+    'connect': Rule(3, 1.0, 30.0),
+    'timeout': Rule(3, 2.0, 60.0),
+    'server': Rule(3, 2.0, 60.0),
+    'throttle': Rule(5, 5.0, 120.0),
+    'corrupt': Rule(2, 0.5, 5.0),
+}
+
+# error classes that count against the health of a host
+HOST_ERRORS = ('connect', 'timeout', 'server', 'throttle')
+
+
+def classify_status(status_code):
+    '''Return the error class of an HTTP status, or None if it is not worth
+retrying (success, 304, 404, ...).'''
+    if status_code == 429:
+        return 'throttle'
+    if status_code >= 500:
+        return 'server'
+    return None
+
+
+def parse_retry_after(value):
+    '''Seconds to wait from a Retry-After header (seconds or HTTP date), or
+None.'''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitOpenError(TransportError):
+    '''A host kept failing: requests to it fail fast until it recovers.'''
+
+    def __init__(self, message=''):
+        super().__init__(message, kind='circuit')
+
+
+class CircuitBreaker:
+    '''Health of one host. After *failure_threshold* consecutive failures the
+circuit opens: requests to the host wait for a cooldown, which pauses the
+download queue instead of hammering a failing server. Then one probe request
+is let through (half-open); its success closes the circuit, its failure opens
+it again with twice the cooldown, up to *max_cooldown*. After *max_trips*
+openings in a row requests fail fast with CircuitOpenError while it is open.
+
+    '''
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, host=None, failure_threshold=5, cooldown=30.0,
+                 max_cooldown=300.0, max_trips=3):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_trips = max_trips
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.cooldown = cooldown
+        self.opened_at = 0.0
+        self._lock = threading.Condition()
+
+    def before_request(self):
+        '''Block while the circuit is open; raise CircuitOpenError instead once
+the host has tripped it max_trips times in a row.'''
+        with self._lock:
+            while True:
+                if self.state == self.CLOSED:
+                    return
+                if self.state == self.OPEN:
+                    remaining = self.opened_at + self.cooldown - time.monotonic()
+                    if remaining <= 0:
+                        # this request is the probe
+                        self.state = self.HALF_OPEN
+                        return
+                    if self.trips >= self.max_trips:
+                        raise CircuitOpenError(
+                            'circuit for {0} is open'.format(self.host))
+                    self._lock.wait(remaining)
+                else:
+                    # wait for the probe to succeed or fail
+                    if self.trips >= self.max_trips:
+                        raise CircuitOpenError(
+                            'circuit for {0} is open'.format(self.host))
+                    self._lock.wait()
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                log_event(logger, 'circuit_closed', host=self.host)
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trips = 0
+            self.cooldown = self.base_cooldown
+            self._lock.notify_all()
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            elif self.state == self.OPEN or \
+                    self.failures < self.failure_threshold:
+                return
+            self.state = self.OPEN
+            self.trips += 1
+            self.opened_at = time.monotonic()
+            log_event(logger, 'circuit_open', level=logging.WARNING,
+                      host=self.host, failures=self.failures, trips=self.trips,
+                      cooldown=self.cooldown)
+            self._lock.notify_all()
+
+
+class RetryPolicy:
+    '''Retries per error class with exponential backoff and full jitter, and a
+CircuitBreaker per host. Shared by all download threads of a Scraper.'''
+
+    def __init__(self, rules=None, failure_threshold=5, cooldown=30.0,
+                 max_cooldown=300.0, max_trips=3):
+        self.rules = dict(DEFAULT_RULES)
+        self.rules.update(rules or {})
+        self.breaker_options = dict(
+            failure_threshold=failure_threshold, cooldown=cooldown,
+            max_cooldown=max_cooldown, max_trips=max_trips)
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, app_config):
+        '''Build the policy from the [Http] config section.'''
+        http = app_config.config['Http']
+        rules = {}
+        for error_class, default in DEFAULT_RULES.items():
+            value = http.get('retry_' + error_class)
+            if not value:
+                continue
+            try:
+                attempts, base_delay, max_delay = value.split(',')
+                rules[error_class] = Rule(int(attempts), float(base_delay),
+                                          float(max_delay))
+            except ValueError:
+                logger.error('invalid retry_{0} = {1}, using {2}'.format(
+                    error_class, value, ','.join(map(str, default))))
+        return cls(
+            rules=rules,
+            failure_threshold=http.getint('circuit_failures', 5),
+            cooldown=http.getfloat('circuit_cooldown', 30),
+            max_cooldown=http.getfloat('circuit_max_cooldown', 300),
+            max_trips=http.getint('circuit_max_trips', 3)
+        )
+
+    def breaker(self, url):
+        '''Return the CircuitBreaker of the host of *url*.'''
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(host=host,
+                                                      **self.breaker_options)
+            return self._breakers[host]
+
+    def delay(self, error_class, attempt, retry_after=None):
+        '''Seconds to wait before retry number *attempt* (1 based): a random
+delay up to base_delay * 2 ** (attempt - 1), capped at max_delay. A server's
+Retry-After is honoured, also capped.'''
+        rule = self.rules[error_class]
+        if retry_after is not None:
+            return min(retry_after, rule.max_delay)
+        return random.uniform(
+            0, min(rule.max_delay, rule.base_delay * 2 ** (attempt - 1)))
+
+    def run(self, url, attempt):
+        '''Call *attempt*() until it succeeds or its error class runs out of
+tries. attempt() returns (error class or None, result, retry_after or None).
+Return the result of the last call. Transport errors of the last attempt are
+re-raised; CircuitOpenError is raised without calling attempt() at all.'''
+        breaker = self.breaker(url)
+        tries = {}
+        while True:
+            breaker.before_request()
+            # every outcome is recorded, any unexpected exception as a failure:
+            # otherwise a probe that raised would leave the circuit half-open
+            # and its waiters blocked for good
+            error_class = 'connect'
+            try:
+                error_class, result, retry_after = attempt()
+                error = None
+            except CircuitOpenError:
+                raise
+            except TransportError as e:
+                error_class = e.kind if e.kind in self.rules else 'connect'
+                result, retry_after, error = None, None, e
+            finally:
+                if error_class in HOST_ERRORS:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            if error_class is None:
+                return result
+
+            tries[error_class] = tries.get(error_class, 0) + 1
+            if tries[error_class] >= self.rules[error_class].attempts:
+                if error is not None:
+                    raise error
+                return result
+            wait = self.delay(error_class, tries[error_class], retry_after)
+            log_event(logger, 'http_retry', url=url, error=error_class,
+                      attempt=tries[error_class], delay=round(wait, 2))
+            time.sleep(wait)
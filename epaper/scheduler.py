@@ -0,0 +1,280 @@
+from collections import deque, namedtuple
+from datetime import datetime, timedelta
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from epaper.logs import log_event
+
+# logging
+logger = logging.getLogger('scheduler')
+
+# renditions in download priority order; each one is a tier
+TIERS = ('thumbnail', 'lowres', 'highres')
+
+# a single (page, rendition) download
+Job = namedtuple('Job', ['page_number', 'rendition', 'url', 'filename'])
+
+# share of the time left to a deadline that the remaining downloads may take
+DEADLINE_MARGIN = 0.9
+
+
+def parse_deadline(value, now=None):
+    '''Return the epoch time of the next HH:MM local time after *now* (a
+datetime, default now), or None for an empty value.'''
+    if not value:
+        return None
+    now = now or datetime.now()
+    clock = datetime.strptime(value.strip(), '%H:%M')
+    deadline = now.replace(hour=clock.hour, minute=clock.minute, second=0,
+                           microsecond=0)
+    if deadline <= now:
+        deadline += timedelta(days=1)
+    return deadline.timestamp()
+
+
+class ThroughputMeter:
+    '''Bytes per second downloaded by all workers together over the last
+*window* seconds.'''
+
+    def __init__(self, window=30.0):
+        self.window = window
+        self.start = time.monotonic()
+        # (monotonic time, bytes) of finished downloads
+        self._samples = deque()
+
+    def add(self, nbytes):
+        self._samples.append((time.monotonic(), nbytes))
+
+    def rate(self):
+        '''Return bytes per second, or None before the first download.'''
+        now = time.monotonic()
+        while self._samples and self._samples[0][0] < now - self.window:
+            self._samples.popleft()
+        if not self._samples:
+            return None
+        elapsed = now - max(self.start, now - self.window)
+        return sum(nbytes for _, nbytes in self._samples) / max(elapsed, 0.001)
+
+
+class DownloadScheduler:
+    '''Priority queue of page downloads worked by a pool of threads. The thumbnail
+of every page is fetched before any lowres image, and all lowres images before
+any highres one, so an edition becomes browsable as early as possible. Pages
+being viewed can be bumped ahead of everything else with bump().
+
+run_job(job) performs a download and returns True on success, or None if the
+job is leased by another worker; deferred jobs are retried every
+*retry_interval* seconds once the queue has drained. Callbacks:
+
+    on_job_done(job, ok)   after every job
+    on_tier_complete(tier) once no job of that rendition is pending
+
+With a *deadline* (epoch seconds) the queue is planned against the throughput
+of the run, fed by transferred(), and job_size(job), the expected bytes of a
+job. When the pending jobs would not finish in time, jobs of the last tiers,
+e.g. highres and then lowres images, are postponed from the last page forward:
+they leave the queue, so every page gets at least the renditions that fit. They
+come back if the throughput recovers. The first tier is never postponed.
+postponed() returns the jobs left for a pass after the run.
+
+    '''
+
+    def __init__(self, run_job=None, workers=4, tiers=TIERS,
+                 on_job_done=None, on_tier_complete=None, retry_interval=5,
+                 deadline=None, job_size=None, plan_interval=1.0):
+        self.run_job = run_job
+        self.workers = max(1, workers)
+        self.tiers = tiers
+        self.on_job_done = on_job_done
+        self.on_tier_complete = on_tier_complete
+        self.retry_interval = retry_interval
+        self.deadline = deadline
+        self.job_size = job_size
+        self.plan_interval = plan_interval
+        self.meter = ThroughputMeter()
+        # tier -> jobs taken out of the queue to meet the deadline
+        self._postponed = dict((tier, []) for tier in tiers)
+        self._planned_at = 0.0
+
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Condition()
+        # job -> current heap entry, jobs not listed here are taken or done
+        self._pending = {}
+        # page_number -> position in toc
+        self._page_order = {}
+        # tier -> jobs not finished yet
+        self._remaining = dict((tier, 0) for tier in tiers)
+        # jobs another worker holds a lease for
+        self._deferred = []
+        self._running = 0
+        # jobs being downloaded
+        self._taken = set()
+        self._cancelled = False
+
+    def _push(self, job, boost=0):
+        entry = [boost, self.tiers.index(job.rendition),
+                 self._page_order[job.page_number], next(self._counter), job]
+        self._pending[job] = entry
+        heapq.heappush(self._heap, entry)
+
+    def add(self, job):
+        '''Queue a Job; renditions not in self.tiers are ignored.'''
+        if job.rendition not in self.tiers:
+            return
+        with self._lock:
+            self._page_order.setdefault(job.page_number, len(self._page_order))
+            self._remaining[job.rendition] += 1
+            self._push(job)
+            self._lock.notify()
+
+    def bump(self, page_number):
+        '''Move pending jobs of *page_number* to the top of the queue, still in tier
+order among themselves.'''
+        with self._lock:
+            for job, entry in list(self._pending.items()):
+                if job.page_number == page_number and entry[0] == 0:
+                    # invalidate the old heap entry, it is skipped when popped
+                    entry[-1] = None
+                    self._push(job, boost=-1)
+            self._lock.notify_all()
+
+    def cancel(self):
+        '''Drop all pending jobs; running jobs are allowed to finish.'''
+        with self._lock:
+            self._cancelled = True
+            self._heap = []
+            self._pending = {}
+            self._deferred = []
+            self._lock.notify_all()
+
+    def transferred(self, nbytes):
+        '''Record the size of a finished download for the throughput.'''
+        with self._lock:
+            self.meter.add(nbytes)
+
+    def postponed(self):
+        '''Return the jobs postponed to meet the deadline.'''
+        with self._lock:
+            return [job for tier in self.tiers for job in self._postponed[tier]]
+
+    def _plan(self):
+        # called with the lock held
+        now = time.monotonic()
+        if self.deadline is None or self._cancelled or \
+           now - self._planned_at < self.plan_interval:
+            return
+        self._planned_at = now
+        rate = self.meter.rate()
+        if rate is None:
+            return
+        budget = (self.deadline - time.time()) * DEADLINE_MARGIN * rate
+        # a single download gets about its share of the throughput only
+        share = budget / self.workers
+        # running jobs cannot be postponed
+        total = sum(self.job_size(job) for job in self._taken)
+        full = False
+        for i, tier in enumerate(self.tiers):
+            # front pages keep their renditions, the last ones are postponed
+            jobs = sorted(
+                [job for job in self._pending if job.rendition == tier] +
+                self._postponed[tier],
+                key=lambda job: self._page_order[job.page_number])
+            keep, postpone = [], []
+            for job in jobs:
+                size = self.job_size(job)
+                if i == 0 or (not full and total + size <= budget and
+                              size <= share):
+                    total += size
+                    keep.append(job)
+                else:
+                    full = True
+                    postpone.append(job)
+            postponed = set(self._postponed[tier])
+            dropped = [job for job in postpone if job not in postponed]
+            restored = [job for job in keep if job in postponed]
+            for job in dropped:
+                # invalidate the heap entry, it is skipped when popped
+                self._pending.pop(job)[-1] = None
+            for job in restored:
+                self._push(job)
+            self._remaining[tier] += len(restored) - len(dropped)
+            self._postponed[tier] = postpone
+            if dropped or restored:
+                log_event(logger, 'deadline_plan', tier=tier,
+                          postponed=len(dropped), restored=len(restored),
+                          rate=int(rate), budget=int(budget))
+
+    def _next_job(self):
+        with self._lock:
+            while True:
+                self._plan()
+                while self._heap:
+                    job = heapq.heappop(self._heap)[-1]
+                    if job is not None:
+                        del self._pending[job]
+                        self._taken.add(job)
+                        self._running += 1
+                        return job
+                if self._cancelled or \
+                   (self._running == 0 and not self._deferred):
+                    self._lock.notify_all()
+                    return None
+                if self._running == 0:
+                    # only jobs leased by other workers are left: wait for
+                    # them to finish, or for their leases to go stale.
+                    self._lock.wait(self.retry_interval)
+                    if self._heap or self._running:
+                        continue
+                    deferred, self._deferred = self._deferred, []
+                    for job in deferred:
+                        self._push(job)
+                    continue
+                self._lock.wait()
+
+    def _defer(self, job):
+        with self._lock:
+            self._taken.discard(job)
+            self._running -= 1
+            self._deferred.append(job)
+            self._lock.notify_all()
+
+    def _finish(self, job, ok):
+        if self.on_job_done:
+            self.on_job_done(job, ok)
+        with self._lock:
+            self._taken.discard(job)
+            self._running -= 1
+            self._remaining[job.rendition] -= 1
+            tier_complete = self._remaining[job.rendition] == 0 and \
+                not self._postponed[job.rendition] and not self._cancelled
+            self._lock.notify_all()
+        if tier_complete and self.on_tier_complete:
+            self.on_tier_complete(job.rendition)
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                ok = self.run_job(job)
+            except Exception:
+                logger.exception('download failed: {0}'.format(job.url))
+                ok = False
+            if ok is None:
+                self._defer(job)
+            else:
+                self._finish(job, ok)
+
+    def run(self):
+        '''Work the queue on self.workers threads until it is empty.'''
+        threads = [threading.Thread(target=self._work, daemon=True)
+                   for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
@@ -1,14 +1,38 @@
-from PIL import Image
+from PIL import Image, ImageFile
 from bs4 import BeautifulSoup
 from io import BytesIO
+import json
 import logging
 import random
-import requests
 import time
 
+from epaper.logs import log_event
+from epaper.retry import RetryPolicy, classify_status, parse_retry_after
+from epaper.transport import ACCEPT_ENCODING, TransportError, make_transport
+from epaper.utils import atomic_path
+
 # logging
 logger = logging.getLogger('scraper')
 
+# read size for streamed response bodies
+CHUNK_SIZE = 64 * 1024
+
+
+class CorruptImageError(Exception):
+    '''A streamed image that does not decode.'''
+
+
+def _check_image(parser, chunk=None):
+    '''Feed *chunk* to ImageFile.Parser *parser*, or with no chunk check that
+the image is complete.'''
+    try:
+        if chunk is None:
+            parser.close()
+        else:
+            parser.feed(chunk)
+    except (IOError, SyntaxError, ValueError) as e:
+        raise CorruptImageError(str(e))
+
 
 class Scraper:
     '''Class encapsulating all scraping related activity.'''
@@ -25,12 +49,15 @@ class Scraper:
 
         self.repository_uri_template = 'Repository/{pub_code:s}/{edition_code:s}/{date:s}'
 
-        # requests session object
-        self.session = requests.Session()
-
         # user-agent
         self.user_agent = app_config.config['Http']['user_agent']
 
+        # HTTP transport selected in [Http] config section
+        self.transport = make_transport(app_config)
+
+        # retries and per-host circuit breakers, see epaper.retry
+        self.retry_policy = RetryPolicy.from_config(app_config)
+
     def _build_repository_uri(self, pub_code=None, edition_code=None, date_str=None):
         '''Return formatted repository uri path.'''
         return self.repository_uri_template.format(
@@ -52,8 +79,9 @@ class Scraper:
         ])
 
     def build_page_urls(self, pub_code=None, edition_code=None,
-                        date_str=None, page_folder=None):
-        '''Return formatted page urls to be downloaded.'''
+                        date_str=None, page_folder=None, with_pdf=True):
+        '''Return formatted page urls to be downloaded. The PDF file name needs a
+page.json request, skipped unless *with_pdf*.'''
         page_url = '/'.join([
             self.site_url,
             self._build_repository_uri(
@@ -66,7 +94,7 @@ class Scraper:
 
         # if we have a valid page_url, get PDF file name
         pdf_url = None
-        res = self.fetch(page_url + '/page.json')
+        res = self.fetch(page_url + '/page.json') if with_pdf else None
         if res:
             pdf_url = page_url + '/' + res['pdf']
 
@@ -78,59 +106,225 @@ class Scraper:
             'pdf': [pdf_url, None, False]
         }
 
-    def fetch(self, url, delay=False):
-        '''GET a URL resource once with sleep deplay.'''
+    def _get(self, url, headers=None):
+        '''GET a URL; text resources are requested compressed and decoded while
+the body streams in. Timeouts, connection errors, 5xx and 429 responses are
+retried as self.retry_policy says. Return (status_code, response headers,
+body), or None if the request failed.'''
+        request_headers = {'Accept-Encoding': ACCEPT_ENCODING}
+        request_headers.update(headers or {})
+
+        def attempt():
+            start = time.monotonic()
+            body = b''
+            with self.transport.stream(url, headers=request_headers) as res:
+                status_code = res.status_code
+                response_headers = dict(
+                    (k.lower(), v) for k, v in res.headers.items())
+                if status_code == 200:
+                    body = b''.join(res.iter_content(CHUNK_SIZE))
+            log_event(logger, 'http_request', sampled=True, url=url,
+                      status=status_code,
+                      content_type=response_headers.get('content-type', ''),
+                      bytes=len(body), elapsed=round(time.monotonic() - start, 3))
+            return (classify_status(status_code),
+                    (status_code, response_headers, body),
+                    parse_retry_after(response_headers.get('retry-after')))
+
+        try:
+            return self.retry_policy.run(url, attempt)
+        except TransportError as e:
+            logger.error('could not retrieve {0}: {1}'.format(url, e))
+            return None
+
+    def _decode(self, content_type, body):
+        if content_type.startswith('text/html'):
+            return BeautifulSoup(body, 'html.parser')
+        if content_type.startswith('application/json'):
+            return json.loads(body)
+        else:
+            # probably an image
+            return body
+
+    def fetch(self, url, delay=False, response_headers=None):
+        '''GET a URL resource once with sleep deplay. If given, the
+*response_headers* dict is updated with the (lower-cased) response headers.'''
         if delay:
             # Be nice; sleep for 5 to 15 seconds between requests
             # XXX: fix the config part soon
             sleep_for = random.randint(5, 15)
             time.sleep(sleep_for)
-        # fetch
-        res = self.session.get(url, headers={'User-Agent': self.user_agent})
-        if res.status_code == 200:
-            content_type = res.headers.get('content-type')
-            logger.info(f'XXX - {content_type}')
-            if content_type.startswith('text/html'):
-                return BeautifulSoup(res.text, 'html.parser')
-            if content_type.startswith('application/json'):
-                return res.json()
-            else:
-                # probably an image
-                return res.content
+        res = self._get(url)
+        if res is None:
+            return None
+        status_code, headers, body = res
+        if response_headers is not None:
+            response_headers.update(headers)
+        if status_code == 200:
+            return self._decode(headers.get('content-type', ''), body)
         else:
-            # for h in res.request.headers:
-            #    logger.info(f'XXX - {h} = {res.request.headers[h]}')
             logger.error('could not retrieve {0}'.format(url))
             return None
 
-    def save_image(self, url, save_to_file, retry_limit=1, delay=True):
-        '''Fetch given URL and save the image with specified retry attempts and random
-delay between requests.'''
+    def fetch_conditional(self, url, validators=None):
+        '''GET a URL resource unless it is unchanged since *validators* (a dict with
+etag and/or last_modified from an earlier response). Return (status_code, data,
+validators); data is None unless status_code is 200, status_code is None if the
+request failed.'''
+        validators = validators or {}
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        res = self._get(url, headers=headers)
+        if res is None:
+            return (None, None, validators)
+        status_code, response_headers, body = res
+        if status_code == 304:
+            return (304, None, validators)
+        new_validators = {
+            'etag': response_headers.get('etag'),
+            'last_modified': response_headers.get('last-modified'),
+        }
+        data = None
+        if status_code == 200:
+            data = self._decode(response_headers.get('content-type', ''), body)
+        return (status_code, data, new_validators)
+
+    def _head(self, url):
+        def attempt():
+            res = self.transport.head(url)
+            return (classify_status(res.status_code), res,
+                    parse_retry_after(res.headers.get('retry-after')))
+
+        try:
+            return self.retry_policy.run(url, attempt)
+        except TransportError as e:
+            logger.error('could not retrieve {0}: {1}'.format(url, e))
+            return None
+
+    def head(self, url):
+        '''HEAD a URL resource, return the lower-cased response headers, or None if
+the request failed.'''
+        res = self._head(url)
+        if res is None:
+            return None
+        if res.status_code != 200:
+            logger.error('could not retrieve {0}'.format(url))
+            return None
+        return dict((k.lower(), v) for k, v in res.headers.items())
+
+    def exists(self, url):
+        '''HEAD a URL resource: return True if it exists, False if the server says
+it does not, None if that could not be found out.'''
+        res = self._head(url)
+        if res is None:
+            return None
+        if res.status_code == 200:
+            return True
+        if res.status_code in (404, 410):
+            return False
+        return None
+
+    def save_image(self, url, save_to_file, retry_limit=None, delay=True,
+                   response_headers=None):
+        '''Fetch given URL and save the image with random delay between requests.
+Images that do not decode are fetched again up to *retry_limit* times in all,
+default from the corrupt rule of self.retry_policy, with backoff; failed
+requests are retried by fetch() already. See fetch() for *response_headers*.
+Return (saved, attempts).'''
         retry_count = 1
 
         if not save_to_file:
             return (False, retry_count)
 
-        while retry_count <= retry_limit:
-            content = self.fetch(url, delay=delay)
-            if content and isinstance(content, bytes):
-                try:
-                    image = Image.open(BytesIO(content))
-                    image.save(save_to_file)
-                    break
-                except IOError as e:
-                    retry_count += 1
-                    if retry_count > retry_limit:
-                        # retries are HTTP success but image has format errors.
-                        with open(save_to_file + '.dump', 'wb') as f:
-                            f.write(content)
-            else:
-                retry_count += 1
-
-        if retry_count > retry_limit:
-            return (False, retry_count)
-        else:
-            return (True, retry_count)
+        if retry_limit is None:
+            retry_limit = self.retry_policy.rules['corrupt'].attempts
+        while True:
+            content = self.fetch(url, delay=delay,
+                                 response_headers=response_headers)
+            if not content or not isinstance(content, bytes):
+                return (False, retry_count)
+            try:
+                image = Image.open(BytesIO(content))
+                with atomic_path(save_to_file) as temp:
+                    image.save(temp)
+                return (True, retry_count)
+            except IOError:
+                if retry_count >= retry_limit:
+                    # retries are HTTP success but image has format errors.
+                    with open(save_to_file + '.dump', 'wb') as f:
+                        f.write(content)
+                    return (False, retry_count)
+            wait = self.retry_policy.delay('corrupt', retry_count)
+            log_event(logger, 'http_retry', url=url, error='corrupt',
+                      attempt=retry_count, delay=round(wait, 2))
+            time.sleep(wait)
+            retry_count += 1
+
+    def save_file(self, url, save_to_file, delay=True, response_headers=None):
+        '''Fetch given URL and save the response body as is, e.g. a PDF. See fetch()
+for *response_headers*.'''
+        if not url or not save_to_file:
+            return False
+        content = self.fetch(url, delay=delay, response_headers=response_headers)
+        if content and isinstance(content, bytes):
+            with atomic_path(save_to_file) as temp:
+                with open(temp, 'wb') as fd:
+                    fd.write(content)
+            return True
+        return False
+
+    def stream_to_storage(self, url, storage, key, image=True,
+                          response_headers=None):
+        '''Stream the body of given URL to *key* of *storage* (see epaper.storage)
+chunk by chunk, e.g. straight into a multipart upload, without holding it all
+in memory. With *image* the image is decoded as it arrives, and a corrupt one
+is not stored but fetched again as in save_image(). Requests are retried as in
+fetch(). See fetch() for *response_headers*. Return True if stored.'''
+        if not url or not key:
+            return False
+
+        def attempt():
+            start = time.monotonic()
+            size = 0
+            with self.transport.stream(url) as res:
+                status_code = res.status_code
+                headers = dict((k.lower(), v) for k, v in res.headers.items())
+                error_class = classify_status(status_code)
+                if status_code == 200:
+                    parser = ImageFile.Parser() if image else None
+                    try:
+                        with storage.writer(key) as fd:
+                            for chunk in res.iter_content(CHUNK_SIZE):
+                                fd.write(chunk)
+                                size += len(chunk)
+                                if parser is not None:
+                                    _check_image(parser, chunk)
+                            if parser is not None:
+                                _check_image(parser)
+                    except CorruptImageError as e:
+                        logger.error('corrupt image {0}: {1}'.format(url, e))
+                        error_class = 'corrupt'
+            log_event(logger, 'http_request', sampled=True, url=url,
+                      status=status_code,
+                      content_type=headers.get('content-type', ''),
+                      bytes=size, elapsed=round(time.monotonic() - start, 3))
+            return (error_class, (status_code, headers, error_class is None),
+                    parse_retry_after(headers.get('retry-after')))
+
+        try:
+            res = self.retry_policy.run(url, attempt)
+        except TransportError as e:
+            logger.error('could not retrieve {0}: {1}'.format(url, e))
+            return False
+        status_code, headers, stored = res
+        if response_headers is not None:
+            response_headers.update(headers)
+        if not stored:
+            logger.error('could not retrieve {0}'.format(url))
+        return stored and status_code == 200
 
     def parse_publication_codes(self, doc):
         '''Find tag with id='Publications', parse the HTML to obtain tuple of
@@ -0,0 +1,150 @@
+from collections import namedtuple
+import logging
+import os
+import sqlite3
+import threading
+
+# logging
+logger = logging.getLogger('search')
+
+# a single search result
+Hit = namedtuple('Hit', ['pub_code', 'edition_code', 'date', 'page', 'title'])
+
+
+class SearchIndex:
+    '''Incremental full-text index of page titles over the disk cache. Editions are
+added once, from their toc.json, as they finish downloading; queries never scan
+the cache. The text of pages, extracted from their PDFs by epaper.pdftext, is
+added page by page. Uses SQLite FTS5 when available and a plain LIKE scan
+otherwise. The connection is shared by the download threads, under a lock.
+
+    '''
+
+    def __init__(self, cache_dir=None):
+        self.db_file = os.path.join(cache_dir, 'search.db')
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS editions ('
+            'pub_code TEXT, edition_code TEXT, date TEXT, '
+            'PRIMARY KEY (pub_code, edition_code, date))'
+        )
+        try:
+            self.conn.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS pages USING fts5('
+                'title, pub_code UNINDEXED, edition_code UNINDEXED, '
+                'date UNINDEXED, page UNINDEXED)'
+            )
+            self.conn.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS texts USING fts5('
+                'text, pub_code UNINDEXED, edition_code UNINDEXED, '
+                'date UNINDEXED, page UNINDEXED)'
+            )
+            self.fts = True
+        except sqlite3.OperationalError:
+            logger.info('sqlite3 without FTS5, falling back to LIKE queries')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS pages ('
+                'title TEXT, pub_code TEXT, edition_code TEXT, '
+                'date TEXT, page INTEGER)'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS texts ('
+                'text TEXT, pub_code TEXT, edition_code TEXT, '
+                'date TEXT, page INTEGER)'
+            )
+            self.fts = False
+        self.conn.commit()
+
+    def has_edition(self, pub_code=None, edition_code=None, date_str=None):
+        '''Return True if the edition is already indexed.'''
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT 1 FROM editions WHERE pub_code=? AND edition_code=? AND '
+                'date=?', (pub_code, edition_code, date_str)
+            ).fetchone()
+        return row is not None
+
+    def add_edition(self, pub_code=None, edition_code=None, date_str=None,
+                    toc_dict=None):
+        '''Index page titles of an edition from its toc dict. Editions already in the
+index are skipped. Return True if the edition was added.'''
+        if not toc_dict or 'toc' not in toc_dict:
+            return False
+        rows = [
+            (page.get('page_title', ''), pub_code, edition_code, date_str,
+             int(page['page']))
+            for page in toc_dict['toc']
+        ]
+        with self._lock, self.conn:
+            # another thread or process may be adding the same edition
+            added = self.conn.execute(
+                'INSERT OR IGNORE INTO editions VALUES (?, ?, ?)',
+                (pub_code, edition_code, date_str)
+            ).rowcount
+            if added:
+                self.conn.executemany(
+                    'INSERT INTO pages (title, pub_code, edition_code, date, '
+                    'page) VALUES (?, ?, ?, ?, ?)', rows
+                )
+        return bool(added)
+
+    def add_page_text(self, pub_code=None, edition_code=None, date_str=None,
+                      page=None, text=''):
+        '''Index the text of one page, replacing text indexed for it before.'''
+        with self._lock, self.conn:
+            self.conn.execute(
+                'DELETE FROM texts WHERE pub_code=? AND edition_code=? AND '
+                'date=? AND page=?', (pub_code, edition_code, date_str, page)
+            )
+            self.conn.execute(
+                'INSERT INTO texts (text, pub_code, edition_code, date, page) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (text, pub_code, edition_code, date_str, page)
+            )
+
+    def search(self, query, pub_code=None, edition_code=None, limit=50,
+               text=False):
+        '''Return a list of Hit for pages whose title matches *query*, newest
+editions first. With *text* the text of pages is searched instead, and the
+title of a Hit is an excerpt of the text around the match.'''
+        if text and self.fts:
+            column = "snippet(texts, 0, '[', ']', '...', 12)"
+            where, args = ['texts MATCH ?'], [query]
+        elif text:
+            column = 'substr(text, max(1, instr(lower(text), lower(?)) - 40), 100)'
+            where, args = ['text LIKE ?'], ['%{0}%'.format(query)]
+        elif self.fts:
+            column = 'title'
+            where, args = ['pages MATCH ?'], [query]
+        else:
+            column = 'title'
+            where, args = ['title LIKE ?'], ['%{0}%'.format(query)]
+        if pub_code:
+            where.append('pub_code = ?')
+            args.append(pub_code)
+        if edition_code:
+            where.append('edition_code = ?')
+            args.append(edition_code)
+        sql = ('SELECT pub_code, edition_code, date, page, {0} FROM {1} '
+               'WHERE {2} ORDER BY date DESC, page LIMIT ?').format(
+                   column, 'texts' if text else 'pages', ' AND '.join(where))
+        if text and not self.fts:
+            # the query is also used to find the excerpt
+            args.insert(0, query)
+        with self._lock:
+            try:
+                rows = self.conn.execute(sql, args + [limit]).fetchall()
+            except sqlite3.OperationalError:
+                # not a valid FTS5 expression, search for the words literally
+                args[0] = ' '.join('"{0}"'.format(word.replace('"', '""'))
+                                   for word in query.split())
+                rows = self.conn.execute(sql, args + [limit]).fetchall()
+        if text:
+            # excerpts on one line
+            rows = [row[:4] + (' '.join(row[4].split()),) for row in rows]
+        return [Hit(*row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,88 @@
+import logging
+import re
+
+# logging
+logger = logging.getLogger('selection')
+
+# all downloadable renditions of a page, see Scraper.build_page_urls()
+RENDITIONS = ('thumbnail', 'lowres', 'highres', 'pdf')
+
+
+def parse_page_ranges(spec):
+    '''Parse a page range spec like "1-12,15,20-" into a list of (first, last)
+tuples; last is None for open ranges. An empty spec selects all pages.'''
+    ranges = []
+    for part in (spec or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if '-' in part:
+                first, last = part.split('-', 1)
+                ranges.append((int(first or 1), int(last) if last else None))
+            else:
+                ranges.append((int(part), int(part)))
+        except ValueError:
+            raise ValueError('invalid page range: {0}'.format(part))
+    return ranges
+
+
+class PageSelection:
+    '''Which pages and renditions of an edition to download. Pages are filtered
+by number and by page_title from toc.json, before any per-page request is
+made, so skipped pages cost nothing.
+
+    pages       page ranges, e.g. "1-12,15"
+    include     regex, only pages whose title matches
+    exclude     regex, skip pages whose title matches, e.g. "Classifieds"
+    renditions  comma separated subset of thumbnail,lowres,highres,pdf
+
+    '''
+
+    def __init__(self, pages='', include='', exclude='',
+                 renditions='thumbnail,lowres,highres'):
+        self.page_ranges = parse_page_ranges(pages)
+        self.include = re.compile(include, re.IGNORECASE) if include else None
+        self.exclude = re.compile(exclude, re.IGNORECASE) if exclude else None
+        self.renditions = tuple(
+            r for r in RENDITIONS
+            if r in [x.strip() for x in renditions.split(',')]
+        )
+        if not self.renditions:
+            raise ValueError('no valid renditions in: {0}'.format(renditions))
+
+    @classmethod
+    def from_config(cls, app_config, **overrides):
+        '''Build from the [Selection] config section; *overrides* that are not
+None take precedence, e.g. command line options.'''
+        section = app_config.config['Selection'] \
+            if 'Selection' in app_config.config else {}
+        kwargs = dict(
+            (key, section.get(key, default))
+            for key, default in (('pages', ''), ('include', ''),
+                                 ('exclude', ''),
+                                 ('renditions', 'thumbnail,lowres,highres'))
+        )
+        kwargs.update((k, v) for k, v in overrides.items() if v is not None)
+        return cls(**kwargs)
+
+    @property
+    def pdf(self):
+        return 'pdf' in self.renditions
+
+    def selects_page(self, number, title=''):
+        '''Return True if page *number* with *title* is selected.'''
+        if self.page_ranges and not any(
+                first <= number and (last is None or number <= last)
+                for first, last in self.page_ranges):
+            return False
+        if self.include and not self.include.search(title or ''):
+            return False
+        if self.exclude and self.exclude.search(title or ''):
+            return False
+        return True
+
+    def filter_toc(self, toc):
+        '''Return the selected entries of a toc.json page list.'''
+        return [page for page in toc
+                if self.selects_page(int(page['page']), page.get('page_title', ''))]
@@ -0,0 +1,305 @@
+from email.utils import formatdate
+import asyncio
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+import threading
+from urllib.parse import unquote, urlsplit
+
+from epaper.epaper import EPaper
+from epaper.watcher import CacheWatcher
+
+# logging
+logger = logging.getLogger('server')
+
+# page files: page-NNN-<rendition>.<ext>. sync rewrites pages that changed
+# under the same name, so clients may cache them only for a while and then
+# revalidate with the ETag
+PAGE_FILE = re.compile(r'^page-\d+-\w+\.(jpg|webp|avif|pdf)$')
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+REASONS = {
+    200: 'OK',
+    206: 'Partial Content',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    416: 'Range Not Satisfiable',
+}
+
+
+def file_etag(size, mtime_ns, base=0):
+    '''Return the ETag of a file of *size* bytes, at offset *base* of an edition
+archive for files of packed editions.'''
+    if base:
+        return '"{0:x}-{1:x}-{2:x}"'.format(size, mtime_ns, base)
+    return '"{0:x}-{1:x}"'.format(size, mtime_ns)
+
+
+def parse_range(value, size):
+    '''Return (first, last) byte positions of a single byte range Range header
+*value* for a file of *size* bytes, or None to send the whole file (no header,
+or one not supported). Raise ValueError if the range cannot be satisfied.'''
+    match = RANGE.match(value or '')
+    if not match:
+        return None
+    first, last = match.groups()
+    if first:
+        offset = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    elif last:
+        offset = max(0, size - int(last))
+        end = size - 1
+    else:
+        offset, end = 0, -1
+    if offset >= size or end < offset:
+        raise ValueError('range {0} of {1} bytes'.format(value, size))
+    return offset, end
+
+
+class CacheServer:
+    '''Serve the disk cache to display clients on the LAN over HTTP/1.1.
+
+    GET /index.json      editions and their pages, see EPaper.build_catalog()
+    GET /<pub>/<edition>/<date>/<file>
+
+Files are sent with sendfile(), with ETag/If-None-Match and single byte Range
+support; clients may cache page files for *max_age* seconds, then revalidate
+them. Files of packed editions are sent straight from the edition archive. The
+index is built once and then updated
+edition by edition as a CacheWatcher reports changes (polling every
+*watch_interval* seconds without inotify); editions added to the cache are also
+added to the search index. As changes made over NFS by other hosts are not
+seen by inotify, the index is still rebuilt every *index_interval* seconds.
+
+    '''
+
+    def __init__(self, publisher=None, app_config=None, host='127.0.0.1',
+                 port=8080, index_interval=300, watch_interval=5, max_age=300):
+        self.epaper = EPaper(publisher=publisher, app_config=app_config)
+        self.cache_dir = os.path.realpath(app_config.config['App']['cache_dir'])
+        self.host = host
+        self.port = port
+        self.index_interval = index_interval
+        self.watch_interval = watch_interval
+        self.max_age = max_age
+        self.index = b''
+        self.index_etag = ''
+        # (pub, edition, date): EPaper.describe_pub() of the edition
+        self.catalog = {}
+        self._catalog_lock = threading.Lock()
+        # editions changed since the index was last updated
+        self._dirty = set()
+        self.watcher = None
+
+    def _publish(self):
+        editions = [self.catalog[key] for key in sorted(self.catalog)]
+        self.index = json.dumps({'editions': editions}).encode('utf-8')
+        self.index_etag = '"{0}"'.format(hashlib.sha1(self.index).hexdigest())
+
+    def refresh_index(self):
+        '''Rebuild the JSON index from the cache metadata.'''
+        with self._catalog_lock:
+            self.catalog = dict(
+                ((e['pub_code'], e['edition_code'], e['date']), e)
+                for e in self.epaper.build_catalog())
+            self._publish()
+
+    def update_editions(self, keys):
+        '''Update the index entries of editions (pub, edition, date) only.'''
+        with self._catalog_lock:
+            for key in keys:
+                if key not in self.watcher.editions:
+                    self.catalog.pop(key, None)
+                    continue
+                self.catalog[key] = self.epaper.describe_pub(*key)
+                if not self.epaper.search_index.has_edition(*key):
+                    # e.g. downloaded by another process or host
+                    toc, metadata = self.epaper.load_pub(*key)
+                    if toc is not None:
+                        self.epaper.search_index.add_edition(*key,
+                                                             toc_dict=toc)
+            self._publish()
+
+    def _on_cache_event(self, event):
+        '''Runs on the event loop; bursts of events (a page download writes three
+files) are coalesced into one index update.'''
+        flush = not self._dirty
+        self._dirty.add((event.pub_code, event.edition_code, event.date))
+        if flush:
+            asyncio.get_running_loop().call_later(
+                0.5, lambda: asyncio.ensure_future(self._flush()))
+
+    async def _flush(self):
+        keys, self._dirty = self._dirty, set()
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.update_editions, keys)
+
+    async def _refresh_periodically(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.index_interval)
+            await loop.run_in_executor(None, self.refresh_index)
+
+    def _resolve(self, path):
+        '''Map a request path to (file in the cache directory, offset, size), or
+None. Files of packed editions are byte ranges of the edition archive. Only
+edition files are served, not dot files (leases, partial downloads) or the
+log and index databases at the top of the cache.'''
+        parts = [p for p in unquote(path).split('/') if p]
+        if len(parts) != 4 or any(p.startswith('.') or p == '..' for p in parts):
+            return None
+        filename = os.path.realpath(os.path.join(self.cache_dir, *parts))
+        if not filename.startswith(self.cache_dir + os.sep):
+            return None
+        if os.path.isfile(filename):
+            return filename, 0, os.stat(filename).st_size
+        archive = self.epaper.open_archive(os.path.dirname(filename))
+        member = archive.locate(parts[3]) if archive is not None else None
+        if member is None:
+            return None
+        return (archive.filename,) + member
+
+    async def _send_head(self, writer, status, headers):
+        lines = ['HTTP/1.1 {0} {1}'.format(status, REASONS[status])]
+        lines.extend('{0}: {1}'.format(k, v) for k, v in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    async def _send_error(self, writer, status, headers=None):
+        body = REASONS[status].encode('latin-1')
+        response = {
+            'Content-Type': 'text/plain',
+            'Content-Length': len(body),
+        }
+        response.update(headers or {})
+        await self._send_head(writer, status, response)
+        writer.write(body)
+        await writer.drain()
+
+    async def _send_index(self, writer, method, headers):
+        if headers.get('if-none-match') == self.index_etag:
+            await self._send_head(writer, 304, {'ETag': self.index_etag})
+            return
+        await self._send_head(writer, 200, {
+            'Content-Type': 'application/json',
+            'Content-Length': len(self.index),
+            'ETag': self.index_etag,
+            'Cache-Control': 'no-cache',
+        })
+        if method == 'GET':
+            writer.write(self.index)
+            await writer.drain()
+
+    async def _send_file(self, writer, method, headers, path, filename, base,
+                         size):
+        '''Send *size* bytes at offset *base* of *filename* as the file *path*.'''
+        stat = os.stat(filename)
+        etag = file_etag(size, stat.st_mtime_ns, base)
+        response = {
+            'ETag': etag,
+            'Last-Modified': formatdate(stat.st_mtime, usegmt=True),
+            'Accept-Ranges': 'bytes',
+            'Cache-Control': 'public, max-age={0}'.format(self.max_age)
+            if PAGE_FILE.match(os.path.basename(path)) else 'no-cache',
+        }
+        if headers.get('if-none-match') == etag:
+            await self._send_head(writer, 304, response)
+            return
+
+        status, offset, count = 200, 0, size
+        if headers.get('if-range', etag) == etag:
+            try:
+                byte_range = parse_range(headers.get('range'), size)
+            except ValueError:
+                await self._send_error(writer, 416, {
+                    'Content-Range': 'bytes */{0}'.format(size)})
+                return
+        else:
+            byte_range = None
+        if byte_range is not None:
+            offset, end = byte_range
+            status, count = 206, end - offset + 1
+            response['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+                offset, end, size)
+
+        content_type, _ = mimetypes.guess_type(path)
+        response['Content-Type'] = content_type or 'application/octet-stream'
+        response['Content-Length'] = count
+        await self._send_head(writer, status, response)
+        if method == 'GET' and count:
+            with open(filename, 'rb') as fd:
+                await asyncio.get_running_loop().sendfile(
+                    writer.transport, fd, base + offset, count)
+
+    async def handle(self, reader, writer):
+        '''Serve requests of one keep-alive connection.'''
+        try:
+            while True:
+                request = await reader.readuntil(b'\r\n\r\n')
+                lines = request.decode('latin-1').split('\r\n')
+                try:
+                    method, target, version = lines[0].split(' ')
+                except ValueError:
+                    await self._send_error(writer, 400)
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        key, value = line.split(':', 1)
+                        headers[key.strip().lower()] = value.strip()
+
+                path = urlsplit(target).path
+                if method not in ('GET', 'HEAD'):
+                    await self._send_error(writer, 405)
+                elif path == '/index.json':
+                    await self._send_index(writer, method, headers)
+                else:
+                    resolved = self._resolve(path)
+                    if resolved is None:
+                        await self._send_error(writer, 404)
+                    else:
+                        await self._send_file(writer, method, headers, path,
+                                              *resolved)
+
+                if headers.get('connection', '').lower() == 'close' or \
+                   version == 'HTTP/1.0':
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.watcher = CacheWatcher(
+            self.cache_dir,
+            callback=lambda event: loop.call_soon_threadsafe(
+                self._on_cache_event, event),
+            interval=self.watch_interval
+        )
+        self.watcher.start()
+        self.refresh_index()
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        logger.info('serving {0} on {1}:{2}'.format(
+            self.cache_dir, self.host, self.port))
+        refresh = asyncio.ensure_future(self._refresh_periodically())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            refresh.cancel()
+            self.watcher.stop()
+
+    def run(self):
+        '''Serve until interrupted.'''
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
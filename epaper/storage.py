@@ -0,0 +1,241 @@
+from contextlib import contextmanager
+import logging
+import os
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+from epaper.utils import atomic_path
+
+# logging
+logger = logging.getLogger('storage')
+
+# S3 multipart upload parts must be at least 5 MiB, except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def file_key(root, filename):
+    '''Return the storage key of *filename*, a path under *root* (cache_dir).'''
+    return '/'.join(os.path.relpath(filename, root).split(os.sep))
+
+
+class LocalStorage:
+    '''Edition files in a local directory, normally cache_dir. Keys are paths
+relative to it with / separators, e.g. TOI/DEL/2024-01-02/page-001-lowres.jpg.'''
+
+    local = True
+
+    def __init__(self, root=None):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def key(self, filename):
+        '''Return the key of *filename*, a path under root.'''
+        return file_key(self.root, filename)
+
+    @contextmanager
+    def writer(self, key):
+        '''Yield a binary file to write *key* to. The file appears when the block
+completes, and not at all if it raises.'''
+        filename = self.path(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with atomic_path(filename) as temp:
+            with open(temp, 'wb') as fd:
+                yield fd
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def open(self, key):
+        '''Return a binary file object of *key*; FileNotFoundError if missing.'''
+        return open(self.path(key), 'rb')
+
+    def read(self, key):
+        with self.open(key) as fd:
+            return fd.read()
+
+    def list(self, prefix=''):
+        '''Yield the keys under *prefix*, a key of a directory.'''
+        top = self.path(prefix) if prefix else self.root
+        for dirpath, dirnames, filenames in os.walk(top):
+            for name in filenames:
+                if not name.startswith('.'):
+                    yield self.key(os.path.join(dirpath, name))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class MultipartWriter:
+    '''File-like writer of one object. Writes are buffered up to *part_size*
+bytes and each full buffer is sent as a part of a multipart upload, so memory
+use is bounded whatever the size of the object. Objects smaller than one part
+are sent with a single PUT instead.'''
+
+    def __init__(self, client=None, bucket=None, name=None,
+                 part_size=MIN_PART_SIZE):
+        self.client = client
+        self.bucket = bucket
+        self.name = name
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.name)['UploadId']
+        number = len(self.parts) + 1
+        res = self.client.upload_part(
+            Bucket=self.bucket, Key=self.name, UploadId=self.upload_id,
+            PartNumber=number, Body=self.buffer)
+        self.parts.append({'ETag': res['ETag'], 'PartNumber': number})
+        self.buffer.clear()
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.size += len(data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def close(self):
+        '''Complete the upload: the object appears now.'''
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.name,
+                                   Body=self.buffer)
+            self.buffer.clear()
+            return
+        if self.buffer:
+            self._upload_part()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.name, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        '''Drop the parts uploaded so far; the object is left as it was.'''
+        self.buffer.clear()
+        if self.upload_id is None:
+            return
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.name, UploadId=self.upload_id)
+        except Exception as e:
+            # the bucket's lifecycle rules clean up eventually
+            logger.error('could not abort upload of {0}: {1}'.format(
+                self.name, e))
+
+
+class ObjectStorage:
+    '''Edition files in an S3 compatible bucket (AWS, MinIO, ...), with the
+optional boto3. Keys are as in LocalStorage, below *prefix*. Credentials come
+from the usual boto3 sources, e.g. AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY.
+
+    '''
+
+    local = False
+
+    def __init__(self, bucket=None, prefix='', endpoint_url=None, region=None,
+                 part_size=8 * 1024 * 1024, client=None):
+        if client is None:
+            if boto3 is None:
+                raise ImportError('boto3 is required for object storage')
+            client = boto3.client('s3', endpoint_url=endpoint_url or None,
+                                  region_name=region or None)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.part_size = max(MIN_PART_SIZE, part_size)
+
+    def _name(self, key):
+        return '/'.join((self.prefix, key)) if self.prefix else key
+
+    @contextmanager
+    def writer(self, key):
+        '''Yield a MultipartWriter for *key*. The object appears when the block
+completes, and not at all if it raises.'''
+        writer = MultipartWriter(self.client, self.bucket, self._name(key),
+                                 self.part_size)
+        try:
+            yield writer
+            # completing the upload can fail too, e.g. on a missing part
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._name(key))
+            return True
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def open(self, key):
+        '''Return a binary, not seekable, stream of *key*; FileNotFoundError if
+missing.'''
+        try:
+            return self.client.get_object(
+                Bucket=self.bucket, Key=self._name(key))['Body']
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(key)
+
+    def read(self, key):
+        body = self.open(key)
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def list(self, prefix=''):
+        '''Yield the keys under *prefix*, a key of a directory.'''
+        start = len(self.prefix) + 1 if self.prefix else 0
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(
+            Bucket=self.bucket,
+            Prefix=self._name(prefix.rstrip('/') + '/') if prefix else
+            (self.prefix + '/' if self.prefix else ''))
+        for page in pages:
+            for item in page.get('Contents', []):
+                yield item['Key'][start:]
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._name(key))
+
+
+def make_storage(app_config):
+    '''Build the storage backend selected in the [Storage] config section. Falls
+back to cache_dir when the object store cannot be used.'''
+    config = app_config.config['Storage']
+    cache_dir = app_config.config['App']['cache_dir']
+    backend = config.get('backend', 'local')
+    if backend == 's3':
+        if not config.get('bucket'):
+            logger.error('no [Storage] bucket configured, using {0}'.format(
+                cache_dir))
+            return LocalStorage(cache_dir)
+        try:
+            return ObjectStorage(
+                bucket=config['bucket'],
+                prefix=config.get('prefix', ''),
+                endpoint_url=config.get('endpoint_url', ''),
+                region=config.get('region', ''),
+                part_size=config.getint('part_size', 8) * 1024 * 1024
+            )
+        except ImportError as e:
+            logger.error('{0}, using {1}'.format(e, cache_dir))
+    elif backend != 'local':
+        logger.error('unknown storage backend {0}, using {1}'.format(
+            backend, cache_dir))
+    return LocalStorage(cache_dir)
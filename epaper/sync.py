@@ -0,0 +1,199 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+
+from epaper.atlas import ATLAS_NAME
+from epaper.manifest import Manifest
+from epaper.transcode import resolve_image
+from epaper.utils import find_json, read_json, write_json
+
+# logging
+logger = logging.getLogger('sync')
+
+# what sync found and did; changed maps page number to the list of reasons
+SyncReport = namedtuple('SyncReport', [
+    'added', 'removed', 'changed', 'unchanged', 'downloaded', 'failed'])
+
+IMAGE_RENDITIONS = ('thumbnail', 'lowres', 'highres')
+
+
+class EditionSync:
+    '''Bring a downloaded edition up to date with late corrections. toc.json and
+each page.json are re-fetched with conditional requests (validators are kept in
+sync.json) and page images are checked with HEAD requests against the ETag or
+Content-Length recorded in the edition manifest. Only pages whose page folder,
+PDF name or images changed are downloaded again.
+
+The edition is the one selected in *epaper*, with its download directory
+already created.
+
+    '''
+
+    def __init__(self, epaper=None, scraper=None, selection=None, workers=4):
+        self.epaper = epaper
+        self.scraper = scraper
+        self.selection = selection
+        self.workers = max(1, workers)
+        self.download_path = epaper.download_path
+        self.state_file = os.path.join(self.download_path, 'sync.json')
+        self.state = read_json(self.state_file) \
+            if find_json(self.state_file) else {'toc': {}, 'pages': {}}
+        self.manifest = Manifest(self.download_path,
+                                 compression=epaper.metadata_compression)
+
+    def _date_str(self):
+        return self.epaper.selected_date.strftime('%Y%m%d')
+
+    def _stored_pdf_urls(self):
+        filename = os.path.join(self.download_path, 'page_metadata.json')
+        if not find_json(filename):
+            return {}
+        return dict((number, urls['pdf'][0])
+                    for number, title, urls in read_json(filename))
+
+    def _image_changed(self, url, filename):
+        '''Compare the remote image with the manifest entry of the local file.
+Return True if it changed; records validators for files that have none yet.'''
+        local = resolve_image(filename)
+        if local is None:
+            return True
+        entry = self.manifest.entries.get(os.path.basename(local))
+        headers = self.scraper.head(url)
+        if headers is None or entry is None:
+            return False
+        etag = headers.get('etag')
+        length = headers.get('content-length')
+        if entry.get('etag') and etag:
+            return entry['etag'] != etag
+        if entry.get('content_length') and length:
+            return entry['content_length'] != length
+        # downloaded before validators were recorded: use these from now on
+        entry['etag'], entry['content_length'] = etag, length
+        return False
+
+    def _check_page(self, entry, old_entry, old_pdf_url):
+        '''Return (page, reasons, renditions to download) for one toc entry.'''
+        number = int(entry['page'])
+        urls = self.scraper.build_page_urls(
+            pub_code=self.epaper.selected_publication[1],
+            edition_code=self.epaper.selected_edition[1],
+            date_str=self._date_str(),
+            page_folder=entry['page_folder'],
+            with_pdf=False
+        )
+        for key, filename in self.epaper.page_filenames(number).items():
+            urls[key][1] = filename
+        page = self.epaper.Page(number=number, title=entry.get('page_title', ''),
+                                urls=urls)
+
+        reasons = []
+        if old_entry is None:
+            reasons.append('added')
+        elif old_entry['page_folder'] != entry['page_folder']:
+            reasons.append('page_folder')
+
+        if self.selection.pdf:
+            page_url = urls['thumbnail'][0].rsplit('/', 1)[0]
+            status, data, validators = self.scraper.fetch_conditional(
+                page_url + '/page.json', self.state['pages'].get(str(number)))
+            if status == 200 and data:
+                urls['pdf'][0] = page_url + '/' + data['pdf']
+                if old_pdf_url and \
+                   os.path.basename(old_pdf_url) != data['pdf']:
+                    reasons.append('pdf')
+            else:
+                urls['pdf'][0] = old_pdf_url
+            if status in (200, 304):
+                self.state['pages'][str(number)] = validators
+
+        if reasons:
+            renditions = [r for r in self.selection.renditions if urls[r][0]]
+        else:
+            renditions = [
+                r for r in self.selection.renditions
+                if r in IMAGE_RENDITIONS and self._image_changed(*urls[r][:2])
+            ]
+            reasons.extend(renditions)
+            if 'pdf' in self.selection.renditions and urls['pdf'][0] and \
+               not os.path.exists(urls['pdf'][1]):
+                renditions.append('pdf')
+        return page, reasons, renditions
+
+    def _download(self, page, rendition):
+        url, filename, exists = page.urls[rendition]
+        headers = {}
+        if rendition == 'pdf':
+            ok = self.scraper.save_file(url, filename, delay=False,
+                                        response_headers=headers)
+        else:
+            ok, count = self.scraper.save_image(url, filename, delay=False,
+                                                response_headers=headers)
+        if ok:
+            self.manifest.add(filename, etag=headers.get('etag'),
+                              content_length=headers.get('content-length'))
+        return ok
+
+    def run(self):
+        '''Sync the edition, return a SyncReport or None if toc.json could not be
+retrieved.'''
+        toc_url = self.scraper.build_toc_url(
+            pub_code=self.epaper.selected_publication[1],
+            edition_code=self.epaper.selected_edition[1],
+            date_str=self._date_str()
+        )
+        toc_filename = os.path.join(self.download_path, 'toc.json')
+        old_toc = read_json(toc_filename) if find_json(toc_filename) else None
+        status, toc, validators = self.scraper.fetch_conditional(
+            toc_url, self.state['toc'] if old_toc else None)
+        if status == 304:
+            toc = old_toc
+        elif status != 200 or not toc or 'toc' not in toc:
+            logger.error('Table of contents could not be retrieved!')
+            return None
+        self.state['toc'] = validators
+        self.epaper.toc_dict = toc
+
+        old_entries = dict((int(p['page']), p) for p in
+                           self.selection.filter_toc(old_toc['toc'])) \
+            if old_toc else {}
+        entries = self.selection.filter_toc(toc['toc'])
+        old_pdf_urls = self._stored_pdf_urls()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            checks = list(pool.map(
+                lambda e: self._check_page(e, old_entries.get(int(e['page'])),
+                                           old_pdf_urls.get(int(e['page']))),
+                entries))
+            jobs = [(page, r) for page, reasons, renditions in checks
+                    for r in renditions]
+            results = list(pool.map(lambda job: self._download(*job), jobs))
+
+        failed = sorted(set(page.number for (page, r), ok in zip(jobs, results)
+                            if not ok))
+        self.epaper.pages = [page for page, reasons, renditions in checks]
+        self.epaper.num_pages = len(self.epaper.pages)
+        self.epaper.transcode_pages(manifest=self.manifest)
+        if jobs or not find_json(
+                os.path.join(self.download_path, ATLAS_NAME + '.json')):
+            atlas = self.epaper.build_thumbnail_atlas()
+            if atlas:
+                self.manifest.add(atlas)
+
+        if status == 200:
+            self.epaper.save_toc()
+        self.epaper.save_page_metadata()
+        self.manifest.save()
+        write_json(self.state_file, self.state,
+                   compression=self.epaper.metadata_compression)
+
+        new_numbers = set(int(e['page']) for e in entries)
+        return SyncReport(
+            added=[page.number for page, reasons, r in checks if 'added' in reasons],
+            removed=sorted(set(old_entries) - new_numbers),
+            changed=dict((page.number, reasons) for page, reasons, r in checks
+                         if reasons and 'added' not in reasons),
+            unchanged=len([c for c in checks if not c[1]]),
+            downloaded=len([ok for ok in results if ok]),
+            failed=failed
+        )
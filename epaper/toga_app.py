@@ -1,11 +1,18 @@
 import toga
 from toga.style.pack import Pack, COLUMN, ROW
 
+from datetime import datetime
+from functools import partial
+import asyncio
 import logging
 
+from epaper.availability import AvailabilityProber, candidate_dates
+from epaper.downloader import DownloadError, Downloader
 from epaper.epaper import EPaper
 from epaper.appconfig import AppConfig
+from epaper.logs import setup_logging
 from epaper.scraper import Scraper
+from epaper.watcher import CacheWatcher, PAGE_COMPLETED
 
 
 class EpaperApp(toga.App):
@@ -20,12 +27,7 @@ class EpaperApp(toga.App):
         self.app_config = AppConfig()
 
         # setup logging
-        logging.basicConfig(
-            filename=self.app_config.config['App']['log_file'],
-            filemode='w',
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            level=logging.DEBUG
-        )
+        setup_logging(self.app_config)
 
         # Scraper
         self.scraper = Scraper(
@@ -93,6 +95,15 @@ class EpaperApp(toga.App):
             )
         )
 
+        # offer only dates that have the selected edition
+        self.prober = AvailabilityProber.from_config(
+            self.scraper, self.app_config)
+        if self.epaper.selected_edition[1]:
+            self.epaper.available_dates = self.prober.available_dates(
+                self.epaper.selected_publication[1],
+                self.epaper.selected_edition[1],
+                self.epaper.available_dates)
+
         self.date_selection = toga.Selection(
             items=self.epaper.available_dates,
             style=Pack(
@@ -102,12 +113,38 @@ class EpaperApp(toga.App):
             )
         )
 
+        self.edition_selection.on_select = self.refresh_dates
+
+        # Download controls, see download()
+        self.downloader = None
+        self.download_button = toga.Button(
+            'Download',
+            on_press=self.download,
+            style=Pack(
+                padding_left=5
+            )
+        )
+        self.cancel_button = toga.Button(
+            'Cancel',
+            on_press=self.cancel_download,
+            enabled=False,
+            style=Pack(
+                padding_left=5
+            )
+        )
+        self.status_label = toga.Label(
+            '',
+            style=Pack(
+                padding=5
+            )
+        )
+
         # Thumbnail View Commands
         thumbnail_commands = []
         for i in range(self.epaper.num_pages):
             thumbnail_commands.append(
                 toga.Command(
-                    self.display_page(None, i),
+                    partial(self.display_page, page_number=i),
                     label='Display Page',
                     tooltip='Display Page {}'.format(i),
                     group=toga.Group.VIEW,
@@ -115,25 +152,9 @@ class EpaperApp(toga.App):
                 )
             )
 
-        thumbnail_buttons = [
-            toga.Button(
-                'Page {}'.format(i),
-                on_press=self.display_page(None, i),
-                style=Pack(
-                    width=100,
-                    padding=2
-                )
-            ) for i in range(self.epaper.num_pages)
-        ]
-
         # left view of SplitContainer below
         self.thumbnail_view = toga.ScrollContainer(
-            content=toga.Box(
-                children=thumbnail_buttons,
-                style=Pack(
-                    direction=COLUMN
-                )
-            )
+            content=self.thumbnail_box()
         )
 
         # right view of SplitContainer below
@@ -152,7 +173,9 @@ class EpaperApp(toga.App):
                     children=[
                         self.publication_selection,
                         self.edition_selection,
-                        self.date_selection
+                        self.date_selection,
+                        self.download_button,
+                        self.cancel_button
                     ],
                     style=Pack(
                         direction=ROW,
@@ -168,7 +191,8 @@ class EpaperApp(toga.App):
                         direction=ROW,
                         padding=5
                     )
-                )
+                ),
+                self.status_label
             ],
             style=Pack(
                 direction=COLUMN
@@ -178,13 +202,133 @@ class EpaperApp(toga.App):
         self.main_window.content = box
         self.main_window.show()
 
+        # pages written by our downloads or any other process show up as they
+        # complete; the callback runs in the watcher thread
+        self.watcher = CacheWatcher(
+            self.app_config.config['App']['cache_dir'],
+            callback=lambda event: self.loop.call_soon_threadsafe(
+                self.on_cache_event, event),
+            interval=self.app_config.config['Server'].getint(
+                'watch_interval', 5)
+        )
+        self.watcher.start()
+
+    def thumbnail_box(self):
+        '''Return a column of page thumbnails and buttons of the edition being
+viewed.'''
+        # thumbnails are crops of the edition's atlas: one image decode in all
+        thumbnail_buttons = [
+            toga.Box(
+                children=[
+                    toga.ImageView(
+                        image=self.epaper.get_page_thumbnail(i),
+                        style=Pack(
+                            width=100
+                        )
+                    ),
+                    toga.Button(
+                        'Page {}'.format(i),
+                        on_press=partial(self.display_page, page_number=i),
+                        style=Pack(
+                            width=100,
+                            padding=2
+                        )
+                    )
+                ],
+                style=Pack(
+                    direction=COLUMN
+                )
+            ) for i in range(self.epaper.num_pages)
+        ]
+        return toga.Box(
+            children=thumbnail_buttons,
+            style=Pack(
+                direction=COLUMN
+            )
+        )
+
+    def on_cache_event(self, event):
+        '''Apply a watcher.CacheEvent; the thumbnail column of the edition being
+viewed is rebuilt when one of its thumbnails arrives.'''
+        viewed = self.epaper.apply_cache_event(event)
+        if viewed and (event.kind != PAGE_COMPLETED or
+                       event.rendition == 'thumbnail'):
+            self.thumbnail_view.content = self.thumbnail_box()
+
     def open_document(self, fileUrl):
         pass
 
+    async def refresh_dates(self, selection):
+        '''Offer only the dates on which the selected edition exists; probed
+concurrently off the event loop.'''
+        edition_code = self.epaper.editions.get(selection.value)
+        if not edition_code:
+            return
+        dates = await asyncio.get_running_loop().run_in_executor(
+            None, self.prober.available_dates,
+            self.epaper.selected_publication[1], edition_code,
+            candidate_dates())
+        self.epaper.available_dates = dates
+        self.date_selection.items = dates
+
+    async def download(self, sender):
+        '''Download the selected edition; the download runs in background
+threads and results stream in as pages complete.'''
+        publication = self.publication_selection.value
+        edition = self.edition_selection.value
+        self.epaper.selected_publication = (
+            publication, self.epaper.publications[publication])
+        self.epaper.selected_edition = (edition, self.epaper.editions[edition])
+        self.epaper.save_codes_to_config()
+
+        self.downloader = Downloader(
+            pub_code=self.epaper.selected_publication[1],
+            edition_code=self.epaper.selected_edition[1],
+            date=datetime.strptime(self.date_selection.value, '%Y%m%d'),
+            app_config=self.app_config,
+            publisher=self.publisher,
+            scraper=self.scraper,
+            epaper=self.epaper
+        )
+        self.download_button.enabled = False
+        self.cancel_button.enabled = True
+        try:
+            async for result in self.downloader:
+                self.status_label.text = 'Page {0} {1}: {2}'.format(
+                    result.page.number, result.rendition,
+                    'done' if result.ok else 'failed')
+            report = self.downloader.report
+            self.status_label.text = 'Downloaded {0} pages.'.format(
+                report.downloaded)
+            if report.failed:
+                self.status_label.text += ' Failed: {0}'.format(
+                    repr(report.failed))
+            if report.postponed:
+                # the edition is browsable, fetch what the deadline postponed
+                self.status_label.text = 'Upgrading pages {0}...'.format(
+                    repr(report.postponed))
+                results = await asyncio.get_running_loop().run_in_executor(
+                    None, self.downloader.upgrade)
+                self.status_label.text = 'Upgraded {0} images.'.format(
+                    len([r for r in results if r.ok]))
+        except DownloadError as e:
+            self.logger.error(str(e))
+            self.status_label.text = str(e)
+        finally:
+            self.downloader = None
+            self.download_button.enabled = True
+            self.cancel_button.enabled = False
+
+    def cancel_download(self, sender):
+        '''Stop a running download, keeping the pages already downloaded.'''
+        if self.downloader is not None:
+            self.downloader.cancel()
+
     def display_page(self, sender, page_number):
         """Display page image identified by `page_number`."""
         print(f'Displaying page {page_number}')
-        return None
+        # while downloading, fetch this page's remaining images first
+        self.epaper.select_page(page_number)
 
 
 def main():
@@ -0,0 +1,93 @@
+from PIL import Image, features
+from concurrent.futures import ProcessPoolExecutor
+import importlib
+import logging
+import os
+
+from epaper.utils import atomic_path
+
+# logging
+logger = logging.getLogger('transcode')
+
+# storage formats: file extension and Pillow format name
+STORAGE_FORMATS = {
+    'jpg': ('.jpg', 'JPEG'),
+    'webp': ('.webp', 'WEBP'),
+    'avif': ('.avif', 'AVIF'),
+}
+
+
+def avif_supported():
+    '''Pillow >= 11.2 can write AVIF natively, older versions need the
+pillow-avif-plugin package.'''
+    try:
+        if features.check('avif'):
+            return True
+    except ValueError:
+        pass
+    try:
+        # registers the AVIF plugin with Pillow
+        importlib.import_module('pillow_avif')
+        return True
+    except ImportError:
+        return False
+
+
+def resolve_image(filename):
+    '''Return the path on disk for page image *filename*, which may have been
+transcoded to another storage format since it was recorded, or None.'''
+    if filename is None:
+        return None
+    if os.path.exists(filename):
+        return filename
+    stem, ext = os.path.splitext(filename)
+    extensions = [extension for extension, _ in STORAGE_FORMATS.values()]
+    if ext not in extensions:
+        # not a page image, e.g. a PDF
+        return None
+    for extension in extensions:
+        if os.path.exists(stem + extension):
+            return stem + extension
+    return None
+
+
+def transcode_image(filename, storage_format='webp', quality=80):
+    '''Transcode *filename* to *storage_format*. The original is removed only after
+the new file has been written and verified. Return the new filename, or None
+on failure (the original is kept).'''
+    extension, pil_format = STORAGE_FORMATS[storage_format]
+    target = os.path.splitext(filename)[0] + extension
+    if target == filename:
+        return filename
+    try:
+        with atomic_path(target) as temp:
+            with Image.open(filename) as image:
+                image.save(temp, format=pil_format, quality=quality)
+            with Image.open(temp) as image:
+                image.verify()
+        os.remove(filename)
+        return target
+    except (IOError, OSError, SyntaxError) as e:
+        logger.error('could not transcode {0}: {1}'.format(filename, e))
+        return None
+
+
+def _transcode(args):
+    return transcode_image(*args)
+
+
+def transcode_images(filenames, storage_format='webp', quality=80, workers=None):
+    '''Transcode *filenames* in a process pool across cores. Return a dict mapping
+each original filename to its new filename (or None on failure).'''
+    if storage_format == 'avif' and not avif_supported():
+        logger.error('AVIF is not supported by this Pillow, using webp')
+        storage_format = 'webp'
+    jobs = [(filename, storage_format, quality) for filename in filenames]
+    if not jobs:
+        return {}
+    # workers started with spawn or forkserver do not inherit a plugin loaded
+    # here, they register it themselves
+    initializer = avif_supported if storage_format == 'avif' else None
+    with ProcessPoolExecutor(max_workers=workers or None,
+                             initializer=initializer) as pool:
+        return dict(zip(filenames, pool.map(_transcode, jobs)))
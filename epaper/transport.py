@@ -0,0 +1,272 @@
+from contextlib import contextmanager
+import importlib
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# logging
+logger = logging.getLogger('transport')
+
+
+def _installed(name):
+    '''Return True if module *name* can be imported.'''
+    try:
+        importlib.import_module(name)
+        return True
+    except ImportError:
+        return False
+
+
+# content codings we can decode for text resources (HTML/JSON); both backends
+# decode brotli only if one of the brotli packages is installed.
+if _installed('brotli') or _installed('brotlicffi'):
+    ACCEPT_ENCODING = 'br, gzip, deflate'
+else:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+
+class TransportError(Exception):
+    '''Connection level failure (DNS, refused connection, timeout, ...) raised by
+any transport backend. *kind* is connect, timeout (while reading) or other, see
+epaper.retry.'''
+
+    def __init__(self, message='', kind='other'):
+        super().__init__(message)
+        self.kind = kind
+
+
+class Transport:
+    '''HTTP transport used by Scraper. Backends return response objects exposing
+`status_code`, `headers`, `content`, `text` and `json()`; `stream()` yields a
+response whose body is read, and content-decoded, chunk by chunk through
+`iter_content()`.
+
+    '''
+
+    name = None
+
+    # (exception class, TransportError kind), first match wins
+    error_kinds = ()
+
+    def __init__(self, user_agent=None, pool_connections=4, pool_maxsize=16,
+                 connect_timeout=10, read_timeout=30, max_retries=2):
+        self.user_agent = user_agent
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+
+    def _headers(self, headers=None):
+        merged = {'User-Agent': self.user_agent}
+        if headers:
+            merged.update(headers)
+        return merged
+
+    def _error(self, e):
+        '''Wrap backend exception *e* in a TransportError of the right kind.'''
+        for error, kind in self.error_kinds:
+            if isinstance(e, error):
+                return TransportError(str(e), kind=kind)
+        return TransportError(str(e))
+
+    def get(self, url, headers=None):
+        raise NotImplementedError
+
+    def head(self, url, headers=None):
+        raise NotImplementedError
+
+    def stream(self, url, headers=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class RequestsTransport(Transport):
+    '''requests.Session with a sized connection pool, timeouts and urllib3
+retries on connection errors.'''
+
+    name = 'requests'
+
+    error_kinds = (
+        (requests.ConnectTimeout, 'connect'),
+        (requests.Timeout, 'timeout'),
+        (requests.ConnectionError, 'connect'),
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        retries = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=self.max_retries,
+            status=0,
+            backoff_factor=0.5,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=retries,
+            pool_block=True
+        )
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _request(self, method, url, headers=None, **kwargs):
+        try:
+            return self.session.request(method, url,
+                                        headers=self._headers(headers),
+                                        timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            raise self._error(e) from e
+
+    def get(self, url, headers=None):
+        return self._request('GET', url, headers=headers)
+
+    def head(self, url, headers=None):
+        return self._request('HEAD', url, headers=headers, allow_redirects=True)
+
+    @contextmanager
+    def stream(self, url, headers=None):
+        res = self._request('GET', url, headers=headers, stream=True)
+        try:
+            yield _StreamResponse(res, res.iter_content,
+                                  requests.RequestException, self._error)
+        finally:
+            res.close()
+
+    def close(self):
+        self.session.close()
+
+
+class _HttpxResponse:
+    '''Adapt httpx.Response to the subset of requests.Response we use.'''
+
+    def __init__(self, res):
+        self._res = res
+        self.status_code = res.status_code
+        self.headers = res.headers
+        self.url = str(res.url)
+
+    @property
+    def content(self):
+        return self._res.content
+
+    @property
+    def text(self):
+        return self._res.text
+
+    def json(self):
+        return self._res.json()
+
+
+class _StreamResponse:
+    '''Streamed response; errors raised while reading the body surface as
+TransportError like those raised when connecting.'''
+
+    def __init__(self, res, iter_chunks, errors, wrap_error):
+        self.status_code = res.status_code
+        self.headers = res.headers
+        self.url = str(res.url)
+        self._iter_chunks = iter_chunks
+        self._errors = errors
+        self._wrap_error = wrap_error
+
+    def iter_content(self, chunk_size=None):
+        try:
+            for chunk in self._iter_chunks(chunk_size):
+                yield chunk
+        except self._errors as e:
+            raise self._wrap_error(e) from e
+
+
+class HttpxTransport(Transport):
+    '''httpx.Client with HTTP/2 enabled: all page requests to the archive host are
+multiplexed over a single connection.'''
+
+    name = 'httpx'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        import httpx
+        self._errors = httpx.HTTPError
+        self.error_kinds = (
+            (httpx.ConnectError, 'connect'),
+            (httpx.ConnectTimeout, 'connect'),
+            (httpx.TimeoutException, 'timeout'),
+        )
+        # with a transport given, the client ignores its own http2 and limits
+        self.client = httpx.Client(
+            timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+            transport=httpx.HTTPTransport(
+                http2=True,
+                retries=self.max_retries,
+                limits=httpx.Limits(
+                    max_connections=self.pool_maxsize,
+                    max_keepalive_connections=self.pool_connections
+                )
+            ),
+            follow_redirects=True
+        )
+
+    def _request(self, method, url, headers=None):
+        try:
+            return _HttpxResponse(
+                self.client.request(method, url, headers=self._headers(headers)))
+        except self._errors as e:
+            raise self._error(e) from e
+
+    def get(self, url, headers=None):
+        return self._request('GET', url, headers=headers)
+
+    def head(self, url, headers=None):
+        return self._request('HEAD', url, headers=headers)
+
+    @contextmanager
+    def stream(self, url, headers=None):
+        try:
+            context = self.client.stream('GET', url, headers=self._headers(headers))
+            res = context.__enter__()
+        except self._errors as e:
+            raise self._error(e) from e
+        try:
+            yield _StreamResponse(res, res.iter_bytes, self._errors, self._error)
+        finally:
+            context.__exit__(None, None, None)
+
+    def close(self):
+        self.client.close()
+
+
+TRANSPORTS = {
+    RequestsTransport.name: RequestsTransport,
+    HttpxTransport.name: HttpxTransport,
+}
+
+
+def make_transport(app_config):
+    '''Build the transport selected in the [Http] config section. Falls back to
+requests when httpx (with h2) is not installed.'''
+    http = app_config.config['Http']
+    name = http.get('transport', 'requests')
+    kwargs = dict(
+        user_agent=http['user_agent'],
+        pool_connections=http.getint('pool_connections', 4),
+        pool_maxsize=http.getint('pool_maxsize', 16),
+        connect_timeout=http.getfloat('connect_timeout', 10),
+        read_timeout=http.getfloat('read_timeout', 30),
+        max_retries=http.getint('max_retries', 0)
+    )
+    cls = TRANSPORTS.get(name)
+    if cls is None:
+        logger.error('unknown transport {0}, using requests'.format(name))
+        return RequestsTransport(**kwargs)
+    try:
+        return cls(**kwargs)
+    except ImportError:
+        logger.error('httpx[http2] is not installed, using requests')
+    return RequestsTransport(**kwargs)
@@ -81,20 +81,33 @@ supported by underlying GUI toolkit.
                                       completer=edition_code_completer)
         return (edition_code_key, editions[edition_code_key])
 
-    def select_pub_date(self):
+    def select_pub_date(self, available_dates=None):
         '''Prompt for a date string, check if it is either today's or in the past
-and return a datetime object.'''
+and return a datetime object. With *available_dates* (YYYYMMDD strings, see
+AvailabilityProber) only those are offered and accepted.'''
         on_date = datetime.today()
+        choices = [datetime.strptime(d, '%Y%m%d').strftime('%Y-%m-%d')
+                   for d in available_dates or []]
+        if available_dates is not None and not choices:
+            print('No editions found for the last days, enter any date.')
         retry = True
         while retry:
             try:
-                date_str = prompt(
-                    'Enter a date [YYYY-MM-DD]: ', default=datetime.today().strftime('%Y-%m-%d'))
-                on_date = datetime.strptime(date_str, '%Y-%m-%d')
-                if on_date.date() <= datetime.today().date():
-                    retry = False
+                if choices:
+                    date_str = prompt('Enter a date [YYYY-MM-DD]: ',
+                                      completer=WordCompleter(choices),
+                                      default=choices[0])
                 else:
+                    date_str = prompt(
+                        'Enter a date [YYYY-MM-DD]: ', default=datetime.today().strftime('%Y-%m-%d'))
+                on_date = datetime.strptime(date_str, '%Y-%m-%d')
+                if on_date.date() > datetime.today().date():
                     raise ValueError
+                if choices and date_str not in choices:
+                    print('No edition on {0}, available: {1}'.format(
+                        date_str, ', '.join(choices)))
+                    continue
+                retry = False
             except ValueError:
                 print('Please enter date as YYYY-MM-DD including "-".')
                 print('Also date must be either today\'s or in the past.')
@@ -1,5 +1,15 @@
+from contextlib import contextmanager
+from io import BytesIO
+import gzip
+import json
 import sys
 import os
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 def notify(title=None, message=None):
@@ -38,3 +48,90 @@ But really use os.makedirs(path, exist_ok=True) rather than this.
     while len(stack) > 0:
         current = stack.pop()
         os.mkdir(current)
+
+
+@contextmanager
+def atomic_path(filename):
+    """Yield a temporary path next to *filename*; when the block completes it is
+renamed over *filename*, so readers (and other workers sharing the cache) never
+see a partially written file. The temporary name keeps the file extension.
+"""
+    dirname, basename = os.path.split(filename)
+    stem, ext = os.path.splitext(basename)
+    temp = os.path.join(dirname, '.{0}.{1}.tmp{2}'.format(
+        stem, uuid.uuid4().hex[:8], ext))
+    try:
+        yield temp
+        os.replace(temp, filename)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+# on-disk compression of JSON metadata by name and file suffix
+JSON_SUFFIXES = {
+    'zstd': '.zst',
+    'gzip': '.gz',
+    'none': '',
+}
+
+
+def _open_compressed(filename, mode):
+    '''Open *filename* in binary *mode*, (de)compressing by its suffix.'''
+    if filename.endswith('.zst'):
+        if zstandard is None:
+            raise IOError('zstandard is required to read {0}'.format(filename))
+        return zstandard.open(filename, mode)
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+def find_json(path):
+    """Return the existing file for JSON document *path* (e.g. .../toc.json),
+trying the compressed variants first, or None.
+"""
+    for suffix in ('.zst', '.gz', ''):
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return None
+
+
+def write_json(path, obj, compression='zstd'):
+    """Write *obj* as JSON to *path* plus the suffix for *compression* and remove
+stale variants of the same document. Falls back to gzip if zstandard is not
+installed. Returns the filename written.
+"""
+    if compression == 'zstd' and zstandard is None:
+        compression = 'gzip'
+    filename = path + JSON_SUFFIXES.get(compression, '')
+    with atomic_path(filename) as temp:
+        with _open_compressed(temp, 'wb') as fd:
+            fd.write(json.dumps(obj).encode('utf-8'))
+    for suffix in JSON_SUFFIXES.values():
+        if path + suffix != filename and os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    return filename
+
+
+def read_json(path):
+    """Read JSON document *path* from whichever compressed variant exists."""
+    filename = find_json(path)
+    if filename is None:
+        raise FileNotFoundError(path)
+    with _open_compressed(filename, 'rb') as fd:
+        return json.loads(fd.read().decode('utf-8'))
+
+
+def decode_json(data, filename):
+    """Decode JSON document *data* read from *filename*, decompressing by its
+suffix.
+"""
+    if filename.endswith('.zst'):
+        if zstandard is None:
+            raise IOError('zstandard is required to read {0}'.format(filename))
+        with zstandard.open(BytesIO(data), 'rb') as fd:
+            data = fd.read()
+    elif filename.endswith('.gz'):
+        data = gzip.decompress(data)
+    return json.loads(data.decode('utf-8'))
@@ -0,0 +1,210 @@
+from collections import namedtuple
+import logging
+import os
+import re
+import threading
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# logging
+logger = logging.getLogger('watcher')
+
+# a change in the cache; page and rendition are set for page_completed only
+CacheEvent = namedtuple('CacheEvent', [
+    'kind', 'pub_code', 'edition_code', 'date', 'page', 'rendition'])
+
+EDITION_ADDED = 'edition_added'
+PAGE_COMPLETED = 'page_completed'
+EDITION_PACKED = 'edition_packed'
+EDITION_EVICTED = 'edition_evicted'
+
+PAGE_FILE = re.compile(r'^page-(\d+)-(\w+)\.(jpg|webp|avif|pdf)$')
+DATE_DIR = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+TOC_FILES = ('toc.json', 'toc.json.zst', 'toc.json.gz')
+
+
+class CacheWatcher:
+    '''Watch cache_dir for editions appearing, page files being completed and
+editions being packed or evicted, and call *callback*(CacheEvent) from a
+background thread for each change.
+
+With the optional inotify_simple package (Linux) only the directories inotify
+reports as changed are looked at. Elsewhere the cache is rescanned every
+*interval* seconds. Files are complete when they appear: everything in the
+cache is written to a temporary file and renamed into place.
+
+    '''
+
+    def __init__(self, cache_dir=None, callback=None, interval=5.0,
+                 use_inotify=True):
+        self.cache_dir = os.path.realpath(cache_dir)
+        self.callback = callback
+        self.interval = interval
+        # (pub, edition, date): (packed, page file names)
+        self.editions = {}
+        self._inotify = None
+        if use_inotify and inotify_simple is not None:
+            try:
+                self._inotify = inotify_simple.INotify()
+            except OSError as e:
+                logger.error('inotify unavailable, polling: {0}'.format(e))
+        # watch descriptor -> directory
+        self._watches = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def backend(self):
+        return 'inotify' if self._inotify is not None else 'poll'
+
+    def _emit(self, kind, key, page=None, rendition=None):
+        event = CacheEvent(kind, key[0], key[1], key[2], page, rendition)
+        logger.debug('{0}'.format(event))
+        if self.callback is not None:
+            try:
+                self.callback(event)
+            except Exception:
+                logger.exception('cache event callback failed')
+
+    def _watch(self, path):
+        if self._inotify is None or path in self._watches.values():
+            return
+        flags = inotify_simple.flags
+        try:
+            wd = self._inotify.add_watch(
+                path, flags.CREATE | flags.MOVED_TO | flags.CLOSE_WRITE |
+                flags.DELETE | flags.MOVED_FROM)
+        except OSError:
+            # removed in the meantime
+            return
+        self._watches[wd] = path
+
+    def _edition_state(self, key):
+        download_path = os.path.join(self.cache_dir, *key)
+        try:
+            names = os.listdir(download_path)
+        except OSError:
+            names = None
+        if names is not None and any(name in names for name in TOC_FILES):
+            return (False, frozenset(name for name in names
+                                     if PAGE_FILE.match(name)))
+        if os.path.exists(download_path + '.zip'):
+            old = self.editions.get(key)
+            return (True, old[1] if old else frozenset())
+        return None
+
+    def update_edition(self, key, emit=True):
+        '''Compare an edition with what is known about it, emitting events.'''
+        state = self._edition_state(key)
+        old = self.editions.get(key)
+        if state is None:
+            if old is not None:
+                del self.editions[key]
+                if emit:
+                    self._emit(EDITION_EVICTED, key)
+            return
+        self.editions[key] = state
+        if not emit:
+            return
+        if old is None:
+            self._emit(EDITION_ADDED, key)
+        elif state[0] and not old[0]:
+            self._emit(EDITION_PACKED, key)
+        for name in sorted(state[1] - (old[1] if old else frozenset())):
+            match = PAGE_FILE.match(name)
+            self._emit(PAGE_COMPLETED, key, page=int(match.group(1)),
+                       rendition='pdf' if match.group(3) == 'pdf'
+                       else match.group(2))
+
+    def _subdirs(self, path):
+        try:
+            return sorted(name for name in os.listdir(path)
+                          if not name.startswith('.') and
+                          os.path.isdir(os.path.join(path, name)))
+        except OSError:
+            return []
+
+    def scan(self, emit=True):
+        '''Rescan the whole cache; with polling this is the source of events.'''
+        self._watch(self.cache_dir)
+        seen = set()
+        for pub_code in self._subdirs(self.cache_dir):
+            self._watch(os.path.join(self.cache_dir, pub_code))
+            for edition_code in self._subdirs(
+                    os.path.join(self.cache_dir, pub_code)):
+                path = os.path.join(self.cache_dir, pub_code, edition_code)
+                self._watch(path)
+                try:
+                    names = os.listdir(path)
+                except OSError:
+                    continue
+                for name in names:
+                    if DATE_DIR.match(name) and \
+                       os.path.isdir(os.path.join(path, name)):
+                        self._watch(os.path.join(path, name))
+                        seen.add((pub_code, edition_code, name))
+                    elif name.endswith('.zip') and DATE_DIR.match(name[:-4]):
+                        seen.add((pub_code, edition_code, name[:-4]))
+        for key in sorted(seen | set(self.editions)):
+            self.update_edition(key, emit=emit)
+
+    def _handle(self, event):
+        flags = inotify_simple.flags
+        if event.mask & flags.Q_OVERFLOW:
+            # events were lost
+            self.scan()
+            return
+        if event.mask & flags.IGNORED:
+            self._watches.pop(event.wd, None)
+            return
+        path = self._watches.get(event.wd)
+        if path is None:
+            return
+        parts = os.path.relpath(path, self.cache_dir).split(os.sep)
+        if path == self.cache_dir or len(parts) < 2:
+            # a new publication or edition directory
+            if event.mask & flags.ISDIR:
+                self.scan()
+        elif len(parts) == 2:
+            # a date directory or edition archive
+            name = event.name[:-4] if event.name.endswith('.zip') \
+                else event.name
+            if not DATE_DIR.match(name):
+                return
+            if event.mask & flags.ISDIR and \
+               event.mask & (flags.CREATE | flags.MOVED_TO):
+                self._watch(os.path.join(path, name))
+            self.update_edition((parts[0], parts[1], name))
+        elif len(parts) == 3 and not event.name.startswith('.'):
+            self.update_edition(tuple(parts))
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self._inotify is None:
+                if self._stop.wait(self.interval):
+                    break
+                self.scan()
+                continue
+            for event in self._inotify.read(timeout=1000):
+                self._handle(event)
+
+    def start(self):
+        '''Learn the current state of the cache without emitting events, then
+watch it in a daemon thread.'''
+        self.scan(emit=False)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logger.info('watching {0} ({1})'.format(self.cache_dir, self.backend))
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
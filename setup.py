@@ -49,6 +49,25 @@ setup(
         'prompt_toolkit',
     ],
     extras_require={
+        'http2': [
+            'httpx[http2]',
+        ],
+        'compression': [
+            'brotli',
+            'zstandard',
+        ],
+        'dedupe': [
+            'numpy',
+        ],
+        'watch': [
+            'inotify_simple',
+        ],
+        'text': [
+            'pypdf',
+        ],
+        's3': [
+            'boto3',
+        ],
         'dev': [
             'check-manifest',
         ],
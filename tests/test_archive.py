@@ -0,0 +1,132 @@
+import os
+import struct
+import zipfile
+
+import pytest
+
+from epaper.appconfig import AppConfig
+from epaper.archive import (EditionArchive, archive_path, pack_edition,
+                            unpack_edition, verify_archive)
+from epaper.epaper import EPaper
+from epaper.utils import write_json
+
+FILES = {
+    'page-001-thumbnail.jpg': b'thumbnail' * 10,
+    'page-001-lowres.webp': b'lowres' * 1000,
+    'page-002-highres.pdf': os.urandom(5000),
+}
+
+
+@pytest.fixture
+def download_path(tmpdir):
+    path = os.path.join(str(tmpdir), 'TOI', 'BOM', '2024-01-02')
+    os.makedirs(os.path.join(path, '.leases'))
+    for name, data in FILES.items():
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(data)
+    with open(os.path.join(path, '.page-003-lowres.tmp.jpg'), 'wb') as f:
+        f.write(b'partial')
+    write_json(os.path.join(path, 'toc.json'), {'toc': []}, compression='gzip')
+    return path
+
+
+def test_pack_edition(download_path):
+    filename = pack_edition(download_path)
+    assert filename == archive_path(download_path)
+    assert filename.endswith(os.path.join('BOM', '2024-01-02.zip'))
+    assert not os.path.exists(download_path)
+    with zipfile.ZipFile(filename) as zf:
+        assert sorted(zf.namelist()) == sorted(list(FILES) + ['toc.json.gz'])
+        assert all(info.compress_type == zipfile.ZIP_STORED
+                   for info in zf.infolist())
+
+
+def test_offsets_point_at_member_data(download_path):
+    archive = EditionArchive(pack_edition(download_path))
+    with open(archive.filename, 'rb') as f:
+        content = f.read()
+    for name, data in FILES.items():
+        offset, size = archive.locate(name)
+        assert size == len(data)
+        assert content[offset:offset + size] == data
+        assert archive.read(name) == data
+        assert archive.open(name).read() == data
+    assert archive.locate('missing.jpg') is None
+    archive.close()
+
+
+def test_local_extra_field(tmpdir):
+    # member data starts after the extra field of the local header
+    filename = os.path.join(str(tmpdir), 'extra.zip')
+    with zipfile.ZipFile(filename, 'w') as zf:
+        info = zipfile.ZipInfo('page-001-thumbnail.jpg')
+        info.extra = struct.pack('<HH', 0xcafe, 4) + b'pad!'
+        zf.writestr(info, b'image')
+        zf.writestr('toc.json', b'{}', compress_type=zipfile.ZIP_DEFLATED)
+    archive = EditionArchive(filename)
+    assert archive.read('page-001-thumbnail.jpg') == b'image'
+    # compressed members cannot be sliced out of the file
+    assert archive.locate('toc.json') is None
+    archive.close()
+
+
+def test_json_and_images(download_path):
+    archive = EditionArchive(pack_edition(download_path))
+    assert archive.find_json('toc.json') == 'toc.json.gz'
+    assert archive.read_json('toc.json') == {'toc': []}
+    with pytest.raises(FileNotFoundError):
+        archive.read_json('sync.json')
+    assert archive.resolve_image('page-001-lowres.jpg') == \
+        'page-001-lowres.webp'
+    assert archive.resolve_image('page-001-thumbnail.jpg') == \
+        'page-001-thumbnail.jpg'
+    assert archive.resolve_image('page-002-highres.jpg') is None
+    archive.close()
+
+
+def test_unpack_edition(download_path):
+    pack_edition(download_path)
+    unpack_edition(download_path)
+    assert not os.path.exists(archive_path(download_path))
+    for name, data in FILES.items():
+        with open(os.path.join(download_path, name), 'rb') as f:
+            assert f.read() == data
+
+
+def test_verify_archive(download_path):
+    archive = EditionArchive(pack_edition(download_path))
+    assert verify_archive(archive.filename) == []
+    offset, size = archive.locate('page-002-highres.pdf')
+    archive.close()
+    with open(archive.filename, 'r+b') as f:
+        f.seek(offset + size // 2)
+        byte = f.read(1)
+        f.seek(offset + size // 2)
+        f.write(bytes([byte[0] ^ 0xff]))
+    assert verify_archive(archive.filename) == ['page-002-highres.pdf']
+
+
+@pytest.mark.parametrize('length', [0, 100, -30])
+def test_truncated_archive(download_path, length):
+    filename = pack_edition(download_path)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    with open(filename, 'wb') as f:
+        f.write(data[:length])
+    with pytest.raises(IOError):
+        EditionArchive(filename)
+    with pytest.raises(IOError):
+        verify_archive(filename)
+
+
+def test_open_truncated_archive(download_path, tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    app_config = AppConfig()
+    app_config.config['App']['cache_dir'] = str(tmpdir)
+    epaper = EPaper(publisher='TOI', app_config=app_config)
+    filename = pack_edition(download_path)
+    with open(filename, 'r+b') as f:
+        f.truncate(200)
+    assert epaper.open_archive(download_path) is None
+    assert epaper.load_pub('TOI', 'BOM', '2024-01-02') == (None, None)
+    assert epaper.describe_pub('TOI', 'BOM', '2024-01-02')['pages'] == []
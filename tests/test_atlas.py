@@ -0,0 +1,109 @@
+import os
+
+from PIL import Image, ImageColor
+import pytest
+
+from epaper.archive import EditionArchive, archive_path, pack_edition
+from epaper.atlas import ThumbnailAtlas, atlas_paths, build_atlas
+from epaper.utils import read_json
+
+COLOURS = ['red', 'green', 'blue', 'yellow', 'purple']
+
+
+@pytest.fixture
+def download_path(tmpdir):
+    path = os.path.join(str(tmpdir), 'TOI', 'BOM', '2024-01-02')
+    os.makedirs(path)
+    return path
+
+
+def write_thumbnails(download_path, sizes):
+    thumbnails = {}
+    for number, size in enumerate(sizes, 1):
+        filename = os.path.join(download_path,
+                                'page-{0:03d}-thumbnail.jpg'.format(number))
+        Image.new('RGB', size, COLOURS[number - 1]).save(filename, 'JPEG')
+        thumbnails[number] = filename
+    return thumbnails
+
+
+def colour(image):
+    '''The colour name of the middle pixel of *image*.'''
+    pixel = image.convert('RGB').getpixel((image.size[0] // 2,
+                                           image.size[1] // 2))
+    return min(COLOURS, key=lambda name: sum(
+        (a - b) ** 2 for a, b in zip(ImageColor.getrgb(name), pixel)))
+
+
+def test_build_atlas(download_path):
+    thumbnails = write_thumbnails(
+        download_path, [(40, 60), (40, 50), (30, 60), (40, 70), (20, 20)])
+    filename = build_atlas(download_path, thumbnails, compression='none')
+    assert filename == os.path.join(download_path, 'thumbnails.jpg')
+    assert atlas_paths(download_path) == (
+        filename, os.path.join(download_path, 'thumbnails.json'))
+    # rows of 3 pages, each as high as its tallest thumbnail
+    index = read_json(os.path.join(download_path, 'thumbnails.json'))
+    assert index['size'] == [110, 130]
+    assert index['pages'] == {
+        '1': [0, 0, 40, 60], '2': [40, 0, 80, 50], '3': [80, 0, 110, 60],
+        '4': [0, 60, 40, 130], '5': [40, 60, 60, 80]}
+    with Image.open(filename) as image:
+        assert image.size == (110, 130)
+
+
+def test_build_atlas_storage_format(download_path):
+    thumbnails = write_thumbnails(download_path, [(40, 60), (40, 60)])
+    build_atlas(download_path, thumbnails, compression='none')
+    filename = build_atlas(download_path, thumbnails, storage_format='webp',
+                           compression='none')
+    assert filename == os.path.join(download_path, 'thumbnails.webp')
+    # the atlas in the old format is removed
+    assert not os.path.exists(os.path.join(download_path, 'thumbnails.jpg'))
+    assert atlas_paths(download_path)[0] == filename
+
+
+def test_build_atlas_unreadable_thumbnails(download_path):
+    thumbnails = write_thumbnails(download_path, [(40, 60)])
+    thumbnails[2] = os.path.join(download_path, 'page-002-thumbnail.jpg')
+    with open(thumbnails[2], 'wb') as f:
+        f.write(b'not an image')
+    build_atlas(download_path, thumbnails, compression='none')
+    assert list(read_json(os.path.join(
+        download_path, 'thumbnails.json'))['pages']) == ['1']
+    assert build_atlas(download_path, {2: thumbnails[2]}) is None
+    assert build_atlas(download_path, {}) is None
+
+
+def test_thumbnail_atlas(download_path):
+    thumbnails = write_thumbnails(download_path, [(40, 60), (40, 60), (40, 60)])
+    build_atlas(download_path, thumbnails, storage_format='webp')
+    atlas = ThumbnailAtlas(download_path)
+    assert atlas.filename == os.path.join(download_path, 'thumbnails.webp')
+    assert atlas.thumbnail(2).size == (40, 60)
+    assert colour(atlas.thumbnail(2)) == 'green'
+    assert atlas.thumbnail(9) is None
+    assert not atlas.is_stale()
+    os.utime(atlas.filename, (0, 0))
+    assert atlas.is_stale()
+    os.remove(atlas.filename)
+    assert atlas.is_stale()
+
+
+def test_thumbnail_atlas_missing(download_path):
+    with pytest.raises(FileNotFoundError):
+        ThumbnailAtlas(download_path)
+
+
+def test_thumbnail_atlas_from_archive(download_path):
+    thumbnails = write_thumbnails(download_path, [(40, 60), (40, 60)])
+    build_atlas(download_path, thumbnails, storage_format='webp')
+    pack_edition(download_path)
+    assert not os.path.exists(download_path)
+    archive = EditionArchive(archive_path(download_path))
+    try:
+        atlas = ThumbnailAtlas(download_path, archive)
+        assert colour(atlas.thumbnail(1)) == 'red'
+        assert not atlas.is_stale()
+    finally:
+        archive.close()
@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+import os
+import threading
+
+import pytest
+
+from epaper.appconfig import AppConfig
+from epaper.availability import AvailabilityProber, candidate_dates
+from epaper.scraper import Scraper
+
+
+class FakeScraper(Scraper):
+    '''Editions exist unless their toc.json URL is in *missing*; URLs in
+*unknown* cannot be checked.'''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.missing = set()
+        self.unknown = set()
+        self.checked = []
+        self._lock = threading.Lock()
+
+    def toc_url(self, edition_code, date_str):
+        return self.build_toc_url(pub_code='TOI', edition_code=edition_code,
+                                  date_str=date_str)
+
+    def exists(self, url):
+        with self._lock:
+            self.checked.append(url)
+        if url in self.unknown:
+            return None
+        return url not in self.missing
+
+
+@pytest.fixture
+def app_config(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    return AppConfig()
+
+
+@pytest.fixture
+def scraper(app_config):
+    return FakeScraper(publisher='TOI', app_config=app_config)
+
+
+def prober(scraper, app_config, **kwargs):
+    kwargs.setdefault('ttl', 600)
+    return AvailabilityProber(
+        scraper=scraper, cache_dir=app_config.config['App']['cache_dir'],
+        compression='none', **kwargs)
+
+
+DATES = ['20240103', '20240102', '20240101']
+
+
+def test_candidate_dates():
+    dates = candidate_dates(2)
+    today = datetime.today().date()
+    assert dates == [(today - timedelta(i)).strftime('%Y%m%d')
+                     for i in range(3)]
+    assert len(candidate_dates()) == 8
+
+
+def test_available_dates(scraper, app_config):
+    scraper.missing.add(scraper.toc_url('BOM', '20240102'))
+    scraper.unknown.add(scraper.toc_url('BOM', '20240101'))
+    p = prober(scraper, app_config)
+    # an unknown date is offered
+    assert p.available_dates('TOI', 'BOM', DATES) == ['20240103', '20240101']
+    assert len(scraper.checked) == 3
+
+
+def test_available_editions(scraper, app_config):
+    scraper.missing.add(scraper.toc_url('DEL', '20240103'))
+    p = prober(scraper, app_config, workers=4)
+    assert p.available_editions('TOI', ['BOM', 'DEL'], DATES) == {
+        'BOM': DATES, 'DEL': ['20240102', '20240101']}
+    assert len(scraper.checked) == 6
+
+
+def test_results_are_cached(scraper, app_config):
+    scraper.unknown.add(scraper.toc_url('BOM', '20240101'))
+    prober(scraper, app_config).available_dates('TOI', 'BOM', DATES)
+    assert os.path.exists(os.path.join(app_config.config['App']['cache_dir'],
+                                       'availability.json'))
+    del scraper.checked[:]
+    # a later run only checks again what was unknown
+    scraper.unknown.clear()
+    scraper.missing.add(scraper.toc_url('BOM', '20240101'))
+    p = prober(scraper, app_config)
+    assert p.available_dates('TOI', 'BOM', DATES) == DATES[:2]
+    assert scraper.checked == [scraper.toc_url('BOM', '20240101')]
+    del scraper.checked[:]
+    assert p.available_dates('TOI', 'BOM', DATES) == DATES[:2]
+    assert scraper.checked == []
+
+
+def test_expired_results(scraper, app_config):
+    p = prober(scraper, app_config, ttl=0)
+    p.available_dates('TOI', 'BOM', DATES)
+    assert p.cache == {}
+    p.available_dates('TOI', 'BOM', DATES)
+    assert len(scraper.checked) == 6
+
+
+def test_from_config(scraper, app_config):
+    app_config.config['Http']['probe_ttl'] = '30'
+    app_config.config['Http']['probe_workers'] = '2'
+    p = AvailabilityProber.from_config(scraper, app_config)
+    assert (p.ttl, p.workers) == (30, 2)
+    assert p.path == os.path.join(app_config.config['App']['cache_dir'],
+                                  'availability.json')
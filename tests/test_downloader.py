@@ -0,0 +1,298 @@
+from contextlib import contextmanager
+from io import BytesIO
+import asyncio
+import json
+import os
+import time
+
+from PIL import Image
+import pytest
+
+from epaper import downloader
+from epaper.appconfig import AppConfig
+from epaper.archive import archive_path
+from epaper.downloader import DownloadError, Downloader
+from epaper.manifest import Manifest
+from epaper.scheduler import DownloadScheduler
+from epaper.scraper import Scraper
+from epaper.selection import PageSelection
+from epaper.transport import Transport
+
+ARCHIVE_HTML = '''<select id="Publications">
+<option value="TOI">The Times of India</option></select>
+<select id="Editions"><option value="BOM">Mumbai</option></select>'''
+
+
+def jpeg(colour):
+    out = BytesIO()
+    Image.new('RGB', (40, 60), colour).save(out, 'JPEG')
+    return out.getvalue()
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, headers=None, content=b''):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = content
+
+    def iter_content(self, chunk_size=None):
+        yield self.content
+
+
+class FakeTransport(Transport):
+    '''Serve an edition from memory: url -> (content type, body). HEAD requests
+report *head_sizes* [url suffix: bytes] as Content-Length when given.'''
+
+    name = 'fake'
+
+    def __init__(self, site_url, pages=3, head_sizes=None):
+        super().__init__()
+        self.head_sizes = head_sizes or {}
+        self.requests = []
+        # called with the URL of every GET
+        self.on_request = None
+        self.files = {}
+        archive = site_url + '/Search/Archives'
+        self.files[archive] = ('text/html', ARCHIVE_HTML.encode())
+        self.files[archive + '?PUB=TOI'] = ('text/html', ARCHIVE_HTML.encode())
+        edition_url = site_url + '/Repository/TOI/BOM/20240102'
+        toc = {'toc': [{'page': str(n), 'page_title': 'Page {0}'.format(n),
+                        'page_folder': 'Page{0:03d}'.format(n)}
+                       for n in range(1, pages + 1)]}
+        self.files[edition_url + '/toc.json'] = (
+            'application/json', json.dumps(toc).encode())
+        for n in range(1, pages + 1):
+            page_url = '{0}/Page{1:03d}/'.format(edition_url, n)
+            for name in ('page_thumbnail.jpg', 'big_page.jpg', 'big_page2.jpg'):
+                self.files[page_url + name] = ('image/jpeg', jpeg((n * 60, 0, 0)))
+
+    def _response(self, url, body=True):
+        if url not in self.files:
+            return FakeResponse(404)
+        content_type, content = self.files[url]
+        headers = {'Content-Type': content_type,
+                   'Content-Length': str(len(content)),
+                   'ETag': '"{0}"'.format(len(content))}
+        return FakeResponse(200, headers, content if body else b'')
+
+    def get(self, url, headers=None):
+        self.requests.append(('GET', url))
+        return self._response(url)
+
+    def head(self, url, headers=None):
+        self.requests.append(('HEAD', url))
+        res = self._response(url, body=False)
+        for suffix, size in self.head_sizes.items():
+            if url.endswith(suffix):
+                res.headers['Content-Length'] = str(size)
+        return res
+
+    @contextmanager
+    def stream(self, url, headers=None):
+        self.requests.append(('GET', url))
+        if self.on_request is not None:
+            self.on_request(url)
+        yield self._response(url)
+
+    def gets(self, suffix=''):
+        return [url for method, url in self.requests
+                if method == 'GET' and url.endswith(suffix)]
+
+
+@pytest.fixture
+def app_config(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    app_config = AppConfig()
+    app_config.config['Http']['workers'] = '2'
+    return app_config
+
+
+@pytest.fixture
+def transport(app_config):
+    return FakeTransport(app_config.config['TOI']['site_url'])
+
+
+def make_downloader(app_config, transport, **kwargs):
+    scraper = Scraper(publisher='TOI', app_config=app_config)
+    scraper.transport = transport
+    kwargs.setdefault('selection', PageSelection())
+    return Downloader(pub_code='TOI', edition_code='BOM', date='2024-01-02',
+                      app_config=app_config, scraper=scraper, deadline='',
+                      **kwargs)
+
+
+def test_run(app_config, transport):
+    progress = []
+    d = make_downloader(app_config, transport, on_progress=progress.append)
+    report = d.run()
+    assert report.downloaded == 3
+    assert report.failed == []
+    assert report.postponed == []
+    assert not report.cancelled
+    assert report.download_path == os.path.join(
+        app_config.config['App']['cache_dir'], 'TOI', 'BOM', '2024-01-02')
+    assert d.epaper.selected_publication == ('The Times of India', 'TOI')
+    assert d.epaper.selected_edition == ('Mumbai', 'BOM')
+    for page in (1, 2, 3):
+        for rendition in ('thumbnail', 'lowres', 'highres'):
+            assert os.path.exists(os.path.join(
+                report.download_path,
+                'page-{0:03d}-{1}.jpg'.format(page, rendition)))
+    # ETags are recorded for `epaper sync`
+    manifest = Manifest(report.download_path)
+    assert manifest.entries['page-001-lowres.jpg']['etag'] is not None
+    stages = [p.stage for p in progress]
+    assert stages[0] == 'metadata'
+    assert stages.count('tier') == 3
+    assert stages[-1] == 'done'
+
+
+def test_iteration_in_tier_order(app_config, transport):
+    app_config.config['Http']['workers'] = '1'
+    d = make_downloader(app_config, transport)
+    results = list(d)
+    assert [(r.page.number, r.rendition) for r in results] == [
+        (page, rendition)
+        for rendition in ('thumbnail', 'lowres', 'highres')
+        for page in (1, 2, 3)]
+    assert all(r.ok for r in results)
+    assert results[0].filename == os.path.join(
+        d.report.download_path, 'page-001-thumbnail.jpg')
+    assert d.report.downloaded == 3
+
+
+def test_async_iteration(app_config, transport):
+    d = make_downloader(app_config, transport)
+
+    async def download():
+        return [result async for result in d]
+
+    results = asyncio.run(download())
+    assert len(results) == 9
+    assert all(r.ok for r in results)
+    assert d.report.downloaded == 3
+
+
+def test_selection(app_config, transport):
+    d = make_downloader(app_config, transport, selection=PageSelection(
+        pages='2', renditions='thumbnail,lowres'))
+    assert sorted(r.rendition for r in d) == ['lowres', 'thumbnail']
+    assert d.report.downloaded == 1
+    assert len(transport.gets('.jpg')) == 2
+    assert all('/Page002/' in url for url in transport.gets('.jpg'))
+
+
+def test_failed_page(app_config, transport):
+    site_url = app_config.config['TOI']['site_url']
+    for name in ('big_page.jpg', 'big_page2.jpg'):
+        del transport.files[
+            site_url + '/Repository/TOI/BOM/20240102/Page002/' + name]
+    report = make_downloader(app_config, transport).run()
+    assert report.downloaded == 2
+    assert report.failed == [2]
+
+
+def test_existing_files_are_skipped(app_config, transport):
+    make_downloader(app_config, transport).run()
+    del transport.requests[:]
+    report = make_downloader(app_config, transport).run()
+    assert report.downloaded == 3
+    assert transport.gets('.jpg') == []
+
+
+def test_missing_toc(app_config, transport):
+    transport.files = dict((url, v) for url, v in transport.files.items()
+                           if not url.endswith('toc.json'))
+    with pytest.raises(DownloadError):
+        make_downloader(app_config, transport).run()
+
+
+def test_unknown_edition(app_config, transport):
+    scraper = Scraper(publisher='TOI', app_config=app_config)
+    scraper.transport = transport
+    d = Downloader(pub_code='TOI', edition_code='XYZ', date='2024-01-02',
+                   app_config=app_config, scraper=scraper,
+                   selection=PageSelection(), deadline='')
+    with pytest.raises(DownloadError):
+        d.prepare()
+
+
+def test_closing_iteration_cancels(app_config, transport):
+    app_config.config['Http']['workers'] = '1'
+    d = make_downloader(app_config, transport)
+    results = iter(d)
+    next(results)
+    results.close()
+    assert d.report.cancelled
+    assert len(transport.gets('.jpg')) < 9
+
+
+def test_bump_page_on_display(app_config, transport):
+    app_config.config['Http']['workers'] = '1'
+    d = make_downloader(app_config, transport)
+
+    def on_request(url):
+        # a viewer turns to page 3 while the first thumbnail downloads
+        if url.endswith('/Page001/page_thumbnail.jpg'):
+            d.epaper.select_page(2)
+
+    transport.on_request = on_request
+    assert [(r.page.number, r.rendition) for r in d][:4] == [
+        (1, 'thumbnail'), (3, 'thumbnail'), (3, 'lowres'), (3, 'highres')]
+
+
+class FixedMeter:
+
+    def add(self, nbytes):
+        pass
+
+    def rate(self):
+        return 1000
+
+
+class PlannedScheduler(DownloadScheduler):
+    '''Plans before every job at a fixed 1000 bytes/s.'''
+
+    def __init__(self, **kwargs):
+        kwargs['plan_interval'] = 0
+        super().__init__(**kwargs)
+        self.meter = FixedMeter()
+
+
+def test_deadline_and_upgrade(app_config, transport, monkeypatch):
+    monkeypatch.setattr(downloader, 'DownloadScheduler', PlannedScheduler)
+    # highres images look too large to make it in time
+    transport.head_sizes = {'big_page2.jpg': 10 ** 9}
+    d = make_downloader(app_config, transport)
+    d.deadline = time.time() + 60
+    results = list(d)
+    assert [r.rendition for r in results].count('highres') == 0
+    assert d.report.postponed == [1, 2, 3]
+    # postponed renditions do not count as failed
+    assert d.report.downloaded == 3
+    assert d.report.failed == []
+
+    upgraded = d.upgrade()
+    assert sorted((r.page.number, r.rendition) for r in upgraded) == [
+        (1, 'highres'), (2, 'highres'), (3, 'highres')]
+    assert d.report.postponed == []
+    assert os.path.exists(os.path.join(d.report.download_path,
+                                       'page-003-highres.jpg'))
+    assert d.upgrade() == []
+
+
+def test_post_processing(app_config, transport):
+    config = app_config.config['App']
+    config['storage_format'] = 'webp'
+    config['transcode_workers'] = '1'
+    config['pack_editions'] = 'yes'
+    report = make_downloader(app_config, transport).run()
+    assert report.failed == []
+    # transcoded, then packed into one archive
+    assert not os.path.exists(report.download_path)
+    assert os.path.exists(archive_path(report.download_path))
+    epaper = make_downloader(app_config, transport).epaper
+    assert epaper.open_pub('TOI', 'BOM', '2024-01-02')
+    assert [os.path.basename(p.urls['lowres'][1]) for p in epaper.pages] == [
+        'page-001-lowres.webp', 'page-002-lowres.webp', 'page-003-lowres.webp']
@@ -0,0 +1,86 @@
+import json
+import os
+import threading
+import time
+
+from epaper.lease import LeaseManager
+
+
+def make_stale(manager, key):
+    old = time.time() - manager.ttl - 1
+    os.utime(manager._path(key), (old, old))
+
+
+def owner(manager, key):
+    with open(manager._path(key)) as f:
+        return json.loads(f.read())['owner']
+
+
+def test_claim_is_exclusive(tmpdir):
+    a = LeaseManager(str(tmpdir), ttl=60, owner='a')
+    b = LeaseManager(str(tmpdir), ttl=60, owner='b')
+    assert a.claim('page-001')
+    assert not b.claim('page-001')
+    assert b.claim('page-002')
+    assert owner(a, 'page-001') == 'a'
+
+
+def test_release_frees_lease(tmpdir):
+    a = LeaseManager(str(tmpdir), ttl=60, owner='a')
+    b = LeaseManager(str(tmpdir), ttl=60, owner='b')
+    a.claim('page-001')
+    a.release('page-001')
+    assert b.claim('page-001')
+
+
+def test_release_keeps_other_owners_lease(tmpdir):
+    a = LeaseManager(str(tmpdir), ttl=60, owner='a')
+    b = LeaseManager(str(tmpdir), ttl=60, owner='b')
+    b.claim('page-001')
+    a.release('page-001')
+    assert owner(b, 'page-001') == 'b'
+
+
+def test_stale_lease_is_taken_over(tmpdir):
+    a = LeaseManager(str(tmpdir), ttl=60, owner='a')
+    b = LeaseManager(str(tmpdir), ttl=60, owner='b')
+    a.claim('page-001')
+    make_stale(a, 'page-001')
+    assert b.claim('page-001')
+    assert owner(b, 'page-001') == 'b'
+    # the dead worker's release does not drop the new lease
+    a.release('page-001')
+    assert owner(b, 'page-001') == 'b'
+
+
+def test_renew_keeps_lease_fresh(tmpdir):
+    a = LeaseManager(str(tmpdir), ttl=60, owner='a')
+    b = LeaseManager(str(tmpdir), ttl=60, owner='b')
+    a.claim('page-001')
+    make_stale(a, 'page-001')
+    a.renew()
+    assert not b.claim('page-001')
+
+
+def test_one_takeover_wins(tmpdir):
+    managers = [LeaseManager(str(tmpdir), ttl=60, owner=str(i))
+                for i in range(8)]
+    managers[0].claim('page-001')
+    make_stale(managers[0], 'page-001')
+    won = []
+    start = threading.Barrier(len(managers) - 1)
+
+    def claim(manager):
+        start.wait()
+        if manager.claim('page-001'):
+            won.append(manager.owner)
+
+    threads = [threading.Thread(target=claim, args=(manager,))
+               for manager in managers[1:]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(won) == 1
+    assert owner(managers[0], 'page-001') == won[0]
+    assert sorted(os.listdir(str(tmpdir))) == ['.takeover', 'page-001.lease']
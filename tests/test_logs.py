@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+
+import pytest
+
+from epaper import logs
+from epaper.appconfig import AppConfig
+from epaper.logs import log_event, setup_logging, stop_logging
+
+
+@pytest.fixture
+def app_config(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    app_config = AppConfig()
+    app_config.config['App']['log_file'] = os.path.join(str(tmpdir), 'epaper.log')
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    yield app_config
+    stop_logging()
+    root.handlers, root.level = handlers, level
+    logs._sample_rate = 1.0
+
+
+def read_log(app_config):
+    with open(app_config.config['App']['log_file']) as f:
+        return f.read().splitlines()
+
+
+def test_text_log(app_config):
+    listener = setup_logging(app_config)
+    # set up once
+    assert setup_logging(app_config) is listener
+    logger = logging.getLogger('test')
+    logger.info('hello %s', 'world')
+    logger.debug('not logged')
+    log_event(logger, 'page_rendition_done', page=3, rendition='lowres')
+    stop_logging()
+    lines = read_log(app_config)
+    assert len(lines) == 2
+    assert lines[0].endswith(' - test - INFO - hello world')
+    assert lines[1].endswith(
+        ' - test - INFO - page_rendition_done page=3 rendition=lowres')
+
+
+def test_json_log(app_config):
+    app_config.config['App']['log_format'] = 'json'
+    app_config.config['App']['log_level'] = 'debug'
+    setup_logging(app_config)
+    logger = logging.getLogger('test')
+    logger.debug('hello')
+    log_event(logger, 'http_request', url='https://example.com', status=200)
+    try:
+        raise ValueError('bad page')
+    except ValueError:
+        logger.exception('failed')
+    stop_logging()
+    entries = [json.loads(line) for line in read_log(app_config)]
+    assert [e['level'] for e in entries] == ['DEBUG', 'INFO', 'ERROR']
+    assert entries[0]['message'] == 'hello'
+    assert entries[1]['event'] == 'http_request'
+    assert entries[1]['url'] == 'https://example.com'
+    assert entries[1]['status'] == 200
+    assert 'ValueError: bad page' in entries[2]['exc_info']
+
+
+def test_records_are_queued_unformatted(app_config):
+    setup_logging(app_config)
+    handler = logging.getLogger().handlers[0]
+    record = logging.LogRecord('test', logging.INFO, __file__, 1, 'page %s',
+                               (['front'],), None)
+    # the listener thread, not the logging thread, formats the message
+    assert handler.prepare(record) is record
+    assert record.args == (['front'],)
+    assert not hasattr(record, 'message')
+
+
+def test_sampled_events(app_config, monkeypatch):
+    app_config.config['App']['log_sample_rate'] = '0.5'
+    setup_logging(app_config)
+    logger = logging.getLogger('test')
+    values = iter([0.1, 0.9])
+    monkeypatch.setattr(logs.random, 'random', lambda: next(values))
+    log_event(logger, 'http_request', sampled=True, url='a')
+    log_event(logger, 'http_request', sampled=True, url='b')
+    # not sampled: always logged
+    log_event(logger, 'page_rendition_done', page=1)
+    stop_logging()
+    lines = read_log(app_config)
+    assert len(lines) == 2
+    assert lines[0].endswith('http_request url=a')
+    assert lines[1].endswith('page_rendition_done page=1')
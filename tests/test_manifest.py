@@ -0,0 +1,127 @@
+import os
+
+from PIL import Image
+import pytest
+
+from epaper.appconfig import AppConfig
+from epaper.archive import archive_path, pack_edition
+from epaper.epaper import EPaper
+from epaper.manifest import (Manifest, check_file, verify_edition,
+                             verify_editions)
+
+
+def write_image(filename, ext='JPEG'):
+    Image.new('RGB', (40, 60), 'white').save(filename, ext)
+
+
+@pytest.fixture
+def download_path(tmpdir):
+    path = os.path.join(str(tmpdir), 'TOI', 'BOM', '2024-01-02')
+    os.makedirs(path)
+    manifest = Manifest(path, compression='none')
+    for page in (1, 2):
+        filename = os.path.join(path, 'page-{0:03d}-lowres.jpg'.format(page))
+        write_image(filename)
+        manifest.add(filename, etag='"{0}"'.format(page), content_length='10')
+    manifest.save()
+    return path
+
+
+def corrupt(filename):
+    stat = os.stat(filename)
+    with open(filename, 'r+b') as f:
+        f.seek(stat.st_size // 2)
+        f.write(b'\0\0\0\0')
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def test_save_merges_other_workers(download_path):
+    a = Manifest(download_path, compression='none')
+    b = Manifest(download_path, compression='none')
+    a.remove('page-002-lowres.jpg')
+    filename = os.path.join(download_path, 'page-003-lowres.jpg')
+    write_image(filename)
+    b.add(filename)
+    b.save()
+    a.save()
+    assert sorted(Manifest(download_path).entries) == \
+        ['page-001-lowres.jpg', 'page-003-lowres.jpg']
+
+
+def test_check_file(download_path):
+    filename = os.path.join(download_path, 'page-001-lowres.jpg')
+    entry = Manifest(download_path).entries['page-001-lowres.jpg']
+    assert check_file(filename, entry)
+    corrupt(filename)
+    # same size and mtime: only a full check reads the file
+    assert check_file(filename, entry)
+    assert not check_file(filename, entry, full=True)
+    assert not check_file(filename + '.missing', entry)
+
+
+def test_check_file_without_entry(download_path):
+    filename = os.path.join(download_path, 'page-009-lowres.jpg')
+    with open(filename, 'wb') as f:
+        f.write(b'not an image')
+    assert not check_file(filename)
+
+
+def test_verify_edition(download_path):
+    assert verify_edition(download_path, compression='none') == []
+    corrupt(os.path.join(download_path, 'page-002-lowres.jpg'))
+    assert verify_edition(download_path, full=True, compression='none') == \
+        ['page-002-lowres.jpg']
+    os.remove(os.path.join(download_path, 'page-001-lowres.jpg'))
+    assert verify_edition(download_path, full=True, compression='none') == \
+        ['page-001-lowres.jpg', 'page-002-lowres.jpg']
+
+
+def test_verify_records_new_files(download_path):
+    write_image(os.path.join(download_path, 'page-003-lowres.jpg'))
+    assert verify_edition(download_path, compression='none') == []
+    assert 'page-003-lowres.jpg' in Manifest(download_path).entries
+
+
+def test_touched_file_keeps_validators(download_path):
+    filename = os.path.join(download_path, 'page-001-lowres.jpg')
+    os.utime(filename, (1, 1))
+    assert verify_edition(download_path, compression='none') == []
+    entry = Manifest(download_path).entries['page-001-lowres.jpg']
+    assert entry['mtime'] == 1
+    assert entry['etag'] == '"1"'
+    assert entry['content_length'] == '10'
+
+
+def test_transcoded_file(download_path):
+    filename = os.path.join(download_path, 'page-001-lowres.jpg')
+    write_image(os.path.join(download_path, 'page-001-lowres.webp'), 'WEBP')
+    os.remove(filename)
+    assert verify_edition(download_path, compression='none') == []
+    entries = Manifest(download_path).entries
+    assert 'page-001-lowres.jpg' not in entries
+    assert 'page-001-lowres.webp' in entries
+
+
+def test_verify_packed_edition(download_path):
+    filename = pack_edition(download_path)
+    assert verify_edition(download_path) == []
+    with open(filename, 'r+b') as f:
+        f.truncate(100)
+    # unreadable: the whole archive is bad
+    assert verify_edition(download_path) == ['2024-01-02.zip']
+    assert list(verify_editions([download_path], workers=1)) == \
+        [(download_path, ['2024-01-02.zip'])]
+
+
+def test_queue_corrupt_archive(download_path, tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    app_config = AppConfig()
+    app_config.config['App']['cache_dir'] = str(tmpdir)
+    epaper = EPaper(publisher='TOI', app_config=app_config)
+    filename = pack_edition(download_path)
+    with open(filename, 'r+b') as f:
+        f.truncate(100)
+    epaper.queue_redownload(download_path, ['2024-01-02.zip'])
+    assert not os.path.exists(archive_path(download_path))
+    assert os.path.isdir(download_path)
+    assert epaper.redownload_queue() == {'TOI/BOM/2024-01-02': ['2024-01-02.zip']}
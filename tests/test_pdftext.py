@@ -0,0 +1,133 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+
+import pytest
+
+pytest.importorskip('pypdf')
+
+from epaper import pdftext  # noqa: E402
+from epaper.pdftext import (TEXT_LOG, TEXT_NAME, TextExtractor,  # noqa: E402
+                            compact_text, read_texts)
+from epaper.utils import find_json, read_json  # noqa: E402
+
+KEY = ('TOI', 'BOM', '2024-01-02')
+
+
+def make_pdf(filename, text):
+    '''Write a one page PDF showing *text*.'''
+    stream = 'BT /F1 24 Tf 72 720 Td ({0}) Tj ET'.format(text).encode('latin-1')
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+        b'/Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>',
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+        b'<< /Length ' + str(len(stream)).encode() + b' >>\nstream\n' +
+        stream + b'\nendstream',
+    ]
+    data, offsets = b'%PDF-1.4\n', []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += '{0} 0 obj\n'.format(i).encode() + obj + b'\nendobj\n'
+    xref = len(data)
+    data += 'xref\n0 {0}\n0000000000 65535 f \n'.format(
+        len(objects) + 1).encode()
+    data += b''.join('{0:010d} 00000 n \n'.format(o).encode() for o in offsets)
+    data += 'trailer\n<< /Size {0} /Root 1 0 R >>\nstartxref\n{1}\n%%EOF\n'.format(
+        len(objects) + 1, xref).encode()
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+
+class Index:
+    def __init__(self):
+        self.pages = {}
+
+    def add_page_text(self, pub, edition, date, page=None, text=''):
+        self.pages[page] = text
+
+
+@pytest.fixture
+def edition(tmpdir):
+    path = os.path.join(str(tmpdir), *KEY)
+    os.makedirs(path)
+    for page in (1, 2, 3):
+        make_pdf(os.path.join(path, 'page-{0:03d}-highres.pdf'.format(page)),
+                 'Page {0} news'.format(page))
+    with open(os.path.join(path, 'page-004-highres.pdf'), 'wb') as f:
+        f.write(b'not a pdf')
+    return str(tmpdir), path
+
+
+def test_compact_text():
+    assert compact_text('  a   b \n\n\t\nc  ') == 'a b\nc'
+
+
+def test_run(edition):
+    cache_dir, path = edition
+    index = Index()
+    extractor = TextExtractor(cache_dir=cache_dir, search_index=index,
+                              workers=2, compression='gzip')
+    results = sorted(extractor.run([KEY]))
+    assert results == [(KEY, 1, True), (KEY, 2, True), (KEY, 3, True),
+                       (KEY, 4, False)]
+    assert index.pages == {1: 'Page 1 news', 2: 'Page 2 news',
+                           3: 'Page 3 news'}
+    # merged into text.json once the edition is done
+    assert not os.path.exists(os.path.join(path, TEXT_LOG))
+    assert find_json(os.path.join(path, TEXT_NAME)).endswith('.gz')
+    assert read_json(os.path.join(path, TEXT_NAME))['2'] == 'Page 2 news'
+    assert read_texts(path) == index.pages
+    # only the failed page is tried again
+    assert list(extractor.run([KEY])) == [(KEY, 4, False)]
+
+
+def test_read_texts_with_log(edition):
+    cache_dir, path = edition
+    extractor = TextExtractor(cache_dir=cache_dir, compression='none')
+    extractor._save(KEY, {1: 'one'})
+    extractor._append(KEY, 2, 'two')
+    extractor._append(KEY, 1, 'one again')
+    with open(os.path.join(path, TEXT_LOG), 'a') as f:
+        # cut short by a crash
+        f.write(json.dumps({'page': 3, 'text': 'three'})[:10])
+    assert read_texts(path) == {1: 'one again', 2: 'two'}
+    assert [page for page, filename in extractor.pending(KEY, read_texts(path))] \
+        == [3, 4]
+
+
+def test_interrupted_run_keeps_text(edition):
+    cache_dir, path = edition
+    extractor = TextExtractor(cache_dir=cache_dir, workers=1,
+                              compression='none')
+    results = extractor.run([KEY])
+    while not next(results)[2]:
+        pass
+    results.close()
+    assert not os.path.exists(os.path.join(path, TEXT_LOG))
+    assert len(read_texts(path)) >= 1
+
+
+def test_interrupted_run_stops_early(tmpdir, monkeypatch):
+    path = os.path.join(str(tmpdir), *KEY)
+    os.makedirs(path)
+    for page in range(1, 101):
+        make_pdf(os.path.join(path, 'page-{0:03d}-highres.pdf'.format(page)),
+                 'Page {0}'.format(page))
+    futures = []
+
+    class Pool(ProcessPoolExecutor):
+        def submit(self, *args):
+            futures.append(super().submit(*args))
+            return futures[-1]
+
+    monkeypatch.setattr(pdftext, 'ProcessPoolExecutor', Pool)
+    extractor = TextExtractor(cache_dir=str(tmpdir), workers=1,
+                              compression='none')
+    results = extractor.run([KEY])
+    next(results)
+    results.close()
+    # pages not started yet were dropped, not waited for
+    assert len([f for f in futures if f.cancelled()]) > 50
+    assert len(read_texts(path)) >= 1
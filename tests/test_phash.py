@@ -0,0 +1,95 @@
+import os
+
+from PIL import Image, ImageDraw
+import pytest
+
+pytest.importorskip('numpy')
+
+from epaper.phash import PHashIndex, dhash  # noqa: E402
+
+
+def write_page(filename, variant=0, fmt='JPEG'):
+    '''A page of a few blocks of text; *variant* moves them around.'''
+    image = Image.new('RGB', (160, 240), 'white')
+    draw = ImageDraw.Draw(image)
+    for i in range(6):
+        left = 10 + ((i * 37 + variant * 53) % 90)
+        draw.rectangle([left, 10 + i * 38, left + 50, 30 + i * 38],
+                       fill='black')
+    image.save(filename, fmt)
+    return filename
+
+
+@pytest.fixture
+def index(tmpdir):
+    return PHashIndex(cache_dir=str(tmpdir), threshold=4)
+
+
+def edition_dir(index, edition_code):
+    path = os.path.join(index.cache_dir, 'TOI', edition_code, '2024-01-02')
+    os.makedirs(path)
+    return path
+
+
+def test_dhash(tmpdir):
+    a = write_page(os.path.join(str(tmpdir), 'a.jpg'))
+    b = write_page(os.path.join(str(tmpdir), 'b.png'), fmt='PNG')
+    c = write_page(os.path.join(str(tmpdir), 'c.jpg'), variant=1)
+    assert 0 <= dhash(a) < 1 << 64
+    # the same page in another format hashes alike, another page does not
+    assert bin(dhash(a) ^ dhash(b)).count('1') <= 4
+    assert bin(dhash(a) ^ dhash(c)).count('1') > 4
+
+
+def test_find_match(index, tmpdir):
+    value = dhash(write_page(os.path.join(str(tmpdir), 'a.jpg')))
+    other = dhash(write_page(os.path.join(str(tmpdir), 'b.jpg'), variant=1))
+    bom = edition_dir(index, 'BOM')
+    index.add('TOI', 'BOM', '2024-01-02', 5, value, bom)
+    assert index.find_match('TOI', 'DEL', '2024-01-02', value) == (bom, 5)
+    # one bit off is still a match
+    assert index.find_match('TOI', 'DEL', '2024-01-02', value ^ 1) == (bom, 5)
+    assert index.find_match('TOI', 'DEL', '2024-01-02', other) is None
+    # not the same edition, publication or date
+    assert index.find_match('TOI', 'BOM', '2024-01-02', value) is None
+    assert index.find_match('ET', 'DEL', '2024-01-02', value) is None
+    assert index.find_match('TOI', 'DEL', '2024-01-03', value) is None
+
+
+def test_add_high_bit_hash(index):
+    # stored as a signed sqlite integer
+    value = (1 << 63) | 0xff00ff00ff
+    bom = edition_dir(index, 'BOM')
+    index.add('TOI', 'BOM', '2024-01-02', 1, value, bom)
+    assert index.find_match('TOI', 'DEL', '2024-01-02', value) == (bom, 1)
+    assert index.find_match('TOI', 'DEL', '2024-01-02', value ^ 0xff) is None
+
+
+def test_reuse(index, tmpdir):
+    bom = edition_dir(index, 'BOM')
+    delhi = edition_dir(index, 'DEL')
+    thumbnail = write_page(os.path.join(bom, 'page-004-thumbnail.jpg'))
+    write_page(os.path.join(bom, 'page-004-lowres.webp'), fmt='WEBP')
+    value = dhash(thumbnail)
+    index.add('TOI', 'BOM', '2024-01-02', 4, value, bom)
+
+    target = index.reuse('TOI', 'DEL', '2024-01-02', value, 'lowres',
+                         os.path.join(delhi, 'page-002-lowres.jpg'))
+    # the matched file keeps its format
+    assert target == os.path.join(delhi, 'page-002-lowres.webp')
+    with open(target, 'rb') as a, \
+            open(os.path.join(bom, 'page-004-lowres.webp'), 'rb') as b:
+        assert a.read() == b.read()
+    # the matching page has no highres image
+    assert index.reuse('TOI', 'DEL', '2024-01-02', value, 'highres',
+                       os.path.join(delhi, 'page-002-highres.jpg')) is None
+
+
+def test_reuse_skips_blank_pages(index):
+    bom = edition_dir(index, 'BOM')
+    index.add('TOI', 'BOM', '2024-01-02', 1, 0, bom)
+    Image.new('RGB', (40, 60), 'white').save(
+        os.path.join(bom, 'page-001-lowres.jpg'))
+    assert index.find_match('TOI', 'DEL', '2024-01-02', 0) == (bom, 1)
+    assert index.reuse('TOI', 'DEL', '2024-01-02', 0, 'lowres',
+                       os.path.join(bom, 'page-009-lowres.jpg')) is None
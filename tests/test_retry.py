@@ -0,0 +1,114 @@
+import threading
+
+import pytest
+
+from epaper.retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+def open_breaker(breaker):
+    for i in range(breaker.failure_threshold):
+        breaker.before_request()
+        breaker.record_failure()
+
+
+def test_opens_after_threshold():
+    breaker = CircuitBreaker(host='h', failure_threshold=3, cooldown=0)
+    for i in range(2):
+        breaker.record_failure()
+        assert breaker.state == breaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    assert breaker.trips == 1
+
+
+def test_success_resets_failures():
+    breaker = CircuitBreaker(host='h', failure_threshold=3, cooldown=0)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == breaker.CLOSED
+    assert breaker.failures == 1
+
+
+def test_probe_after_cooldown():
+    breaker = CircuitBreaker(host='h', failure_threshold=1, cooldown=0,
+                             max_trips=5)
+    open_breaker(breaker)
+    breaker.before_request()
+    assert breaker.state == breaker.HALF_OPEN
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+    assert breaker.trips == 0
+
+
+def test_failed_probe_doubles_cooldown():
+    breaker = CircuitBreaker(host='h', failure_threshold=1, cooldown=0.01,
+                             max_cooldown=0.03, max_trips=10)
+    open_breaker(breaker)
+    for cooldown in (0.02, 0.03, 0.03):
+        breaker.before_request()
+        breaker.record_failure()
+        assert breaker.state == breaker.OPEN
+        assert breaker.cooldown == cooldown
+
+
+def test_fails_fast_after_max_trips():
+    breaker = CircuitBreaker(host='h', failure_threshold=1, cooldown=60,
+                             max_trips=2)
+    open_breaker(breaker)
+    # one trip: requests wait for the cooldown
+    assert breaker.trips == 1
+    breaker.opened_at -= 60
+    breaker.before_request()
+    breaker.record_failure()
+    # max_trips trips: fail fast, not after one more
+    assert breaker.trips == 2
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+
+def test_waiters_fail_fast_when_probe_trips_max():
+    breaker = CircuitBreaker(host='h', failure_threshold=1, cooldown=60,
+                             max_trips=2)
+    open_breaker(breaker)
+    breaker.opened_at -= 60
+    breaker.before_request()
+    errors = []
+
+    def wait():
+        try:
+            breaker.before_request()
+        except CircuitOpenError as e:
+            errors.append(e)
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    breaker.record_failure()
+    waiter.join(5)
+    assert not waiter.is_alive()
+    assert len(errors) == 1
+
+
+def test_run_retries_then_returns():
+    policy = RetryPolicy(failure_threshold=10)
+    policy.delay = lambda *args: 0
+    results = iter([('server', None, None), (None, 'ok', None)])
+    assert policy.run('http://h/a', lambda: next(results)) == 'ok'
+
+
+def test_run_records_unexpected_errors():
+    policy = RetryPolicy(failure_threshold=1, cooldown=0, max_trips=5)
+    breaker = policy.breaker('http://h/a')
+    open_breaker(breaker)
+
+    def attempt():
+        raise ValueError('bad response')
+
+    # the probe raises: the circuit opens again instead of staying half-open
+    with pytest.raises(ValueError):
+        policy.run('http://h/a', attempt)
+    assert breaker.state == breaker.OPEN
+    assert breaker.trips == 2
+    assert policy.run('http://h/a', lambda: (None, 'ok', None)) == 'ok'
+    assert breaker.state == breaker.CLOSED
@@ -0,0 +1,197 @@
+from datetime import datetime
+import threading
+import time
+
+from epaper.scheduler import DownloadScheduler, Job, TIERS, parse_deadline
+
+
+def make_jobs(pages=3, tiers=TIERS):
+    return [Job(page, tier, 'http://h/{0}/{1}'.format(page, tier),
+                'page-{0:03d}-{1}.jpg'.format(page, tier))
+            for page in range(1, pages + 1) for tier in tiers]
+
+
+def run(scheduler, jobs):
+    for job in jobs:
+        scheduler.add(job)
+    scheduler.run()
+
+
+def order(jobs):
+    return [(job.page_number, job.rendition) for job in jobs]
+
+
+def test_tier_order():
+    done = []
+    scheduler = DownloadScheduler(run_job=lambda job: done.append(job) or True,
+                                  workers=1)
+    run(scheduler, make_jobs())
+    assert order(done) == [(page, tier) for tier in TIERS
+                           for page in (1, 2, 3)]
+
+
+def test_tier_complete():
+    complete = []
+    scheduler = DownloadScheduler(run_job=lambda job: True, workers=3,
+                                  on_tier_complete=complete.append)
+    run(scheduler, make_jobs())
+    assert sorted(complete) == sorted(TIERS)
+
+
+def test_bump():
+    done = []
+    scheduler = DownloadScheduler(run_job=lambda job: done.append(job) or True,
+                                  workers=1)
+    for job in make_jobs():
+        scheduler.add(job)
+    scheduler.bump(3)
+    scheduler.run()
+    assert order(done[:3]) == [(3, tier) for tier in TIERS]
+    assert order(done[3:5]) == [(1, 'thumbnail'), (2, 'thumbnail')]
+    assert len(done) == 9
+
+
+def test_bump_while_running():
+    done = []
+
+    def run_job(job):
+        done.append(job)
+        if len(done) == 1:
+            scheduler.bump(2)
+        return True
+
+    scheduler = DownloadScheduler(run_job=run_job, workers=1)
+    run(scheduler, make_jobs())
+    assert order(done[:4]) == [(1, 'thumbnail'), (2, 'thumbnail'),
+                               (2, 'lowres'), (2, 'highres')]
+
+
+def test_deferred_jobs_are_retried():
+    tries = {}
+    lock = threading.Lock()
+
+    def run_job(job):
+        with lock:
+            tries[job] = tries.get(job, 0) + 1
+            # leased by another worker the first time
+            return True if tries[job] > 1 else None
+
+    scheduler = DownloadScheduler(run_job=run_job, workers=2,
+                                  retry_interval=0.01)
+    jobs = make_jobs(pages=2)
+    run(scheduler, jobs)
+    assert all(tries[job] == 2 for job in jobs)
+
+
+def test_cancel():
+    done = []
+
+    def run_job(job):
+        done.append(job)
+        scheduler.cancel()
+        return True
+
+    scheduler = DownloadScheduler(run_job=run_job, workers=1)
+    run(scheduler, make_jobs())
+    assert len(done) == 1
+
+
+class FixedMeter:
+    def __init__(self, rate):
+        self._rate = rate
+
+    def add(self, nbytes):
+        pass
+
+    def rate(self):
+        return self._rate
+
+
+SIZES = {'thumbnail': 100, 'lowres': 1000, 'highres': 3000}
+
+
+def deadline_scheduler(rate, seconds=10, pages=4, workers=1):
+    scheduler = DownloadScheduler(
+        run_job=lambda job: True, workers=workers,
+        deadline=time.time() + seconds, plan_interval=0,
+        job_size=lambda job: SIZES[job.rendition])
+    scheduler.meter = FixedMeter(rate)
+    for job in make_jobs(pages):
+        scheduler.add(job)
+    return scheduler
+
+
+def plan(scheduler):
+    with scheduler._lock:
+        scheduler._plan()
+
+
+def test_parse_deadline():
+    now = datetime(2024, 1, 2, 5, 0)
+    assert parse_deadline('', now) is None
+    assert parse_deadline('06:30', now) == \
+        datetime(2024, 1, 2, 6, 30).timestamp()
+    # already past today: tomorrow
+    assert parse_deadline('04:00', now) == \
+        datetime(2024, 1, 3, 4, 0).timestamp()
+
+
+def test_deadline_postpones_last_pages():
+    # about 9000 bytes fit: all thumbnails and lowres, page 1 highres
+    scheduler = deadline_scheduler(rate=1000)
+    plan(scheduler)
+    assert order(scheduler.postponed()) == [(2, 'highres'), (3, 'highres'),
+                                            (4, 'highres')]
+    assert scheduler._remaining['highres'] == 1
+
+
+def test_deadline_postpones_lower_tiers_too():
+    # 1800 bytes: thumbnails and one lowres image
+    scheduler = deadline_scheduler(rate=200)
+    plan(scheduler)
+    assert order(scheduler.postponed()) == \
+        [(page, 'lowres') for page in (2, 3, 4)] + \
+        [(page, 'highres') for page in (1, 2, 3, 4)]
+
+
+def test_deadline_never_postpones_first_tier():
+    scheduler = deadline_scheduler(rate=1)
+    plan(scheduler)
+    assert not [job for job in scheduler.postponed()
+                if job.rendition == 'thumbnail']
+    assert scheduler._remaining['thumbnail'] == 4
+
+
+def test_deadline_share_per_worker():
+    # enough in total, but a highres image takes one of 4 workers too long
+    scheduler = deadline_scheduler(rate=1200, workers=4)
+    plan(scheduler)
+    assert order(scheduler.postponed()) == [(page, 'highres')
+                                            for page in (1, 2, 3, 4)]
+
+
+def test_deadline_restores_when_throughput_recovers():
+    scheduler = deadline_scheduler(rate=1000)
+    plan(scheduler)
+    scheduler.meter = FixedMeter(100000)
+    plan(scheduler)
+    assert scheduler.postponed() == []
+    done = []
+    scheduler.run_job = lambda job: done.append(job) or True
+    scheduler.run()
+    assert len(done) == 12
+
+
+def test_postponed_jobs_are_not_run():
+    done, complete = [], []
+    scheduler = deadline_scheduler(rate=1000)
+    plan(scheduler)
+    # no planning again while the run takes no time at all
+    scheduler.plan_interval = 3600
+    scheduler.run_job = lambda job: done.append(job) or True
+    scheduler.on_tier_complete = complete.append
+    scheduler.run()
+    assert order(done)[-1] == (1, 'highres')
+    assert len(done) == 9
+    # highres is not complete while some are postponed
+    assert complete == ['thumbnail', 'lowres']
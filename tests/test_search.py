@@ -0,0 +1,74 @@
+import threading
+
+import pytest
+
+from epaper.search import SearchIndex
+
+TOC = {'toc': [{'page': '1', 'page_title': 'Front Page'},
+               {'page': '2', 'page_title': 'Budget Special'},
+               {'page': '3', 'page_title': 'Sports'}]}
+
+
+@pytest.fixture
+def index(tmpdir):
+    index = SearchIndex(str(tmpdir))
+    yield index
+    index.close()
+
+
+def test_add_edition_once(index):
+    assert index.add_edition('TOI', 'BOM', '2024-01-02', TOC)
+    assert index.has_edition('TOI', 'BOM', '2024-01-02')
+    assert not index.add_edition('TOI', 'BOM', '2024-01-02', TOC)
+    assert not index.add_edition('TOI', 'BOM', '2024-01-03', {})
+    assert len(index.search('budget')) == 1
+
+
+def test_add_edition_concurrently(index):
+    results = []
+    start = threading.Barrier(8)
+
+    def add():
+        start.wait()
+        results.append(index.add_edition('TOI', 'BOM', '2024-01-02', TOC))
+
+    threads = [threading.Thread(target=add) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 1
+    assert [hit.page for hit in index.search('sports')] == [3]
+
+
+def test_added_by_another_connection(index, tmpdir):
+    other = SearchIndex(str(tmpdir))
+    assert other.add_edition('TOI', 'BOM', '2024-01-02', TOC)
+    other.close()
+    assert not index.add_edition('TOI', 'BOM', '2024-01-02', TOC)
+    assert len(index.search('front')) == 1
+
+
+def test_search_order_and_filters(index):
+    index.add_edition('TOI', 'BOM', '2024-01-02', TOC)
+    index.add_edition('TOI', 'DEL', '2024-01-03', TOC)
+    hits = index.search('page')
+    assert [(hit.edition_code, hit.date) for hit in hits] == \
+        [('DEL', '2024-01-03'), ('BOM', '2024-01-02')]
+    assert [hit.edition_code for hit in index.search('page',
+                                                     edition_code='BOM')] == \
+        ['BOM']
+    # not a valid FTS5 expression: searched for literally
+    assert [hit.page for hit in index.search('budget"')] == [2, 2]
+
+
+def test_search_text(index):
+    index.add_page_text('TOI', 'BOM', '2024-01-02', page=2,
+                        text='The finance minister\npresented the budget')
+    index.add_page_text('TOI', 'BOM', '2024-01-02', page=2,
+                        text='Budget 2024: tax slabs unchanged')
+    hits = index.search('slabs', text=True)
+    assert len(hits) == 1
+    assert hits[0].page == 2
+    assert 'slabs' in hits[0].title
+    assert index.search('minister', text=True) == []
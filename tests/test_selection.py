@@ -0,0 +1,73 @@
+import pytest
+
+from epaper.selection import PageSelection, parse_page_ranges
+
+
+@pytest.mark.parametrize('spec, expected', [
+    ('', []),
+    (None, []),
+    ('3', [(3, 3)]),
+    ('1-12,15', [(1, 12), (15, 15)]),
+    (' 20- , -4 ', [(20, None), (1, 4)]),
+    ('1,,2', [(1, 1), (2, 2)]),
+])
+def test_parse_page_ranges(spec, expected):
+    assert parse_page_ranges(spec) == expected
+
+
+@pytest.mark.parametrize('spec', ['a', '1-b', '1-2-3', '1.5'])
+def test_parse_page_ranges_invalid(spec):
+    with pytest.raises(ValueError):
+        parse_page_ranges(spec)
+
+
+def test_selects_all_by_default():
+    selection = PageSelection()
+    assert all(selection.selects_page(n) for n in range(1, 50))
+    assert selection.renditions == ('thumbnail', 'lowres', 'highres')
+    assert not selection.pdf
+
+
+def test_page_ranges():
+    selection = PageSelection(pages='1-3,10-')
+    assert [n for n in range(1, 13) if selection.selects_page(n)] == \
+        [1, 2, 3, 10, 11, 12]
+
+
+def test_titles():
+    selection = PageSelection(include='times|city', exclude='classifieds')
+    assert selection.selects_page(1, 'The Times Of India')
+    assert selection.selects_page(2, 'CITY')
+    assert not selection.selects_page(3, 'Sports')
+    assert not selection.selects_page(4, 'City Classifieds')
+    assert not selection.selects_page(5, '')
+
+
+def test_renditions():
+    # kept in download order, unknown names dropped
+    selection = PageSelection(renditions='pdf, highres,foo')
+    assert selection.renditions == ('highres', 'pdf')
+    assert selection.pdf
+    with pytest.raises(ValueError):
+        PageSelection(renditions='foo')
+
+
+def test_filter_toc():
+    toc = [{'page': str(n), 'page_title': title} for n, title in
+           enumerate(['Front', 'Nation', 'Classifieds', 'Sports'], 1)]
+    selection = PageSelection(pages='2-', exclude='classifieds')
+    assert [p['page'] for p in selection.filter_toc(toc)] == ['2', '4']
+
+
+class Config:
+    def __init__(self, sections):
+        self.config = sections
+
+
+def test_from_config_overrides():
+    config = Config({'Selection': {'pages': '1-4', 'renditions': 'thumbnail',
+                                   'exclude': 'Sports'}})
+    selection = PageSelection.from_config(config, pages='2', include=None)
+    assert selection.page_ranges == [(2, 2)]
+    assert selection.renditions == ('thumbnail',)
+    assert not selection.selects_page(2, 'Sports')
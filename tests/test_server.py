@@ -0,0 +1,108 @@
+import asyncio
+import os
+
+import pytest
+
+from epaper.appconfig import AppConfig
+from epaper.server import CacheServer, file_etag, parse_range
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, None),
+    ('', None),
+    ('bytes=0-99', (0, 99)),
+    ('bytes=10-', (10, 999)),
+    ('bytes=990-2000', (990, 999)),
+    ('bytes=-100', (900, 999)),
+    ('bytes=-5000', (0, 999)),
+    ('bytes=999-999', (999, 999)),
+    # not supported: the whole file is sent
+    ('bytes=0-9,20-29', None),
+    ('items=0-9', None),
+])
+def test_parse_range(value, expected):
+    assert parse_range(value, 1000) == expected
+
+
+@pytest.mark.parametrize('value', [
+    'bytes=1000-', 'bytes=50-10', 'bytes=-', 'bytes=-0',
+])
+def test_parse_range_unsatisfiable(value):
+    with pytest.raises(ValueError):
+        parse_range(value, 1000)
+
+
+def test_file_etag():
+    assert file_etag(255, 4096) == '"ff-1000"'
+    # files of packed editions also depend on their offset in the archive
+    assert file_etag(255, 4096, 16) == '"ff-1000-10"'
+
+
+@pytest.fixture
+def server(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    server = CacheServer(publisher='TOI', app_config=AppConfig(), max_age=60)
+    path = os.path.join(server.cache_dir, 'TOI', 'BOM', '2024-01-02')
+    os.makedirs(path)
+    with open(os.path.join(path, 'page-001-lowres.jpg'), 'wb') as f:
+        f.write(bytes(range(256)) * 4)
+    return server
+
+
+def get(server, path, **headers):
+    '''Return (status, headers, body) of a GET of *path* from *server*.'''
+    async def request():
+        listener = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        lines = ['GET {0} HTTP/1.1'.format(path), 'Connection: close']
+        lines.extend('{0}: {1}'.format(k.replace('_', '-'), v)
+                     for k, v in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        response = await reader.read()
+        writer.close()
+        listener.close()
+        await listener.wait_closed()
+        return response
+
+    head, body = asyncio.run(request()).split(b'\r\n\r\n', 1)
+    lines = head.decode('latin-1').split('\r\n')
+    return (int(lines[0].split(' ')[1]),
+            dict(line.split(': ', 1) for line in lines[1:]), body)
+
+
+PAGE = '/TOI/BOM/2024-01-02/page-001-lowres.jpg'
+
+
+def test_page_revalidates(server):
+    status, headers, body = get(server, PAGE)
+    assert status == 200
+    assert len(body) == 1024
+    assert headers['Cache-Control'] == 'public, max-age=60'
+    status, _, body = get(server, PAGE, If_None_Match=headers['ETag'])
+    assert status == 304
+    assert body == b''
+
+
+def test_range(server):
+    status, headers, body = get(server, PAGE, Range='bytes=-16')
+    assert status == 206
+    assert headers['Content-Range'] == 'bytes 1008-1023/1024'
+    assert body == bytes(range(240, 256))
+
+
+def test_range_if_range_mismatch(server):
+    status, _, body = get(server, PAGE, Range='bytes=0-9', If_Range='"old"')
+    assert status == 200
+    assert len(body) == 1024
+
+
+def test_range_unsatisfiable(server):
+    status, headers, _ = get(server, PAGE, Range='bytes=2000-')
+    assert status == 416
+    assert headers['Content-Range'] == 'bytes */1024'
+
+
+def test_dot_files_not_served(server):
+    assert get(server, '/TOI/BOM/2024-01-02/.leases')[0] == 404
+    assert get(server, '/TOI/BOM/../page-001-lowres.jpg')[0] == 404
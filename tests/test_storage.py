@@ -0,0 +1,165 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import os
+import threading
+
+import pytest
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+from PIL import Image  # noqa: E402
+
+from epaper.appconfig import AppConfig  # noqa: E402
+from epaper.scraper import Scraper  # noqa: E402
+from epaper.storage import MIN_PART_SIZE, MultipartWriter, ObjectStorage  # noqa: E402
+
+BUCKET = 'epaper'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def storage(client):
+    return ObjectStorage(bucket=BUCKET, prefix='cache', client=client,
+                         part_size=MIN_PART_SIZE)
+
+
+def uploads(client):
+    return client.list_multipart_uploads(Bucket=BUCKET).get('Uploads', [])
+
+
+def write(writer, data, chunk_size=1024 * 1024):
+    for i in range(0, len(data), chunk_size):
+        writer.write(data[i:i + chunk_size])
+
+
+def test_small_object_single_put(client):
+    writer = MultipartWriter(client, BUCKET, 'small', MIN_PART_SIZE)
+    writer.write(b'page')
+    writer.close()
+    assert writer.upload_id is None
+    assert client.get_object(Bucket=BUCKET, Key='small')['Body'].read() == \
+        b'page'
+
+
+@pytest.mark.parametrize('size, parts', [
+    (MIN_PART_SIZE, 1),
+    (MIN_PART_SIZE + 1, 2),
+    (MIN_PART_SIZE * 5 // 2, 3),
+])
+def test_part_boundaries(client, size, parts):
+    data = os.urandom(size)
+    writer = MultipartWriter(client, BUCKET, 'large', MIN_PART_SIZE)
+    write(writer, data)
+    # full parts are sent as soon as they are buffered
+    assert len(writer.parts) == size // MIN_PART_SIZE
+    assert len(writer.buffer) == size % MIN_PART_SIZE
+    writer.close()
+    assert len(writer.parts) == parts
+    assert [part['PartNumber'] for part in writer.parts] == \
+        list(range(1, parts + 1))
+    assert client.get_object(Bucket=BUCKET, Key='large')['Body'].read() == data
+    assert uploads(client) == []
+
+
+def test_writer_stores_under_prefix(storage, client):
+    with storage.writer('TOI/BOM/2024-01-02/page-001-lowres.jpg') as fd:
+        fd.write(b'page')
+    assert storage.exists('TOI/BOM/2024-01-02/page-001-lowres.jpg')
+    assert storage.read('TOI/BOM/2024-01-02/page-001-lowres.jpg') == b'page'
+    assert list(storage.list('TOI/BOM')) == \
+        ['TOI/BOM/2024-01-02/page-001-lowres.jpg']
+    assert client.head_object(
+        Bucket=BUCKET, Key='cache/TOI/BOM/2024-01-02/page-001-lowres.jpg')
+
+
+def test_writer_aborts_on_error(storage, client):
+    with pytest.raises(RuntimeError):
+        with storage.writer('page') as fd:
+            write(fd, os.urandom(MIN_PART_SIZE + 1))
+            raise RuntimeError('connection lost')
+    assert not storage.exists('page')
+    assert uploads(client) == []
+
+
+def test_writer_aborts_when_close_fails(storage, client, monkeypatch):
+    def fail(**kwargs):
+        raise RuntimeError('complete failed')
+
+    monkeypatch.setattr(client, 'complete_multipart_upload', fail)
+    with pytest.raises(RuntimeError):
+        with storage.writer('page') as fd:
+            write(fd, os.urandom(MIN_PART_SIZE + 1))
+    assert not storage.exists('page')
+    assert uploads(client) == []
+
+
+def jpeg(size=(400, 300)):
+    buffer = io.BytesIO()
+    Image.effect_noise(size, 64).convert('RGB').save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def image_server():
+    files = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = files.get(self.path)
+            self.send_response(200 if body is not None else 404)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(body or b'')))
+            self.end_headers()
+            self.wfile.write(body or b'')
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.files = files
+    server.url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def scraper(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    scraper = Scraper(publisher='TOI', app_config=AppConfig())
+    scraper.retry_policy.delay = lambda *args: 0
+    yield scraper
+    scraper.transport.close()
+
+
+def test_stream_to_storage(scraper, storage, image_server):
+    image = jpeg()
+    image_server.files['/page.jpg'] = image
+    headers = {}
+    assert scraper.stream_to_storage(image_server.url + '/page.jpg', storage,
+                                     'page.jpg', response_headers=headers)
+    assert storage.read('page.jpg') == image
+    assert headers['content-type'] == 'image/jpeg'
+
+
+def test_stream_to_storage_corrupt_image(scraper, storage, image_server):
+    image_server.files['/page.jpg'] = jpeg()[:2000]
+    assert not scraper.stream_to_storage(image_server.url + '/page.jpg',
+                                         storage, 'page.jpg')
+    assert not storage.exists('page.jpg')
+
+
+def test_stream_to_storage_not_found(scraper, storage, image_server):
+    assert not scraper.stream_to_storage(image_server.url + '/missing.jpg',
+                                         storage, 'missing.jpg')
+    assert not storage.exists('missing.jpg')
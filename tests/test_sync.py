@@ -0,0 +1,131 @@
+from datetime import datetime
+import copy
+import os
+
+from PIL import Image
+import pytest
+
+from epaper.appconfig import AppConfig
+from epaper.epaper import EPaper
+from epaper.scraper import Scraper
+from epaper.selection import PageSelection
+from epaper.sync import EditionSync
+
+
+class FakeScraper(Scraper):
+    '''Scraper of an edition held in memory: toc.json and an ETag per image
+URL.'''
+
+    def __init__(self, pages=4, **kwargs):
+        super().__init__(**kwargs)
+        self.toc = {'toc': [{'page': str(n), 'page_title': 'Page {0}'.format(n),
+                             'page_folder': 'Page{0:03d}'.format(n)}
+                            for n in range(1, pages + 1)]}
+        self.toc_etag = '"toc-1"'
+        self.etags = {}
+        self.downloads = []
+
+    def etag(self, url):
+        return self.etags.setdefault(url, '"1"')
+
+    def fetch_conditional(self, url, validators=None):
+        if validators and validators.get('etag') == self.toc_etag:
+            return 304, None, validators
+        return 200, copy.deepcopy(self.toc), {'etag': self.toc_etag}
+
+    def head(self, url):
+        return {'etag': self.etag(url), 'content-length': '100'}
+
+    def save_image(self, url, save_to_file, retry_limit=None, delay=True,
+                   response_headers=None):
+        Image.new('RGB', (40, 60)).save(save_to_file, 'JPEG')
+        response_headers['etag'] = self.etag(url)
+        self.downloads.append(url)
+        return True, 1
+
+
+@pytest.fixture
+def edition(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    app_config = AppConfig()
+    epaper = EPaper(publisher='TOI', app_config=app_config)
+    epaper.selected_publication = ('', 'TOI')
+    epaper.selected_edition = ('', 'BOM')
+    epaper.selected_date = datetime(2024, 1, 2)
+    epaper.create_download_dir()
+    scraper = FakeScraper(publisher='TOI', app_config=app_config)
+    return epaper, scraper
+
+
+def sync(edition):
+    epaper, scraper = edition
+    del scraper.downloads[:]
+    return EditionSync(epaper=epaper, scraper=scraper,
+                       selection=PageSelection(), workers=2).run()
+
+
+def test_first_sync_downloads_all(edition):
+    report = sync(edition)
+    assert report.added == [1, 2, 3, 4]
+    assert report.downloaded == 12
+    assert report.failed == []
+
+
+def test_unchanged(edition):
+    sync(edition)
+    report = sync(edition)
+    assert report.added == [] and report.removed == []
+    assert report.changed == {}
+    assert report.unchanged == 4
+    assert edition[1].downloads == []
+
+
+def test_changed_image(edition):
+    epaper, scraper = edition
+    sync(edition)
+    url = [u for u in scraper.etags if '/Page002/big_page.jpg' in u][0]
+    scraper.etags[url] = '"2"'
+    report = sync(edition)
+    assert report.changed == {2: ['lowres']}
+    assert scraper.downloads == [url]
+    # the new ETag is recorded: nothing to do next time
+    assert sync(edition).changed == {}
+
+
+def test_changed_page_folder(edition):
+    epaper, scraper = edition
+    sync(edition)
+    scraper.toc['toc'][2]['page_folder'] = 'Page003b'
+    scraper.toc_etag = '"toc-2"'
+    report = sync(edition)
+    assert report.changed == {3: ['page_folder']}
+    assert len(scraper.downloads) == 3
+    assert all('/Page003b/' in url for url in scraper.downloads)
+
+
+def test_added_and_removed_pages(edition):
+    epaper, scraper = edition
+    sync(edition)
+    scraper.toc['toc'] = scraper.toc['toc'][:3] + [
+        {'page': '5', 'page_title': 'Page 5', 'page_folder': 'Page005'}]
+    scraper.toc_etag = '"toc-2"'
+    report = sync(edition)
+    assert report.added == [5]
+    assert report.removed == [4]
+    assert report.changed == {}
+    assert len(scraper.downloads) == 3
+
+
+def test_changed_transcoded_image(edition):
+    epaper, scraper = edition
+    epaper.app_config.config['App']['storage_format'] = 'webp'
+    epaper.app_config.config['App']['transcode_workers'] = '1'
+    sync(edition)
+    assert os.path.exists(os.path.join(epaper.download_path,
+                                       'page-002-lowres.webp'))
+    url = [u for u in scraper.etags if '/Page002/big_page.jpg' in u][0]
+    scraper.etags[url] = '"2"'
+    # the ETag of the download moved with the transcoded file
+    assert sync(edition).changed == {2: ['lowres']}
+    assert scraper.downloads == [url]
+    assert sync(edition).changed == {}
@@ -0,0 +1,71 @@
+import multiprocessing
+import os
+
+from PIL import Image
+import pytest
+
+from epaper import transcode
+from epaper.transcode import (avif_supported, resolve_image, transcode_image,
+                              transcode_images)
+
+
+def write_image(filename):
+    Image.new('RGB', (80, 120), 'navy').save(filename, 'JPEG')
+    return filename
+
+
+def test_resolve_image(tmpdir):
+    jpg = os.path.join(str(tmpdir), 'page-001-lowres.jpg')
+    assert resolve_image(None) is None
+    assert resolve_image(jpg) is None
+    write_image(jpg)
+    assert resolve_image(jpg) == jpg
+    os.rename(jpg, jpg[:-4] + '.webp')
+    assert resolve_image(jpg) == jpg[:-4] + '.webp'
+    # not a page image
+    assert resolve_image(jpg[:-4] + '.pdf') is None
+
+
+def test_transcode_image(tmpdir):
+    jpg = write_image(os.path.join(str(tmpdir), 'page-001-lowres.jpg'))
+    webp = transcode_image(jpg, 'webp', quality=50)
+    assert webp == jpg[:-4] + '.webp'
+    assert not os.path.exists(jpg)
+    with Image.open(webp) as image:
+        assert image.format == 'WEBP'
+        assert image.size == (80, 120)
+    # already in the storage format
+    assert transcode_image(webp, 'webp') == webp
+
+
+def test_transcode_broken_image_is_kept(tmpdir):
+    jpg = os.path.join(str(tmpdir), 'page-001-lowres.jpg')
+    with open(jpg, 'wb') as f:
+        f.write(b'not an image')
+    assert transcode_image(jpg, 'webp') is None
+    assert os.path.exists(jpg)
+    assert not os.path.exists(jpg[:-4] + '.webp')
+
+
+def test_transcode_images(tmpdir):
+    filenames = [write_image(os.path.join(
+        str(tmpdir), 'page-{0:03d}-lowres.jpg'.format(page)))
+        for page in (1, 2, 3)]
+    results = transcode_images(filenames, 'webp', workers=2)
+    assert results == dict((f, f[:-4] + '.webp') for f in filenames)
+    assert transcode_images([], 'webp') == {}
+
+
+@pytest.mark.skipif(not avif_supported(), reason='no AVIF support')
+def test_transcode_images_avif_spawned_workers(tmpdir, monkeypatch):
+    class SpawnPool(transcode.ProcessPoolExecutor):
+        def __init__(self, **kwargs):
+            # the plugin must be registered in each worker, see avif_supported()
+            assert kwargs['initializer'] is avif_supported
+            super().__init__(mp_context=multiprocessing.get_context('spawn'),
+                             **kwargs)
+
+    monkeypatch.setattr(transcode, 'ProcessPoolExecutor', SpawnPool)
+    jpg = write_image(os.path.join(str(tmpdir), 'page-001-lowres.jpg'))
+    assert transcode_images([jpg], 'avif', workers=1) == \
+        {jpg: jpg[:-4] + '.avif'}
@@ -0,0 +1,119 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gzip
+import socket
+import threading
+
+import pytest
+
+from epaper import transport
+from epaper.appconfig import AppConfig
+from epaper.transport import RequestsTransport, TransportError, make_transport
+
+BODY = b'{"toc": []}' * 100
+
+HTTP2 = transport._installed('httpx') and transport._installed('h2')
+
+BACKENDS = ['requests', 'httpx'] if HTTP2 else ['requests']
+
+
+@pytest.fixture
+def app_config(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    return AppConfig()
+
+
+@pytest.fixture
+def server():
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            requests_seen.append(dict(self.headers))
+            body = gzip.compress(BODY)
+            self.send_response(200 if self.path == '/toc.json' else 404)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    server.requests_seen = requests_seen
+    yield server
+    server.shutdown()
+
+
+def test_make_transport_default(app_config):
+    t = make_transport(app_config)
+    assert isinstance(t, RequestsTransport)
+    assert t.user_agent == app_config.config['Http']['user_agent']
+    t.close()
+
+
+def test_make_transport_unknown(app_config):
+    app_config.config['Http']['transport'] = 'curl'
+    t = make_transport(app_config)
+    assert isinstance(t, RequestsTransport)
+    t.close()
+
+
+def test_make_transport_httpx(app_config):
+    app_config.config['Http']['transport'] = 'httpx'
+    t = make_transport(app_config)
+    if HTTP2:
+        assert t.name == 'httpx'
+    else:
+        # not installed: requests instead
+        assert isinstance(t, RequestsTransport)
+    t.close()
+
+
+def test_make_transport_constructor_errors(app_config, monkeypatch):
+    class Broken(RequestsTransport):
+        def __init__(self, **kwargs):
+            raise KeyError('pool')
+
+    monkeypatch.setitem(transport.TRANSPORTS, 'broken', Broken)
+    app_config.config['Http']['transport'] = 'broken'
+    # a bug in a backend is not reported as an unknown transport
+    with pytest.raises(KeyError):
+        make_transport(app_config)
+
+
+@pytest.mark.parametrize('name', BACKENDS)
+def test_get_decodes(name, server):
+    t = transport.TRANSPORTS[name](user_agent='epaper-test')
+    res = t.get(server.url + '/toc.json')
+    assert res.status_code == 200
+    assert res.content == BODY
+    assert server.requests_seen[-1]['User-Agent'] == 'epaper-test'
+    assert t.get(server.url + '/missing').status_code == 404
+    t.close()
+
+
+@pytest.mark.parametrize('name', BACKENDS)
+def test_stream_decodes(name, server):
+    t = transport.TRANSPORTS[name](user_agent='epaper-test')
+    with t.stream(server.url + '/toc.json') as res:
+        assert b''.join(res.iter_content(64)) == BODY
+    t.close()
+
+
+@pytest.mark.parametrize('name', BACKENDS)
+def test_connect_error(name):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    t = transport.TRANSPORTS[name](user_agent='epaper-test', max_retries=0)
+    with pytest.raises(TransportError) as e:
+        t.get('http://127.0.0.1:{0}/'.format(port))
+    assert e.value.kind == 'connect'
+    t.close()
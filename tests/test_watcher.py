@@ -0,0 +1,155 @@
+import os
+import queue
+
+import pytest
+
+from epaper.appconfig import AppConfig
+from epaper.archive import pack_edition
+from epaper.epaper import EPaper
+from epaper.watcher import (EDITION_ADDED, EDITION_EVICTED, EDITION_PACKED,
+                            PAGE_COMPLETED, CacheEvent, CacheWatcher,
+                            inotify_simple)
+
+
+@pytest.fixture
+def cache_dir(tmpdir):
+    return str(tmpdir)
+
+
+@pytest.fixture
+def events():
+    return []
+
+
+@pytest.fixture
+def watcher(cache_dir, events):
+    return CacheWatcher(cache_dir=cache_dir, callback=events.append,
+                        use_inotify=False)
+
+
+def add_edition(cache_dir, date='2024-01-02', pages=()):
+    path = os.path.join(cache_dir, 'TOI', 'BOM', date)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'toc.json'), 'w') as f:
+        f.write('{"toc": []}')
+    for name in pages:
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(b'page')
+    return path
+
+
+def test_poll_backend(watcher):
+    assert watcher.backend == 'poll'
+
+
+def test_start_learns_current_state(watcher, cache_dir, events):
+    add_edition(cache_dir, pages=['page-001-thumbnail.jpg'])
+    watcher.scan(emit=False)
+    assert events == []
+    assert list(watcher.editions) == [('TOI', 'BOM', '2024-01-02')]
+
+
+def test_edition_added_and_pages(watcher, cache_dir, events):
+    watcher.scan()
+    assert events == []
+    add_edition(cache_dir, pages=['page-001-thumbnail.jpg',
+                                  'page-001-lowres.webp'])
+    watcher.scan()
+    key = ('TOI', 'BOM', '2024-01-02')
+    assert events == [
+        CacheEvent(EDITION_ADDED, *key, page=None, rendition=None),
+        CacheEvent(PAGE_COMPLETED, *key, page=1, rendition='lowres'),
+        CacheEvent(PAGE_COMPLETED, *key, page=1, rendition='thumbnail'),
+    ]
+    del events[:]
+    add_edition(cache_dir, pages=['page-002-highres.pdf', '.page-003.tmp',
+                                  'page-003-lowres.jpg.tmp'])
+    watcher.scan()
+    assert events == [
+        CacheEvent(PAGE_COMPLETED, *key, page=2, rendition='pdf')]
+    del events[:]
+    watcher.scan()
+    assert events == []
+
+
+def test_edition_without_toc_is_ignored(watcher, cache_dir, events):
+    path = add_edition(cache_dir, pages=['page-001-thumbnail.jpg'])
+    os.remove(os.path.join(path, 'toc.json'))
+    watcher.scan()
+    assert events == []
+
+
+def test_edition_packed_and_evicted(watcher, cache_dir, events):
+    path = add_edition(cache_dir, pages=['page-001-thumbnail.jpg'])
+    watcher.scan()
+    del events[:]
+    pack_edition(path)
+    watcher.scan()
+    key = ('TOI', 'BOM', '2024-01-02')
+    assert events == [CacheEvent(EDITION_PACKED, *key, None, None)]
+    del events[:]
+    os.remove(path + '.zip')
+    watcher.scan()
+    assert events == [CacheEvent(EDITION_EVICTED, *key, None, None)]
+    assert watcher.editions == {}
+
+
+def test_failing_callback(cache_dir):
+    def callback(event):
+        raise ValueError(event)
+
+    watcher = CacheWatcher(cache_dir=cache_dir, callback=callback,
+                           use_inotify=False)
+    add_edition(cache_dir)
+    # logged, the scan goes on
+    watcher.scan()
+    assert ('TOI', 'BOM', '2024-01-02') in watcher.editions
+
+
+def run_watcher(cache_dir, use_inotify):
+    events = queue.Queue()
+    watcher = CacheWatcher(cache_dir=cache_dir, callback=events.put,
+                           interval=0.05, use_inotify=use_inotify)
+    add_edition(cache_dir, date='2024-01-01')
+    watcher.start()
+    try:
+        add_edition(cache_dir, pages=['page-001-thumbnail.jpg'])
+        key = ('TOI', 'BOM', '2024-01-02')
+        assert events.get(timeout=5) == CacheEvent(EDITION_ADDED, *key,
+                                                   None, None)
+        assert events.get(timeout=5) == CacheEvent(PAGE_COMPLETED, *key,
+                                                   1, 'thumbnail')
+    finally:
+        watcher.stop()
+    return watcher
+
+
+def test_watch_thread(cache_dir):
+    watcher = run_watcher(cache_dir, use_inotify=False)
+    assert watcher.backend == 'poll'
+
+
+@pytest.mark.skipif(inotify_simple is None, reason='needs inotify_simple')
+def test_watch_thread_inotify(cache_dir):
+    run_watcher(cache_dir, use_inotify=True)
+
+
+def test_apply_cache_event(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    epaper = EPaper(publisher='TOI', app_config=AppConfig())
+    cache_dir = epaper.app_config.config['App']['cache_dir']
+    key = ('TOI', 'BOM', '2024-01-02')
+    epaper.pages = [epaper.Page(number=1, title='Page 1', urls={
+        'thumbnail': ['', 'page-001-thumbnail.jpg', False]})]
+    epaper.download_path = os.path.join(cache_dir, *key)
+    assert epaper.apply_cache_event(
+        CacheEvent(EDITION_ADDED, *key, None, None))
+    assert epaper.on_disk_pubs == [key]
+    # a page of the edition being viewed
+    assert epaper.apply_cache_event(
+        CacheEvent(PAGE_COMPLETED, *key, 1, 'thumbnail'))
+    assert epaper.pages[0].urls['thumbnail'][2]
+    assert not epaper.apply_cache_event(
+        CacheEvent(EDITION_ADDED, 'TOI', 'DEL', '2024-01-02', None, None))
+    epaper.apply_cache_event(CacheEvent(EDITION_EVICTED, *key, None, None))
+    assert epaper.on_disk_pubs == [('TOI', 'DEL', '2024-01-02')]